@@ -0,0 +1,158 @@
+import os
+import json
+import threading
+import time
+
+
+''' Cache of the attribute schema (name, data type and writability of each
+ attribute) of the OMSvme and ZMX device classes. All the devices of a class
+ on one Tango host have the same attributes, so the schema is fetched with
+ get_attribute_config from the first device of the class used on each host
+ and kept in a JSON file. Entries are keyed by '<tango_host>/<prefix>', as
+ hosts may run different versions of the device servers. An entry is
+ refetched when it is older than the TTL, or when the attribute list of the
+ first device used in a run doesn't match it (e.g. the device server was
+ upgraded).'''
+_format_version = 2
+
+# Tango data types, by name, and the python type their values have
+_type_names = {'DevBoolean': 'bool',
+               'DevShort': 'int', 'DevUShort': 'int', 'DevLong': 'int', 'DevULong': 'int',
+               'DevLong64': 'int', 'DevULong64': 'int', 'DevUChar': 'int', 'DevEnum': 'int',
+               'DevFloat': 'float', 'DevDouble': 'float',
+               'DevString': 'str'}
+
+
+def type_name(data_type):
+    '''
+    Returns 'bool', 'int', 'float' or 'str' for a Tango data type, or None if
+    it isn't a scalar type we know
+    '''
+    return _type_names.get(getattr(data_type, 'name', None) or str(data_type))
+
+
+def is_writable(writable):
+    return (getattr(writable, 'name', None) or str(writable)) != 'READ'
+
+
+def proxy_host(dev_proxy):
+    '''
+    Returns the Tango host (host:port) of the database dev_proxy belongs to
+    '''
+    return '{}:{}'.format(dev_proxy.get_db_host(), dev_proxy.get_db_port())
+
+
+def class_key(tango_host, prefix):
+    return '{}/{}'.format(tango_host, prefix)
+
+
+def coerce_to_type(value, attr_type):
+    '''
+    Converts value to attr_type, where this can be done without losing
+    information. Anything else (e.g. nan) is returned unchanged.
+    '''
+    if attr_type == 'float' and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if attr_type == 'int' and isinstance(value, float) and value.is_integer():
+        return int(value)
+    if attr_type == 'bool' and value in (0, 1):
+        return bool(value)
+    return value
+
+
+def parse_value(string, attr_type):
+    '''
+    Converts a value from a .params file to attr_type. Raises ValueError if it
+    cannot be.
+    '''
+    if attr_type == 'str':
+        return string
+    if attr_type == 'bool':
+        if string in ('True', 'False'):
+            return string == 'True'
+        return coerce_to_type(int(string), 'bool')
+    try:
+        value = int(string)
+    except ValueError:
+        value = float(string)
+    return coerce_to_type(value, attr_type)
+
+
+class SchemaCache(object):
+    '''
+    The schemas of the device classes, keyed by Tango host and prefix ('oms'
+    or 'zmx'), kept in filename. Entries are trusted for ttl seconds.
+    '''
+
+    def __init__(self, filename, ttl=86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.classes = {}
+        self._checked = set()
+        self._lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as cache_file:
+                stored = json.load(cache_file)
+            if stored.get('format') == _format_version:
+                self.classes = stored['classes']
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump({'format': _format_version, 'classes': self.classes}, cache_file, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+
+    def fetch(self, key, dev_proxy):
+        '''
+        Reads the schema of the class of dev_proxy from the device
+        '''
+        attributes = {}
+        names = list(dev_proxy.get_attribute_list())
+        for config in dev_proxy.get_attribute_config(names):
+            attributes[config.name] = {'type': type_name(config.data_type), 'writable': is_writable(config.writable)}
+        # Keep the order of the device's attribute list
+        self.classes[key] = {'fetched': time.time(), 'names': names, 'attributes': attributes}
+        self._checked.add(key)
+        self.save()
+
+    def schema(self, prefix, dev_proxy):
+        '''
+        Returns the cached schema of the class of dev_proxy on its Tango host,
+        fetching it first if needed. The first time a class is used, its
+        attribute list is checked against the device.
+        '''
+        key = class_key(proxy_host(dev_proxy), prefix)
+        with self._lock:
+            entry = self.classes.get(key)
+            if entry is None or time.time() - entry['fetched'] > self.ttl:
+                self.fetch(key, dev_proxy)
+            elif key not in self._checked:
+                if list(dev_proxy.get_attribute_list()) != entry['names']:
+                    print('INFO: Attributes of {} have changed. Updating schema cache.'.format(key))
+                    self.fetch(key, dev_proxy)
+                self._checked.add(key)
+            return self.classes[key]
+
+    def attribute_names(self, prefix, dev_proxy):
+        return list(self.schema(prefix, dev_proxy)['names'])
+
+    def attribute_info(self, label, tango_host=None):
+        '''
+        Returns the cached {'type': ..., 'writable': ...} of an attribute
+        label (e.g. 'oms:Conversion') on tango_host, or None if it isn't
+        known. Without a tango_host (e.g. for a .params file), it is only
+        returned if every host cached agrees on it. Never talks to a device.
+        '''
+        prefix, _, attrib = label.partition(':')
+        if tango_host is not None:
+            entries = [self.classes.get(class_key(tango_host, prefix))]
+        else:
+            entries = [entry for key, entry in self.classes.items() if key.rsplit('/', 1)[-1] == prefix]
+        infos = [entry['attributes'].get(attrib) if entry else None for entry in entries]
+        if not infos or any(info != infos[0] for info in infos):
+            return None
+        return infos[0]
+
+    def attribute_type(self, label, tango_host=None):
+        info = self.attribute_info(label, tango_host)
+        return info['type'] if info else None
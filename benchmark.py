@@ -0,0 +1,113 @@
+import sys
+import argparse
+import contextlib
+import io
+import time
+
+import readMotor
+from simulatedMotors import SimulatedFarm
+
+
+''' Benchmarks of readMotor against a simulated motor farm (see
+ simulatedMotors.py). For each scenario and number of motors, reports the
+ motors per second, device round trips per motor and the p50/p99 time taken
+ for each motor.'''
+_scenarios = ['full', 'reduced', 'compare', 'write']
+_sizes = [16, 64, 512]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+@contextlib.contextmanager
+def timed(module, function_name, timings):
+    '''
+    Records how long each call of module.function_name takes in timings
+    '''
+    function = getattr(module, function_name)
+
+    def timed_function(*args, **kwargs):
+        start = time.monotonic()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            timings.append(time.monotonic() - start)
+
+    setattr(module, function_name, timed_function)
+    try:
+        yield
+    finally:
+        setattr(module, function_name, function)
+
+
+def run_scenario(scenario, n_motors, farm_settings, jobs=1):
+    farm = SimulatedFarm(**farm_settings)
+    config = {'beamline': 'p02', 'tango_host': 'simulated:10000', 'jobs': jobs}
+    motors = ['SIM.{:02d}'.format(i) for i in range(1, n_motors + 1)]
+    dev_names = {'SIM': motors}
+    timings = []
+
+    with farm.patch(), contextlib.redirect_stdout(io.StringIO()):
+        if not readMotor._reduced_attr:
+            readMotor.make_reduced_attribs()
+        reference = None
+        if scenario in ('compare', 'write'):
+            # Values to compare against/write: a snapshot with some changes
+            reference = readMotor.read_motors(dict(config, selection=readMotor._reduced_attr), dev_names)
+            for motor_params in reference.values():
+                motor_params['oms:SlewRate'] = 1000.0
+                motor_params['zmx:RunCurrent'] = 7
+        readMotor.clear_proxy_pool()
+        farm.reset_counts()
+
+        start = time.monotonic()
+        if scenario == 'write':
+            with timed(readMotor, 'write_motor', timings):
+                readMotor.write_motors(config, reference)
+        else:
+            if scenario in ('reduced', 'compare'):
+                config['selection'] = readMotor._reduced_attr
+            with timed(readMotor, 'read_motor', timings):
+                current = readMotor.read_motors(config, dev_names)
+            if scenario == 'compare':
+                readMotor.compare_parameters(reference, current)
+        elapsed = time.monotonic() - start
+
+    return {'scenario': scenario, 'motors': n_motors, 'seconds': elapsed,
+            'motors_per_second': n_motors / elapsed if elapsed else float('inf'),
+            'round_trips_per_motor': farm.round_trips() / n_motors,
+            'p50': percentile(timings, 0.5), 'p99': percentile(timings, 0.99)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark readMotor against a simulated motor farm')
+    parser.add_argument('--scenarios', default=','.join(_scenarios))
+    parser.add_argument('--sizes', default=','.join(str(size) for size in _sizes))
+    parser.add_argument('--jobs', '-j', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.0005, help='Seconds per device call')
+    parser.add_argument('--jitter', type=float, default=0.0002, help='Maximum random change to the latency')
+    parser.add_argument('--failure-rate', dest='failure_rate', type=float, default=0.0,
+                        help='Fraction of device calls which fail')
+    parser.add_argument('--extra-attributes', dest='extra_attributes', type=int, default=20,
+                        help='Attributes per device beyond the reduced set')
+    parser.add_argument('--eprom-cost', dest='eprom_cost', type=float, default=0.005,
+                        help='Extra seconds taken by WriteEPROM')
+    args = parser.parse_args(sys.argv[1:])
+
+    farm_settings = {'latency': args.latency, 'jitter': args.jitter, 'failure_rate': args.failure_rate,
+                     'extra_attributes': args.extra_attributes, 'eprom_cost': args.eprom_cost, 'seed': 0}
+    print('{:>8} {:>6} {:>9} {:>10} {:>12} {:>9} {:>9}'.format(
+        'scenario', 'motors', 'time (s)', 'motors/s', 'trips/motor', 'p50 (ms)', 'p99 (ms)'))
+    for scenario in args.scenarios.split(','):
+        for n_motors in map(int, args.sizes.split(',')):
+            result = run_scenario(scenario, n_motors, farm_settings, args.jobs)
+            print('{scenario:>8} {motors:>6} {seconds:>9.2f} {motors_per_second:>10.1f} {round_trips_per_motor:>12.1f} '
+                  '{p50_ms:>9.2f} {p99_ms:>9.2f}'.format(p50_ms=result['p50'] * 1e3, p99_ms=result['p99'] * 1e3, **result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+import sys
+import argparse
+import mmap
+import re
+import struct
+
+from array import array
+
+
+''' Compact binary snapshot format. Values are stored by column (one column per
+ attribute), so a file can be memory mapped and a column read without copying.
+
+ Layout:
+  - header: magic, version, byte order, number of motors, attributes & strings
+  - motor names, attribute names and string values ('\\0' separated, UTF-8)
+  - column type codes ('q' int64 or 'd' float64), one per attribute
+  - kind of each value (missing/int/float/bool/string), one byte per value
+  - the columns, each n_motors * 8 bytes
+ Everything after the header is aligned to 8 bytes. String values (e.g.
+ zmx:AxisName) are stored as indices into the string table.'''
+_magic = b'MRSNAP\r\n'
+_version = 1
+_header = struct.Struct('<8sBBxxIII')
+
+MISSING, INT, FLOAT, BOOL, STRING = range(5)
+
+_int_pattern = re.compile(r'[-+]?[0-9]+$')
+
+
+def _pad(length):
+    return b'\0' * (-length % 8)
+
+
+def _pack_names(names):
+    blob = '\0'.join(names).encode('utf-8')
+    return struct.pack('<I', len(blob)) + blob
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return BOOL
+    if isinstance(value, int):
+        return INT
+    if isinstance(value, float):
+        return FLOAT
+    return STRING
+
+
+def write_binary_snapshot(all_params, filename):
+    '''
+    Writes a dictionary of motor parameters (as returned by read_motors or
+    read_dat) to a binary snapshot file. Motors and attributes are sorted, as
+    in write_dat.
+    '''
+    motors = sorted(all_params.keys())
+    attributes = sorted(set().union(*all_params.values())) if motors else []
+    strings = {}
+
+    type_codes = []
+    kinds = array('B')
+    columns = []
+    for attr in attributes:
+        column_kinds = []
+        column_values = []
+        for motor in motors:
+            value = all_params[motor].get(attr)
+            if value is None:
+                column_kinds.append(MISSING)
+                column_values.append(0)
+                continue
+            kind = _value_kind(value)
+            if kind == STRING:
+                value = strings.setdefault(str(value), len(strings))
+            column_kinds.append(kind)
+            column_values.append(int(value) if kind == BOOL else value)
+
+        type_code = 'd' if FLOAT in column_kinds else 'q'
+        if type_code == 'd':
+            column_values = [float(value) for value in column_values]
+        type_codes.append(type_code)
+        kinds.extend(column_kinds)
+        columns.append(array(type_code, column_values))
+
+    byte_order = 0 if sys.byteorder == 'little' else 1
+    with open(filename, 'wb') as out_file:
+        body = _header.pack(_magic, _version, byte_order, len(motors), len(attributes), len(strings))
+        for names in (motors, attributes, sorted(strings, key=strings.get)):
+            body += _pack_names(names)
+        body += _pad(len(body))
+        body += ''.join(type_codes).encode('ascii')
+        body += _pad(len(body))
+        body += kinds.tobytes()
+        body += _pad(len(body))
+        out_file.write(body)
+        for column in columns:
+            out_file.write(column.tobytes())
+
+
+class BinarySnapshot(object):
+    '''
+    A memory mapped binary snapshot file. column() gives the values of one
+    attribute for all motors without copying them.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as in_file:
+            self._mmap = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, byte_order, n_motors, n_attrs, n_strings = _header.unpack_from(self._mmap, 0)
+        if magic != _magic or version != _version:
+            self.close()
+            raise ValueError('{} is not a version {} binary snapshot'.format(filename, _version))
+        self._swap_bytes = byte_order != (0 if sys.byteorder == 'little' else 1)
+
+        offset = _header.size
+        tables = []
+        for _ in range(3):
+            blob_len, = struct.unpack_from('<I', self._mmap, offset)
+            blob = bytes(self._view[offset + 4:offset + 4 + blob_len]).decode('utf-8')
+            tables.append(blob.split('\0') if blob_len else [])
+            offset += 4 + blob_len
+        self.motors, self.attributes, self.strings = tables
+        # An empty string is a valid (single) string value
+        if n_strings == 1 and not self.strings:
+            self.strings = ['']
+        offset += -offset % 8
+
+        self.type_codes = bytes(self._view[offset:offset + n_attrs]).decode('ascii')
+        offset += n_attrs
+        offset += -offset % 8
+        self._kinds = self._view[offset:offset + n_attrs * n_motors]
+        offset += n_attrs * n_motors
+        offset += -offset % 8
+        self._columns_offset = offset
+
+        self._motor_index = {motor: i for i, motor in enumerate(self.motors)}
+        self._attr_index = {attr: i for i, attr in enumerate(self.attributes)}
+
+    def column(self, attr):
+        '''
+        Returns the raw values of an attribute for all motors (in the order of
+        self.motors) as a memoryview of int64 or float64. Use kinds() to see
+        which values are missing or strings.
+        '''
+        i = self._attr_index[attr]
+        n_motors = len(self.motors)
+        start = self._columns_offset + i * n_motors * 8
+        raw = self._view[start:start + n_motors * 8]
+        if self._swap_bytes:
+            values = array(self.type_codes[i], raw.tobytes())
+            values.byteswap()
+            return memoryview(values)
+        return raw.cast(self.type_codes[i])
+
+    def kinds(self, attr):
+        i = self._attr_index[attr]
+        n_motors = len(self.motors)
+        return self._kinds[i * n_motors:(i + 1) * n_motors]
+
+    def _decode(self, kind, value):
+        if kind == INT:
+            return int(value)
+        if kind == BOOL:
+            return bool(value)
+        if kind == STRING:
+            return self.strings[int(value)]
+        return value
+
+    def value(self, motor, attr):
+        j = self._motor_index[motor]
+        kind = self.kinds(attr)[j]
+        if kind == MISSING:
+            raise KeyError('{} has no value for {}'.format(motor, attr))
+        return self._decode(kind, self.column(attr)[j])
+
+    def to_dict(self):
+        '''
+        Returns the snapshot as a dictionary, in the same form as read_motors
+        '''
+        all_params = {motor: {} for motor in self.motors}
+        for attr in self.attributes:
+            for motor, kind, value in zip(self.motors, self.kinds(attr), self.column(attr)):
+                if kind != MISSING:
+                    all_params[motor][attr] = self._decode(kind, value)
+        return all_params
+
+    def close(self):
+        self._kinds = None
+        self._view.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Columns are still in use elsewhere. The file stays mapped until
+            # they are released.
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def read_binary_snapshot(filename):
+    with BinarySnapshot(filename) as snapshot:
+        return snapshot.to_dict()
+
+
+def parse_params_value(string):
+    '''
+    Converts a value from a .params file back to what was read from the
+    device. Unlike read_dat, nothing is dropped, so the conversion is lossless.
+    '''
+    if _int_pattern.match(string):
+        return int(string)
+    if string in ('True', 'False'):
+        return string == 'True'
+    try:
+        return float(string)
+    except ValueError:
+        return string
+
+
+def read_params_raw(filename):
+    all_params = {}
+    with open(filename, 'r') as in_file:
+        for line in in_file:
+            line = line.rstrip('\n').split(',')
+            values = iter(line[1:])
+            all_params[line[0]] = {attr: parse_params_value(value) for attr, value in zip(values, values)}
+    return all_params
+
+
+def params_to_binary(params_filename, binary_filename):
+    write_binary_snapshot(read_params_raw(params_filename), binary_filename)
+
+
+def binary_to_params(binary_filename, params_filename, reduced_params_filename=None, reduced_params_list=()):
+    '''
+    Writes a binary snapshot back out as .params files, in the same format as
+    write_dat
+    '''
+    full_lines = []
+    reduced_lines = []
+    for motor, attributes in sorted(read_binary_snapshot(binary_filename).items()):
+        full_line = [motor]
+        reduced_line = [motor]
+        for attr, value in sorted(attributes.items()):
+            full_line.append('{},{}'.format(attr, value))
+            if attr in reduced_params_list:
+                reduced_line.append('{},{}'.format(attr, value))
+        full_lines.append(','.join(full_line) + '\n')
+        reduced_lines.append(','.join(reduced_line) + '\n')
+
+    with open(params_filename, 'w') as out_file:
+        out_file.writelines(full_lines)
+    if reduced_params_filename:
+        with open(reduced_params_filename, 'w') as out_file:
+            out_file.writelines(reduced_lines)
+
+
+def binary_filename_for(params_filename):
+    if params_filename.endswith('.params'):
+        params_filename = params_filename[:-len('.params')]
+    return params_filename + '.snap'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert between .params files and binary snapshots')
+    parser.add_argument('input_file')
+    parser.add_argument('output_file', nargs='?', default=None)
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.input_file.endswith('.snap'):
+        # Import here; readMotor isn't needed to convert to binary
+        from readMotor import _reduced_attr, make_reduced_attribs
+        make_reduced_attribs()
+        params_filename = args.output_file or args.input_file[:-len('.snap')] + '.params'
+        reduced_params_filename = params_filename[:-len('.params')] + '_reduced.params'
+        binary_to_params(args.input_file, params_filename, reduced_params_filename, _reduced_attr)
+    else:
+        params_to_binary(args.input_file, args.output_file or binary_filename_for(args.input_file))
+
+
+if __name__ == "__main__":
+    main()
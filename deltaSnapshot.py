@@ -0,0 +1,243 @@
+import os
+import argparse
+import bisect
+import json
+import re
+import sys
+import zlib
+
+from datetime import datetime
+
+
+''' Delta encoded snapshot storage. Most parameters don't change between
+ snapshots, so a store only records the (motor, attribute, value) entries which
+ changed since the previous snapshot. Every keyframe_interval snapshots a full
+ copy (keyframe) is written, so rebuilding a snapshot never has to replay more
+ than that many deltas.
+
+ Files are named motors-<YYYYMMDD_HHMMSS>.key or .delta (plus .z if zlib
+ compressed) and contain one JSON list per line:
+  [motor, {attr: value, ...}]  - the motor has exactly these parameters
+  [motor, attr, value]         - the parameter has a new value
+  [motor, attr]                - the parameter is no longer recorded
+  [motor]                      - the motor is no longer recorded'''
+_entry_pattern = re.compile(r'motors-(\d{8}_\d{6})\.(key|delta)(\.z)?$')
+_stamp_format = '%Y%m%d_%H%M%S'
+
+
+def make_stamp(when=None):
+    if when is None:
+        when = datetime.today()
+    return when.strftime(_stamp_format)
+
+
+def same_value(value_a, value_b):
+    '''
+    Returns True if a parameter with value_a and then value_b hasn't changed.
+    NaN != NaN, but it hasn't changed either.
+    '''
+    if value_a != value_a and value_b != value_b:
+        return True
+    return type(value_a) is type(value_b) and value_a == value_b
+
+
+def snapshot_delta(old_params, new_params):
+    '''
+    Returns the list of delta entries which turn old_params into new_params
+    '''
+    entries = []
+    for motor in sorted(set(old_params) - set(new_params)):
+        entries.append([motor])
+    for motor, attributes in sorted(new_params.items()):
+        if motor not in old_params:
+            entries.append([motor, dict(attributes)])
+            continue
+        old_attributes = old_params[motor]
+        for attr in sorted(set(old_attributes) - set(attributes)):
+            entries.append([motor, attr])
+        for attr, value in sorted(attributes.items()):
+            if attr not in old_attributes or not same_value(old_attributes[attr], value):
+                entries.append([motor, attr, value])
+    return entries
+
+
+def apply_delta(all_params, entries):
+    '''
+    Applies delta entries to all_params (in place)
+    '''
+    for entry in entries:
+        motor = entry[0]
+        if len(entry) == 1:
+            del all_params[motor]
+        elif isinstance(entry[1], dict):
+            all_params[motor] = dict(entry[1])
+        elif len(entry) == 2:
+            del all_params[motor][entry[1]]
+        else:
+            all_params.setdefault(motor, {})[entry[1]] = entry[2]
+    return all_params
+
+
+class DeltaStore(object):
+    '''
+    A directory of delta encoded snapshots. Use add_snapshot() (or writer())
+    to record a snapshot and read() to get any of them back.
+    '''
+
+    def __init__(self, store_dir, keyframe_interval=24, compress=False):
+        self.store_dir = store_dir
+        self.keyframe_interval = max(keyframe_interval, 1)
+        self.compress = compress
+        os.makedirs(store_dir, exist_ok=True)
+        self._latest = None
+
+    def entries(self):
+        '''
+        Returns a sorted list of (stamp, kind, filename) for the store
+        '''
+        entries = []
+        for filename in os.listdir(self.store_dir):
+            match = _entry_pattern.match(filename)
+            if match:
+                entries.append((match.group(1), match.group(2), filename))
+        return sorted(entries)
+
+    def _read_entries(self, filename):
+        with open(os.path.join(self.store_dir, filename), 'rb') as in_file:
+            content = in_file.read()
+        if filename.endswith('.z'):
+            content = zlib.decompress(content)
+        return [json.loads(line) for line in content.decode('utf-8').splitlines() if line]
+
+    def _write_entries(self, filename, entries):
+        content = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries).encode('utf-8')
+        if self.compress:
+            content = zlib.compress(content)
+            filename += '.z'
+        path = os.path.join(self.store_dir, filename)
+        with open(path + '.tmp', 'wb') as out_file:
+            out_file.write(content)
+        os.replace(path + '.tmp', path)
+        return filename
+
+    def read_raw(self, when=None):
+        '''
+        Returns the parameters of the last snapshot taken at or before when
+        (a datetime or stamp; default the latest), exactly as they were read
+        '''
+        entries = self.entries()
+        if when is not None:
+            if isinstance(when, datetime):
+                when = make_stamp(when)
+            entries = entries[:bisect.bisect_right([stamp for stamp, _, _ in entries], when)]
+        if not entries:
+            raise KeyError('No snapshot in {} at or before {}'.format(self.store_dir, when))
+
+        # Replay from the last keyframe
+        start = max(i for i, (_, kind, _) in enumerate(entries) if kind == 'key')
+        all_params = {}
+        for _, _, filename in entries[start:]:
+            apply_delta(all_params, self._read_entries(filename))
+        return all_params
+
+    def read(self, when=None):
+        '''
+        Returns the snapshot at when in the same form as read_dat would
+        return it from the .params file
+        '''
+        # Imported here, as readMotor imports this module
+        from readMotor import format_motor_lines, parse_dat_line
+
+        all_params = {}
+        for motor, attributes in sorted(self.read_raw(when).items()):
+            line, _ = format_motor_lines(motor, attributes, ())
+            device, attribs = parse_dat_line(line)
+            all_params[device] = attribs
+        return all_params
+
+    def add_snapshot(self, all_params, stamp=None):
+        '''
+        Records a snapshot, writing a keyframe if one is due and a delta
+        otherwise. Returns the name of the file written.
+        '''
+        if stamp is None:
+            stamp = make_stamp()
+        entries = self.entries()
+        if entries and stamp <= entries[-1][0]:
+            raise ValueError('Snapshot {} is not newer than the last in {}'.format(stamp, self.store_dir))
+
+        kinds = [kind for _, kind, _ in entries]
+        since_keyframe = kinds[::-1].index('key') if 'key' in kinds else None
+        if since_keyframe is None or since_keyframe + 1 >= self.keyframe_interval:
+            filename = self._write_entries('motors-{}.key'.format(stamp),
+                                           [[motor, dict(attributes)] for motor, attributes in sorted(all_params.items())])
+        else:
+            if self._latest is None:
+                self._latest = self.read_raw()
+            filename = self._write_entries('motors-{}.delta'.format(stamp),
+                                           snapshot_delta(self._latest, all_params))
+        self._latest = {motor: dict(attributes) for motor, attributes in all_params.items()}
+        return filename
+
+    def writer(self, stamp=None):
+        return DeltaWriter(self, stamp)
+
+
+class DeltaWriter(object):
+    '''
+    Collects motors as read_motors reads them (like SnapshotWriter) and adds
+    them to a DeltaStore as one snapshot when closed
+    '''
+
+    def __init__(self, store, stamp=None):
+        self.store = store
+        self.stamp = stamp or make_stamp()
+        self.all_params = {}
+        self.done_motors = set()
+        self.motor_status = {}
+
+    def write_motor(self, device, attributes):
+        self.all_params[device] = attributes
+        self.done_motors.add(device)
+
+    def mark_motor(self, device, status, reason):
+        self.motor_status[device] = (status, reason)
+
+    def close(self, complete=True):
+        if complete:
+            self.store.add_snapshot(self.all_params, self.stamp)
+            if self.motor_status:
+                from readMotor import write_motor_status
+                write_motor_status(self.motor_status,
+                                   os.path.join(self.store.store_dir, 'motors-{}.status'.format(self.stamp)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Add .params files to, or rebuild them from, a delta store')
+    parser.add_argument('store_dir')
+    parser.add_argument('--add', nargs='+', default=[], help='.params files to add, oldest first')
+    parser.add_argument('--at', default=None, help='Print the snapshot at this time (YYYYMMDD_HHMMSS)')
+    parser.add_argument('--keyframe-interval', dest='keyframe_interval', type=int, default=24)
+    parser.add_argument('--compress', action='store_true')
+    args = parser.parse_args(sys.argv[1:])
+
+    from binarySnapshot import read_params_raw
+    from readMotor import format_motor_lines
+
+    store = DeltaStore(args.store_dir, args.keyframe_interval, args.compress)
+    for params_filename in args.add:
+        stamp = re.search(r'(\d{8}_\d{6})', os.path.basename(params_filename)).group(1)
+        print('{} -> {}'.format(params_filename, store.add_snapshot(read_params_raw(params_filename), stamp)))
+    if args.at:
+        for motor, attributes in sorted(store.read_raw(args.at).items()):
+            sys.stdout.write(format_motor_lines(motor, attributes, ())[0])
+
+
+if __name__ == "__main__":
+    main()
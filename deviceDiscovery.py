@@ -0,0 +1,110 @@
+import os
+import json
+import threading
+import time
+
+try:
+    from PyTango import Database
+except ModuleNotFoundError:
+    Database = None
+
+
+''' Finds the motors which actually exist by asking the Tango database which
+ OMSvme ({beamline}/motor/*) and ZMX ({beamline}/ZMX/*) devices are exported.
+ A motor is used only if both its devices are. The result, grouped by server
+ (e.g. {'EH1A': ['EH1A.01', ...]}), is kept in a JSON file per Tango host and
+ beamline, and trusted for the TTL, so the database is asked at most once
+ per TTL.'''
+_format_version = 2
+
+
+def motor_name(dev_name):
+    '''
+    Returns the motor (e.g. 'EH1A.01') of a device name
+    '''
+    return dev_name.rsplit('/', 1)[-1]
+
+
+def server_name(motor):
+    return motor.rsplit('.', 1)[0]
+
+
+def pair_devices(oms_names, zmx_names):
+    '''
+    Returns ({server: [motors]}, unpaired device names) for the given OMS and
+    ZMX device names. Tango names are not case sensitive, so the motors are
+    named in upper case, as in readMotor._servers (e.g. 'EH1A.01').
+    '''
+    zmx_by_motor = {motor_name(name).upper(): name for name in zmx_names}
+    servers = {}
+    unpaired = []
+    for name in oms_names:
+        motor = motor_name(name).upper()
+        if zmx_by_motor.pop(motor, None) is None:
+            unpaired.append(name)
+        else:
+            servers.setdefault(server_name(motor), []).append(motor)
+    unpaired.extend(zmx_by_motor.values())
+    for motors in servers.values():
+        motors.sort()
+    return servers, sorted(unpaired)
+
+
+def exported_devices(database, pattern):
+    names = database.get_device_exported(pattern)
+    # PyTango returns a DbDatum
+    return list(getattr(names, 'value_string', names))
+
+
+def query_database(tango_host, beamline):
+    '''
+    Asks the Tango database of tango_host for the motors of beamline.
+    Returns {server: [motors]}.
+    '''
+    if Database is None:
+        raise RuntimeError('PyTango is needed to query the Tango database')
+    host, _, port = tango_host.partition(':')
+    database = Database(host, int(port or 10000))
+    servers, unpaired = pair_devices(exported_devices(database, '{}/motor/*'.format(beamline)),
+                                     exported_devices(database, '{}/ZMX/*'.format(beamline)))
+    if unpaired:
+        print('WARNING: Ignoring devices without an OMS/ZMX partner:\n{}'.format(', '.join(unpaired)))
+    return servers
+
+
+class DeviceDiscovery(object):
+    '''
+    The motors of each Tango host and beamline, cached in filename for ttl
+    seconds. Without a filename the database is asked once per instance.
+    '''
+
+    def __init__(self, filename=None, ttl=3600):
+        self.filename = filename
+        self.ttl = ttl
+        self.locations = {}
+        self._lock = threading.Lock()
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as cache_file:
+                stored = json.load(cache_file)
+            if stored.get('format') == _format_version:
+                self.locations = stored['locations']
+
+    def save(self):
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump({'format': _format_version, 'locations': self.locations}, cache_file, indent=1, sort_keys=True)
+        os.replace(tmp_filename, self.filename)
+
+    def servers(self, tango_host, beamline, refresh=False):
+        '''
+        Returns {server: [motors]} of the motors which exist on tango_host
+        '''
+        key = '{}/{}'.format(tango_host, beamline)
+        with self._lock:
+            entry = self.locations.get(key)
+            if refresh or entry is None or time.time() - entry['fetched'] > self.ttl:
+                entry = {'fetched': time.time(), 'servers': query_database(tango_host, beamline)}
+                self.locations[key] = entry
+                if self.filename:
+                    self.save()
+            return entry['servers']
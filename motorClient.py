@@ -0,0 +1,74 @@
+import os
+import sys
+import argparse
+import json
+import socket
+
+
+''' Thin client for motorDaemon.py. Takes the same arguments as readMotor.py
+ (plus --socket) and has the daemon do the work, so it starts quickly and
+ doesn't need PyTango. Options which set up the whole process (--metrics,
+ --schema-cache, --no-discover etc.) are given to the daemon when it is
+ started instead.'''
+_default_socket = '/tmp/motor_reader.sock'
+
+
+def connect(address):
+    if ':' in address:
+        host, _, port = address.rpartition(':')
+        return socket.create_connection((host, int(port)))
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(address)
+    return sock
+
+
+def send_request(request, address=_default_socket):
+    '''
+    Sends one request to the daemon and returns its response
+    '''
+    with connect(address) as sock:
+        sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as sock_file:
+            line = sock_file.readline()
+    if not line:
+        raise ConnectionError('No response from the daemon at {}'.format(address))
+    return json.loads(line.decode('utf-8'))
+
+
+def print_result(result):
+    if 'write_summary' in result:
+        print('Write summary:')
+        for outcome, outcome_motors in result['write_summary'].items():
+            print('{:>12}: {}'.format(outcome, ', '.join(outcome_motors) if outcome_motors else '-'))
+    elif 'compare_summary' in result:
+        summary = result['compare_summary']
+        for diff in result['differences']:
+            print('{} parameter for motor {} differ! (Input: {} Current: {})'.format(diff['parameter'], diff['motor'], diff['input'], diff['current']))
+        print('\nInput and current params are same for motors:\n{}'.format(', '.join(summary['same_motors'])))
+        print('Input and current params are DIFFERENT for motors:\n{}'.format(', '.join(summary['different_motors'])))
+        print('\n{} parameters of {} motors compared, {} differences'.format(summary['parameters'], summary['motors'], summary['differences']))
+    elif 'snapshot' in result:
+        print('Read {} motors into {}'.format(len(result['motors']), result['snapshot']))
+        for motor, (status, reason) in sorted(result['motor_status'].items()):
+            print('WARNING: {} {}: {}'.format(motor, status, reason))
+
+
+def main():
+    # Everything but --socket is passed on to the daemon (as readMotor.py arguments)
+    parser = argparse.ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument('--socket', default=_default_socket)
+    args, readmotor_args = parser.parse_known_args(sys.argv[1:])
+
+    response = send_request({'command': 'run', 'args': readmotor_args, 'cwd': os.getcwd()}, args.socket)
+    if not response['ok']:
+        print('ERROR: {}'.format(response['error']))
+        sys.exit(1)
+    print_result(response['result'])
+
+    summary = response['result'].get('write_summary')
+    if summary and (summary['rolled back'] or summary['failed']):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import sys
+import argparse
+import contextlib
+import io
+import json
+import socketserver
+import threading
+import time
+
+import readMotor
+
+
+''' Long running motor_reader service. The proxies (and, with --schema-cache,
+ the attribute schemas) are kept warm between requests, so a request doesn't
+ pay for starting python, importing PyTango or connecting to the devices.
+
+ Requests are read from a Unix socket (or localhost:port), one JSON object
+ per line, and each is answered with one line:
+  {"command": "run", "args": [<readMotor.py arguments>], "cwd": <directory>}
+      -> {"ok": true, "result": <as returned by readMotor.run>}
+  {"command": "status"}
+      -> {"ok": true, "result": {"proxies": ..., "requests": ..., "uptime": ...}}
+ Errors are answered with {"ok": false, "error": <message>}. Relative file
+ names in the arguments are relative to cwd, where snapshots are also saved.
+ Writes to the same motor are never run at the same time. Use motorClient.py
+ to send requests.'''
+_default_socket = '/tmp/motor_reader.sock'
+# Options which set up the whole process. They are given when the daemon is
+# started, so can't be changed by a request.
+_daemon_options = {'metrics': '--metrics', 'schema_cache': '--schema-cache', 'schema_ttl': '--schema-ttl',
+                   'discover': '--no-discover', 'device_cache': '--device-cache', 'device_ttl': '--device-ttl'}
+_path_options = ('input_file', 'compare_against', 'tolerances', 'diff_json', 'diff_csv', 'resume', 'rollback',
+                 'delta_store')
+
+
+class MotorLocks(object):
+    '''
+    One lock per motor (keyed by OMS device name), made on first use
+    '''
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def lock_for(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+
+class MotorService(object):
+    '''
+    Runs the requests. One instance is shared by all connections.
+    '''
+
+    def __init__(self, schema_cache=None, schema_ttl=86400, discover=False, device_cache=None, device_ttl=3600):
+        if not readMotor._reduced_attr:
+            readMotor.make_reduced_attribs()
+        if schema_cache:
+            readMotor.enable_schema_cache(schema_cache, schema_ttl)
+        if discover:
+            readMotor.enable_discovery(device_cache, device_ttl)
+        self.defaults = readMotor.parse_args(['--server', 'all'])
+        self.motor_locks = MotorLocks()
+        self.started = time.monotonic()
+        self.requests = 0
+        self._parse_lock = threading.Lock()
+
+    def parse_args(self, args):
+        '''
+        Returns (config, None), or (None, message) if args are not valid
+        '''
+        # argparse reports errors (and help) by printing and exiting. Capture
+        # them for the client. This briefly captures other requests' output too.
+        output = io.StringIO()
+        with self._parse_lock, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                return readMotor.parse_args(args), None
+            except SystemExit:
+                pass
+        return None, output.getvalue().strip() or 'Invalid arguments'
+
+    def handle(self, request):
+        self.requests += 1
+        command = request.get('command', 'run')
+        if command == 'status':
+            return {'ok': True, 'result': {'proxies': len(readMotor._proxy_pool), 'requests': self.requests,
+                                           'uptime': time.monotonic() - self.started}}
+        if command != 'run':
+            return {'ok': False, 'error': 'Unknown command {}'.format(command)}
+
+        config, error = self.parse_args(request.get('args', []))
+        if config is None:
+            return {'ok': False, 'error': error}
+        if config.get('watch'):
+            return {'ok': False, 'error': '--watch is not available through the daemon'}
+        fixed = sorted(option for key, option in _daemon_options.items() if config[key] != self.defaults[key])
+        if fixed:
+            return {'ok': False, 'error': '{} can only be given when starting the daemon'.format(', '.join(fixed))}
+
+        cwd = request.get('cwd') or os.getcwd()
+        for key in _path_options:
+            if config.get(key):
+                config[key] = os.path.join(cwd, config[key])
+        config['output_dir'] = cwd
+        config['motor_locks'] = self.motor_locks
+
+        try:
+            return {'ok': True, 'result': readMotor.run(config)}
+        except SystemExit:
+            return {'ok': False, 'error': 'Request aborted (see the daemon output for the reason)'}
+        except Exception as ex:
+            return {'ok': False, 'error': str(ex)}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+            except ValueError:
+                response = {'ok': False, 'error': 'Request is not valid JSON'}
+            else:
+                response = self.server.service.handle(request)
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, service):
+    '''
+    Returns a server for service listening on address: host:port, or the
+    path of a Unix socket
+    '''
+    if ':' in address:
+        host, _, port = address.rpartition(':')
+        if host not in ('localhost', '127.0.0.1', '::1'):
+            print('WARNING: Listening on {}. Anyone who can reach it can write to the motors!'.format(host))
+        server = ThreadingTCPServer((host, int(port)), RequestHandler)
+    else:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = ThreadingUnixServer(address, RequestHandler)
+    server.service = service
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve motor_reader requests with warm Tango connections')
+    parser.add_argument('--socket', default=_default_socket,
+                        help='Unix socket path, or localhost:port, to listen on')
+    parser.add_argument('--schema-cache', dest='schema_cache', default=None,
+                        help='File in which to cache the attribute names and types of the device classes')
+    parser.add_argument('--schema-ttl', dest='schema_ttl', type=float, default=86400)
+    parser.add_argument('--no-discover', dest='discover', action='store_false',
+                        help='Use the built-in list of servers instead of asking the Tango database which motors exist')
+    parser.add_argument('--device-cache', dest='device_cache', default=readMotor._device_cache,
+                        help='File in which to cache the motors found in the Tango database')
+    parser.add_argument('--device-ttl', dest='device_ttl', type=float, default=3600)
+    parser.add_argument('--metrics', default=None,
+                        help='Save timings of all Tango calls to this file when the daemon stops')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.metrics:
+        readMotor.enable_metrics(args.metrics)
+    service = MotorService(args.schema_cache, args.schema_ttl, args.discover, args.device_cache, args.device_ttl)
+    server = make_server(args.socket, service)
+    print('Listening on {}'.format(args.socket))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if ':' not in args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+import bisect
+import math
+import sys
+import threading
+
+from array import array
+from collections.abc import MutableMapping
+
+
+''' Compact in-memory form of the parameters of a set of motors. Attribute
+ labels (e.g. 'oms:Conversion') are interned once in an AttributeIndex shared
+ by all the motors, which maps each to a slot. A MotorSnapshot keeps its
+ values by slot in an array of doubles, with the kind of each value and a nan
+ mask in bytearrays; only strings (e.g. zmx:AxisName) and other objects are
+ kept as python objects. Iteration is in sorted label (and motor) order, which
+ the index keeps up to date as labels are added, so writing a snapshot out
+ never needs sorting.
+
+ Both classes behave as the dictionaries they replace, so callers can treat
+ them as such.'''
+MISSING, INT, FLOAT, BOOL, OBJECT = range(5)
+
+# Larger ints can't be stored exactly as doubles
+_max_exact_int = 2 ** 53
+
+
+class AttributeIndex(object):
+    '''
+    The slot of each attribute label, shared by many MotorSnapshots
+    '''
+    __slots__ = ('labels', 'slots', 'order', '_pairs', '_lock')
+
+    def __init__(self):
+        self.labels = []
+        self.slots = {}
+        # Slots in sorted label order
+        self.order = []
+        self._pairs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.labels)
+
+    def slot(self, label):
+        '''
+        Returns the slot of label, adding it if needed
+        '''
+        slot = self.slots.get(label)
+        if slot is not None:
+            return slot
+        with self._lock:
+            slot = self.slots.get(label)
+            if slot is None:
+                slot = len(self.labels)
+                self.labels.append(sys.intern(label))
+                self.slots[self.labels[slot]] = slot
+                position = bisect.bisect([self.labels[i] for i in self.order], label)
+                # Replaced rather than changed, so iterations already running aren't upset
+                self.order = self.order[:position] + [slot] + self.order[position:]
+        return slot
+
+    def pair_slot(self, prefix, attrib):
+        '''
+        Returns the slot of '<prefix>:<attrib>' without formatting the label
+        every time
+        '''
+        slot = self._pairs.get((prefix, attrib))
+        if slot is None:
+            slot = self.slot('{}:{}'.format(prefix, attrib))
+            self._pairs[(prefix, attrib)] = slot
+        return slot
+
+
+class MotorSnapshot(MutableMapping):
+    '''
+    The parameters of one motor, as a mapping of attribute label to value
+    '''
+    __slots__ = ('index', '_kinds', '_values', '_nan', '_objects')
+
+    def __init__(self, index, params=None):
+        self.index = index
+        self._kinds = bytearray()
+        self._values = array('d')
+        self._nan = bytearray()
+        self._objects = {}
+        if params:
+            for label, value in params.items():
+                self[label] = value
+
+    def _grow(self, size):
+        missing = size - len(self._kinds)
+        if missing > 0:
+            self._kinds.extend(bytes(missing))
+            self._values.extend([0.0] * missing)
+            self._nan.extend(bytes(missing))
+
+    def set_slot(self, slot, value):
+        self._grow(slot + 1)
+        self._nan[slot] = 0
+        self._objects.pop(slot, None)
+        if isinstance(value, bool):
+            self._kinds[slot] = BOOL
+            self._values[slot] = float(value)
+        elif isinstance(value, int) and -_max_exact_int <= value <= _max_exact_int:
+            self._kinds[slot] = INT
+            self._values[slot] = value
+        elif isinstance(value, float):
+            self._kinds[slot] = FLOAT
+            self._values[slot] = value
+            self._nan[slot] = math.isnan(value)
+        else:
+            self._kinds[slot] = OBJECT
+            self._objects[slot] = value
+
+    def get_slot(self, slot):
+        kind = self._kinds[slot] if slot < len(self._kinds) else MISSING
+        if kind == FLOAT:
+            return self._values[slot]
+        if kind == INT:
+            return int(self._values[slot])
+        if kind == BOOL:
+            return bool(self._values[slot])
+        if kind == OBJECT:
+            return self._objects[slot]
+        raise KeyError(self.index.labels[slot] if slot < len(self.index) else slot)
+
+    def __getitem__(self, label):
+        slot = self.index.slots.get(label)
+        if slot is None:
+            raise KeyError(label)
+        return self.get_slot(slot)
+
+    def __setitem__(self, label, value):
+        self.set_slot(self.index.slot(label), value)
+
+    def __delitem__(self, label):
+        slot = self.index.slots.get(label)
+        if slot is None or slot >= len(self._kinds) or self._kinds[slot] == MISSING:
+            raise KeyError(label)
+        self._kinds[slot] = MISSING
+        self._nan[slot] = 0
+        self._objects.pop(slot, None)
+
+    def __contains__(self, label):
+        slot = self.index.slots.get(label)
+        return slot is not None and slot < len(self._kinds) and self._kinds[slot] != MISSING
+
+    def __iter__(self):
+        labels = self.index.labels
+        kinds = self._kinds
+        n_slots = len(kinds)
+        for slot in self.index.order:
+            if slot < n_slots and kinds[slot]:
+                yield labels[slot]
+
+    def __len__(self):
+        return len(self._kinds) - self._kinds.count(MISSING)
+
+    def items(self):
+        '''
+        Returns (label, value) pairs in sorted label order
+        '''
+        return [(label, self.get_slot(self.index.slots[label])) for label in self]
+
+    def nan_labels(self):
+        '''
+        Returns the labels of the values which are nan (e.g. couldn't be read)
+        '''
+        return [self.index.labels[slot] for slot in self.index.order if slot < len(self._nan) and self._nan[slot]]
+
+    def copy(self):
+        return MotorSnapshot(self.index, self)
+
+    def __repr__(self):
+        return 'MotorSnapshot({!r})'.format(dict(self.items()))
+
+
+class FleetSnapshot(MutableMapping):
+    '''
+    The parameters of many motors, as a mapping of motor name to
+    MotorSnapshot. Plain dictionaries stored in it are converted.
+    '''
+    __slots__ = ('index', '_motors', '_names')
+
+    def __init__(self, index=None, all_params=None):
+        self.index = index if index is not None else AttributeIndex()
+        self._motors = {}
+        # Kept sorted
+        self._names = []
+        if all_params:
+            for motor, params in all_params.items():
+                self[motor] = params
+
+    def __getitem__(self, motor):
+        return self._motors[motor]
+
+    def __setitem__(self, motor, params):
+        if not (isinstance(params, MotorSnapshot) and params.index is self.index):
+            params = MotorSnapshot(self.index, params)
+        if motor not in self._motors:
+            bisect.insort(self._names, motor)
+        self._motors[motor] = params
+
+    def __delitem__(self, motor):
+        del self._motors[motor]
+        del self._names[bisect.bisect_left(self._names, motor)]
+
+    def __contains__(self, motor):
+        return motor in self._motors
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return 'FleetSnapshot({!r})'.format({motor: dict(params.items()) for motor, params in self.items()})
@@ -1,15 +1,38 @@
+import os
 import sys
 import argparse
 import math
 import itertools
-
+import fnmatch
+import threading
+import time
+import random
+import re
+import csv
+import json
+import atexit
+
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
+import attributeSchema
+import binarySnapshot
+import deltaSnapshot
+import deviceDiscovery
+import motorSnapshot
+import shardedSnapshot
+import tangoMetrics
+
 try:
-    from PyTango import DeviceProxy, DevFailed
+    from PyTango import DeviceProxy, DevFailed, DevSource, EventType
 except ModuleNotFoundError:
     print("WARNING: No PyTango module imported!\n\nIgnore if testing")
     DeviceProxy = None
+    DevSource = None
+    EventType = None
 
 
 # Need python 3.5 to use math.nan
@@ -40,12 +63,58 @@ _parameters_list = {'zmx': ['StopCurrent', 'RunCurrent',
                             'CorrectionGain', 'SlipTolerance', 'CutOrMap',
                             'FlagInvertEncoderDirection',
                             'FlagCheckZMXActivated']}
+
+''' Where attributes may be read from (see --read-source), from the freshest:
+ the hardware, the device server's cache (polling buffer) if the attribute is
+ polled and the hardware otherwise, or only the cache. When a source is asked
+ for, _read_policy gives the least fresh source allowed for an attribute: the
+ flags which protect a motor are always read from the hardware.'''
+_read_sources = {'device': 'DEV', 'cache-device': 'CACHE_DEV', 'cache': 'CACHE'}
+_read_source_order = ('device', 'cache-device', 'cache')
+_read_policy = {'oms:FlagProtected': 'device', 'oms:FlagEncoderHomed': 'device',
+                'oms:FlagCheckZMXActivated': 'device', 'zmx:Deactivation': 'device'}
 _beamline = 'p02'
 _tango_host = 'haspp02oh1:10000'
+# Used when the motors can't be discovered from the Tango database
 _servers = {'EH1A': 64, 'EH1B': 16}
+_device_cache = os.path.join(os.path.expanduser('~'), '.motor_reader_devices.json')
 
 _reduced_attr = []
 
+# Taken from jive. DelayTime value reported cannot be written back
+# directly. Needs to be mapped.
+_DelayTime_map = {1: 0, 2: 1, 4: 2, 6: 3, 8: 4, 10: 5, 12: 6, 14: 7, 16: 8,
+                  20: 9, 40: 10, 60: 11, 100: 12, 200: 13, 500: 14,
+                  1000: 15}
+
+# DeviceProxys are expensive to create, so they are shared between the read,
+# write & compare phases. Keyed by full device name.
+_proxy_pool = {}
+_proxy_pool_lock = threading.Lock()
+# Held while reading from a (shared) DeviceProxy, so a read which changes its
+# source can't affect other reads. Keyed by device name.
+_source_locks = {}
+
+# Slots of the attribute labels, shared by all the MotorSnapshots we make
+_attribute_index = motorSnapshot.AttributeIndex()
+
+# Concurrency limiters (AdaptiveLimiter), keyed by ('read' or 'write',
+# tango_host, server). Each server's motors are driven by one device server
+# process.
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+# Timings of the calls to Tango devices (a tangoMetrics.Metrics), if enabled
+_metrics = None
+
+# Attribute names & types of the device classes (an attributeSchema.SchemaCache),
+# if enabled
+_schema_cache = None
+
+# The motors which exist on each Tango host (a deviceDiscovery.DeviceDiscovery),
+# if enabled. Otherwise _servers is used.
+_discovery = None
+
 
 def make_reduced_attribs():
     # TODO FIXME Needs a test!
@@ -54,21 +123,193 @@ def make_reduced_attribs():
             _reduced_attr.append('{}:{}'.format(dev_proxy, attr))
 
 
+def enable_metrics(filename=None):
+    '''
+    Starts timing every call to a Tango device. New proxies are wrapped so
+    that each call is recorded. If filename is given the metrics are saved to
+    it (as JSON, or Prometheus text if it ends with .prom) on exit.
+    '''
+    global _metrics
+    _metrics = tangoMetrics.Metrics()
+    clear_proxy_pool()
+    if filename:
+        atexit.register(_metrics.write, filename)
+    return _metrics
+
+
+def enable_schema_cache(filename, ttl=86400):
+    '''
+    Uses the attribute schema cached in filename (see attributeSchema)
+    instead of asking each device for its attribute list, and to convert
+    values to the exact type of their attribute
+    '''
+    global _schema_cache
+    _schema_cache = attributeSchema.SchemaCache(filename, ttl)
+    return _schema_cache
+
+
+def enable_discovery(filename=None, ttl=3600):
+    '''
+    Takes the motors from the Tango database (see deviceDiscovery), cached in
+    filename, instead of from _servers
+    '''
+    global _discovery
+    _discovery = deviceDiscovery.DeviceDiscovery(filename, ttl)
+    return _discovery
+
+
+def discovered_servers(config, refresh=False):
+    '''
+    Returns {server: [motors]} of the motors which exist on the Tango host
+    of config, or None if discovery isn't enabled, the database can't be
+    asked or we are comparing files offline (--against). If refresh, the
+    database is asked again even if the cached answer is recent.
+    '''
+    if _discovery is None or config.get('compare_against'):
+        return None
+    try:
+        return _discovery.servers(config['tango_host'], config['beamline'], refresh=refresh)
+    except Exception as ex:
+        print('WARNING: Could not discover the motors of {} ({}). Using the built-in list of servers.'.format(
+            config['tango_host'], ex))
+        return None
+
+
+def attribute_type(label, tango_host=None):
+    '''
+    Returns the type ('bool', 'int', 'float' or 'str') of an attribute label
+    (e.g. 'oms:Conversion') if it is in the schema cache, otherwise None
+    '''
+    if _schema_cache is None:
+        return None
+    return _schema_cache.attribute_type(label, tango_host)
+
+
 def parse_args(user_args):
     parser = argparse.ArgumentParser()
     parser.add_argument('--beamline', '-b', default=_beamline)
-    parser.add_argument('--tango-host', dest='tango_host', default=_tango_host)
-    parser.add_argument('--server', '-s', required=True)
-    # At somepoint we could make server not required, default to the all the
-    # keys in the _servers dict. But that needs more refactoring
+    parser.add_argument('--tango-host', dest='tango_host', default=_tango_host,
+                        help='Tango host or comma separated list of hosts, each optionally as host:port/beamline')
+    parser.add_argument('--server', '-s', required=True,
+                        help='Server, comma separated list of servers or "all"')
     parser.add_argument('--write', default=False)
-    parser.add_argument('--compare', default=False)  # FIXME: This is not tested!
+    parser.add_argument('--compare', default=False)
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=None,
+                        help='Maximum number of attributes to request in one read (default: all)')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of motors to read at the same time')
+    parser.add_argument('--select', default=None,
+                        help='Comma separated list of attributes (e.g. oms:Conversion,zmx:*Current) '
+                             'to read, or "reduced" for the reduced attribute set')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Connect to all motors (--jobs at a time) before starting')
+    parser.add_argument('--only-changed', dest='only_changed', action='store_true',
+                        help='Only write parameters which differ from the current values')
+    parser.add_argument('--retries', type=int, default=3,
+                        help='Number of attempts at writing each attribute')
+    parser.add_argument('--write-deadline', dest='write_deadline', type=float, default=None,
+                        help='Time (s) after which failed writes to a motor are no longer retried')
+    parser.add_argument('--resume', default=None,
+                        help='Continue an interrupted read, given its partial .params.part file, '
+                             'or an interrupted --write, given its .journal file')
+    parser.add_argument('--rollback', default=None,
+                        help='Restore the values from before the --write run recorded in this .journal file')
+    parser.add_argument('--binary', action='store_true',
+                        help='Also save the snapshot in the binary (.snap) format')
+    parser.add_argument('--delta-store', dest='delta_store', default=None,
+                        help='Save the snapshot in this delta store instead of .params files')
+    parser.add_argument('--keyframe-interval', dest='keyframe_interval', type=int, default=24,
+                        help='Number of snapshots between full copies in the delta store')
+    parser.add_argument('--compress', action='store_true',
+                        help='Compress the files in the delta store')
+    parser.add_argument('--against', default=None,
+                        help='Compare with this .params file instead of the current values')
+    parser.add_argument('--tolerances', default=None,
+                        help='JSON file of comparison tolerances, e.g. {"oms:Position": {"abs": 0.01}}')
+    parser.add_argument('--diff-json', dest='diff_json', default=None,
+                        help='Save the differences found by --compare in this JSON file')
+    parser.add_argument('--diff-csv', dest='diff_csv', default=None,
+                        help='Save the differences found by --compare in this CSV file')
+    parser.add_argument('--host-jobs', dest='host_jobs', type=int, default=None,
+                        help='Maximum number of motors to read at once on each Tango host when reading several servers')
+    parser.add_argument('--probe', action='store_true',
+                        help='Ping all devices before reading and skip the motors which do not answer')
+    parser.add_argument('--probe-timeout', dest='probe_timeout', type=int, default=500,
+                        help='Time (ms) to wait for each device to answer the --probe ping')
+    parser.add_argument('--motor-budget', dest='motor_budget', type=float, default=None,
+                        help='Time (s) after which reading a motor is given up and the motor skipped')
+    parser.add_argument('--schema-cache', dest='schema_cache', default=None,
+                        help='File in which to cache the attribute names and types of the device classes')
+    parser.add_argument('--schema-ttl', dest='schema_ttl', type=float, default=86400,
+                        help='Time (s) after which the cached schema is read again from the devices')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep watching the (selected or reduced) attributes and log every change')
+    parser.add_argument('--watch-interval', dest='watch_interval', type=float, default=10,
+                        help='Time (s) between reads of the motors which cannot send change events')
+    parser.add_argument('--watch-log', dest='watch_log', default='motor-changes.log',
+                        help='File to which --watch appends the changes')
+    parser.add_argument('--adaptive', type=int, default=None,
+                        help='Adjust the number of motors of each server read or written at once, up to this many')
+    parser.add_argument('--metrics', default=None,
+                        help='Save timings of all Tango calls to this file (Prometheus text format if it ends with .prom, otherwise JSON)')
+    parser.add_argument('--no-discover', dest='discover', action='store_false',
+                        help='Use the built-in list of servers instead of asking the Tango database which motors exist')
+    parser.add_argument('--device-cache', dest='device_cache', default=_device_cache,
+                        help='File in which to cache the motors found in the Tango database')
+    parser.add_argument('--device-ttl', dest='device_ttl', type=float, default=3600,
+                        help='Time (s) after which the Tango database is asked again which motors exist')
+    parser.add_argument('--shards', type=int, default=None,
+                        help='Read the snapshot in this many worker processes and merge their partial snapshots')
+    parser.add_argument('--shard-hosts', dest='shard_hosts', default=None,
+                        help='Comma separated list of hosts on which to start the --shards workers (with ssh)')
+    parser.add_argument('--read-source', dest='read_source', choices=sorted(_read_sources), default=None,
+                        help='Read snapshots and comparisons from the hardware (device), the device server cache '
+                             '(polling buffer) falling back to the hardware (cache-device), or only the cache. '
+                             'By default the Tango default (cache-device) is used for every attribute.')
     parser.add_argument('dev_ids', default=None, nargs='?')
 
     args = parser.parse_args(user_args)
     config = {'beamline': args.beamline,
               'tango_host': args.tango_host,
-              'server': args.server}
+              'server': args.server,
+              'chunk_size': args.chunk_size,
+              'jobs': args.jobs,
+              'prewarm': args.prewarm,
+              'only_changed': args.only_changed,
+              'retries': args.retries,
+              'write_deadline': args.write_deadline,
+              'resume': args.resume,
+              'rollback': args.rollback,
+              'binary': args.binary,
+              'delta_store': args.delta_store,
+              'keyframe_interval': args.keyframe_interval,
+              'compress': args.compress,
+              'compare_against': args.against,
+              'tolerances': args.tolerances,
+              'diff_json': args.diff_json,
+              'diff_csv': args.diff_csv,
+              'host_jobs': args.host_jobs,
+              'probe': args.probe,
+              'probe_timeout': args.probe_timeout,
+              'motor_budget': args.motor_budget,
+              'schema_cache': args.schema_cache,
+              'schema_ttl': args.schema_ttl,
+              'watch': args.watch,
+              'watch_interval': args.watch_interval,
+              'watch_log': args.watch_log,
+              'adaptive': args.adaptive,
+              'metrics': args.metrics,
+              'discover': args.discover,
+              'device_cache': args.device_cache,
+              'device_ttl': args.device_ttl,
+              'shards': args.shards,
+              'shard_hosts': args.shard_hosts,
+              'read_source': args.read_source}
+
+    if args.select:
+        config['selection'] = args.select.split(',')
+    else:
+        config['selection'] = None
 
     if args.write:
         config['write_params'] = True
@@ -119,99 +360,715 @@ def generate_device_names(server, dev_ids=None):
     return server_devs
 
 
-def read_parameters(oms_dp, zmx_dp):
+def device_names(config, refresh=False):
     '''
-    Returns a dictionary containing the values of all the attributes
+    Returns {server: [motors]} of the motors of config['server'] (only those
+    in config['dev_ids'], if given). With discovery enabled only motors
+    which exist are returned (see discovered_servers for refresh).
     '''
-    motor_params = {}
+    servers = discovered_servers(config, refresh)
+    if servers is None:
+        return generate_device_names(config['server'], config['dev_ids'])
 
-    for prefix, dev_proxy in {'oms': oms_dp, 'zmx': zmx_dp}.items():
-        all_attributes = dev_proxy.get_attribute_list()
-        for attrib in all_attributes:
-            label = '{}:{}'.format(prefix, attrib)
+    # Discovered names are in upper case (see deviceDiscovery.pair_devices)
+    server = config['server'].upper()
+    motors = servers.get(server, [])
+    if config['dev_ids']:
+        wanted = generate_device_names(server, config['dev_ids'])[server]
+        missing = [motor for motor in wanted if motor not in motors]
+        if missing:
+            print('WARNING: These motors do not exist on {}:\n{}'.format(config['tango_host'], ', '.join(missing)))
+        motors = [motor for motor in wanted if motor in motors]
+    elif not motors:
+        print('WARNING: No motors of {} found on {}'.format(server, config['tango_host']))
+    return {server: list(motors)}
+
+
+def oms_device_name(config, motor):
+    return '{}/{}/motor/{}'.format(config['tango_host'], config['beamline'], motor)
+
+
+def zmx_device_name(config, motor):
+    return '{}/{}/ZMX/{}'.format(config['tango_host'], config['beamline'], motor)
+
+
+def get_proxy(dev_name):
+    '''
+    Returns the DeviceProxy for dev_name from the pool, creating it on first use
+    '''
+    with _proxy_pool_lock:
+        dev_proxy = _proxy_pool.get(dev_name)
+    if dev_proxy is None:
+        # Created outside the lock so that slow connections don't block others
+        if _metrics is None:
+            dev_proxy = DeviceProxy(dev_name)
+        else:
+            start = time.perf_counter()
             try:
-                motor_params[label] = dev_proxy.read_attribute(attrib).value
-            except DevFailed:
+                dev_proxy = DeviceProxy(dev_name)
+            except Exception:
+                _metrics.record(tangoMetrics.device_class(dev_name), 'DeviceProxy', '', time.perf_counter() - start, True)
+                raise
+            _metrics.record(tangoMetrics.device_class(dev_name), 'DeviceProxy', '', time.perf_counter() - start)
+            dev_proxy = tangoMetrics.InstrumentedProxy(dev_proxy, dev_name, _metrics)
+        with _proxy_pool_lock:
+            dev_proxy = _proxy_pool.setdefault(dev_name, dev_proxy)
+    return dev_proxy
+
+
+def evict_proxy(dev_name):
+    '''
+    Removes a (probably dead) DeviceProxy from the pool so it is recreated the
+    next time it is needed
+    '''
+    with _proxy_pool_lock:
+        _proxy_pool.pop(dev_name, None)
+
+
+def clear_proxy_pool():
+    with _proxy_pool_lock:
+        _proxy_pool.clear()
+        _source_locks.clear()
+
+
+def source_lock(dev_proxy):
+    with _proxy_pool_lock:
+        return _source_locks.setdefault(dev_proxy.dev_name(), threading.Lock())
+
+
+def get_motor_proxies(config, motor):
+    '''
+    Returns the (OMS, ZMX) DeviceProxy pair for a motor
+    '''
+    return (get_proxy(oms_device_name(config, motor)),
+            get_proxy(zmx_device_name(config, motor)))
+
+
+def evict_motor_proxies(config, motor):
+    evict_proxy(oms_device_name(config, motor))
+    evict_proxy(zmx_device_name(config, motor))
+
+
+def prewarm_proxies(config, motors, jobs=1):
+    '''
+    Creates the proxies for all the given motors, jobs at a time. Motors whose
+    proxies cannot be created are reported and skipped.
+    '''
+    def try_get_proxies(motor):
+        try:
+            get_motor_proxies(config, motor)
+        except Exception as ex:
+            print('WARNING: Could not connect to motor {}:\n{}'.format(motor, str(ex)))
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        list(executor.map(try_get_proxies, motors))
+
+
+def ping_device(dev_name, timeout=None):
+    '''
+    Pings a device, with a client timeout of timeout ms if given. Returns None
+    if the device answered, otherwise the reason it didn't.
+    '''
+    try:
+        dev_proxy = get_proxy(dev_name)
+        if timeout:
+            old_timeout = dev_proxy.get_timeout_millis()
+            dev_proxy.set_timeout_millis(timeout)
+            try:
+                dev_proxy.ping()
+            finally:
+                dev_proxy.set_timeout_millis(old_timeout)
+        else:
+            dev_proxy.ping()
+    except Exception as ex:
+        evict_proxy(dev_name)
+        return '{} did not answer ping: {}'.format(dev_name, str(ex) or type(ex).__name__)
+    return None
+
+
+def probe_motors(config, motors):
+    '''
+    Pings the OMS and ZMX devices of all the motors at the same time, so that
+    dead motors can be skipped instead of timing out on every attribute.
+    Returns a dictionary of the unreachable motors, with the reason.
+    '''
+    dev_names = [(motor, dev_name) for motor in motors
+                 for dev_name in (oms_device_name(config, motor), zmx_device_name(config, motor))]
+    if not dev_names:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(len(dev_names), 64)) as executor:
+        reasons = list(executor.map(lambda name: ping_device(name[1], config.get('probe_timeout')), dev_names))
+
+    unreachable = {}
+    for (motor, _), reason in zip(dev_names, reasons):
+        if reason is not None and motor not in unreachable:
+            unreachable[motor] = reason
+    return unreachable
+
+
+class MotorBudgetExceeded(Exception):
+    '''
+    Raised when reading a motor takes longer than its time budget
+    '''
+
+
+def check_deadline(dev_proxy, deadline):
+    if deadline is not None and time.monotonic() > deadline:
+        raise MotorBudgetExceeded('Time budget used up reading {}'.format(dev_proxy.dev_name()))
+
+
+@contextmanager
+def budget_timeout(dev_proxy, deadline):
+    '''
+    Caps the client timeout of dev_proxy at the time left until deadline for
+    the call made in the context, so a device which hangs can't keep us past
+    it. A call cut short by the cap raises MotorBudgetExceeded.
+    '''
+    check_deadline(dev_proxy, deadline)
+    if deadline is None:
+        yield
+        return
+    old_timeout = dev_proxy.get_timeout_millis()
+    timeout = max(math.ceil((deadline - time.monotonic()) * 1000), 1)
+    if timeout >= old_timeout:
+        yield
+        return
+    dev_proxy.set_timeout_millis(timeout)
+    try:
+        yield
+    except DevFailed:
+        check_deadline(dev_proxy, deadline)
+        raise
+    finally:
+        dev_proxy.set_timeout_millis(old_timeout)
+
+
+def read_attribute_values(dev_proxy, attributes, chunk_size=None, deadline=None):
+    '''
+    Reads the given attributes from a device using as few read_attributes
+    calls as possible. If chunk_size is given, attributes are requested in
+    groups of at most that many. Returns a list of values in the same order as
+    attributes; any value which cannot be read is returned as nan. If the
+    deadline (a time.monotonic() time) passes, MotorBudgetExceeded is raised;
+    no call to the device is allowed to run past it (see budget_timeout).
+    '''
+    attributes = list(attributes)
+    if not chunk_size:
+        chunk_size = max(len(attributes), 1)
+
+    values = []
+    for i in range(0, len(attributes), chunk_size):
+        chunk = attributes[i:i + chunk_size]
+        try:
+            with budget_timeout(dev_proxy, deadline):
+                dev_attrs = dev_proxy.read_attributes(chunk)
+        except (DevFailed, UnicodeDecodeError):
+            # One bad attribute spoils the whole batch. Fall back to reading
+            # this chunk one attribute at a time to find out which.
+            for attrib in chunk:
+                values.append(read_single_attribute(dev_proxy, attrib, deadline))
+            continue
+
+        for attrib, dev_attr in zip(chunk, dev_attrs):
+            if getattr(dev_attr, 'has_failed', False):
                 print('INFO: Value of {} ({}) is undefined. Saved as nan.'.format(attrib, dev_proxy.dev_name()))
-                motor_params[label] = math.nan
-            except UnicodeDecodeError:
-                print('WARNING: Cannot read value of {} ({}). Saved as nan.'.format(attrib, dev_proxy.dev_name()))
-                motor_params[label] = math.nan
+                values.append(math.nan)
+            else:
+                values.append(dev_attr.value)
+
+    return values
+
+
+def read_single_attribute(dev_proxy, attrib, deadline=None):
+    '''
+    Reads one attribute from a device, returning nan if it cannot be read
+    '''
+    try:
+        with budget_timeout(dev_proxy, deadline):
+            return dev_proxy.read_attribute(attrib).value
+    except DevFailed:
+        print('INFO: Value of {} ({}) is undefined. Saved as nan.'.format(attrib, dev_proxy.dev_name()))
+    except UnicodeDecodeError:
+        print('WARNING: Cannot read value of {} ({}). Saved as nan.'.format(attrib, dev_proxy.dev_name()))
+    return math.nan
+
+
+def attribute_list(prefix, dev_proxy):
+    '''
+    Returns the names of the attributes of a device, from the schema cache if
+    it is enabled
+    '''
+    if _schema_cache is None:
+        return list(dev_proxy.get_attribute_list())
+    return _schema_cache.attribute_names(prefix, dev_proxy)
+
+
+def select_attributes(prefix, dev_proxy, selection=None):
+    '''
+    Determines which attributes of dev_proxy to read. With no selection, all
+    the attributes of the device are read. Otherwise selection is a list of
+    labels (e.g. 'oms:Conversion') or glob patterns (e.g. 'oms:Slew*'); only
+    entries for this prefix are used. The attribute list is only requested
+    from the device when a pattern needs to be matched.
+    '''
+    if selection is None:
+        return attribute_list(prefix, dev_proxy)
+
+    wanted = []
+    for label in selection:
+        label_prefix, _, attrib = label.partition(':')
+        if fnmatch.fnmatchcase(prefix, label_prefix) and attrib:
+            wanted.append(attrib)
+
+    if any(char in attrib for attrib in wanted for char in '*?['):
+        return [attrib for attrib in attribute_list(prefix, dev_proxy)
+                if any(fnmatch.fnmatchcase(attrib, pattern) for pattern in wanted)]
+    # Remove duplicates, but keep the order
+    return list(dict.fromkeys(wanted))
+
+
+def resolve_selection(selection):
+    '''
+    Replaces the keyword 'reduced' in a selection with the labels in the
+    reduced attribute list
+    '''
+    if selection is None:
+        return None
+    resolved = []
+    for label in selection:
+        if label == 'reduced':
+            resolved.extend(_reduced_attr)
+        else:
+            resolved.append(label)
+    return resolved
+
+
+def attribute_source(label, source=None):
+    '''
+    Returns the source ('device', 'cache-device' or 'cache') to read an
+    attribute label from when source is asked for, as allowed by _read_policy.
+    With no source, None (the proxy's own setting) is returned.
+    '''
+    if source is None:
+        return None
+    policy = _read_policy.get(label, source)
+    # The fresher of the two
+    return _read_source_order[min(_read_source_order.index(source), _read_source_order.index(policy))]
+
+
+def read_source_values(dev_proxy, attributes, source=None, chunk_size=None, deadline=None):
+    '''
+    Reads attributes (see read_attribute_values) with the source of dev_proxy
+    set to source, putting the previous source back afterwards. The proxy is
+    shared (see get_proxy), so other reads of it wait until then.
+    '''
+    with source_lock(dev_proxy):
+        if source is None or DevSource is None:
+            return read_attribute_values(dev_proxy, attributes, chunk_size=chunk_size, deadline=deadline)
+        old_source = dev_proxy.get_source()
+        dev_proxy.set_source(getattr(DevSource, _read_sources[source]))
+        try:
+            return read_attribute_values(dev_proxy, attributes, chunk_size=chunk_size, deadline=deadline)
+        finally:
+            dev_proxy.set_source(old_source)
+
+
+def read_parameters(oms_dp, zmx_dp, chunk_size=None, selection=None, deadline=None, source=None):
+    '''
+    Returns a dictionary containing the values of all the attributes, or only
+    of those matched by selection (see select_attributes). Raises
+    MotorBudgetExceeded if the deadline passes (see read_attribute_values).
+    If source is given, attributes are read from it where _read_policy allows
+    (see attribute_source).
+    '''
+    motor_params = motorSnapshot.MotorSnapshot(_attribute_index)
+
+    for prefix, dev_proxy in {'oms': oms_dp, 'zmx': zmx_dp}.items():
+        with budget_timeout(dev_proxy, deadline):
+            attributes = select_attributes(prefix, dev_proxy, selection)
+        if not attributes:
+            continue
+        by_source = {}
+        for attrib in attributes:
+            by_source.setdefault(attribute_source('{}:{}'.format(prefix, attrib), source), []).append(attrib)
+        for attrib_source, source_attributes in by_source.items():
+            values = read_source_values(dev_proxy, source_attributes, attrib_source, chunk_size=chunk_size,
+                                        deadline=deadline)
+            for attrib, value in zip(source_attributes, values):
+                motor_params.set_slot(_attribute_index.pair_slot(prefix, attrib), value)
 
     return motor_params
 
 
-def write_parameters(oms_dp, zmx_dp, attribs_to_write, reduced_params_list=_reduced_attr, retry=False, raise_errors=False, written_attribs=None):
-    # TODO Retry a single attribute rather than everything. Will allow multiple retries.
-    def do_undo_write(ex_thrown, oms_dp, zmx_dp, attribs_to_write, old_attribs, undo=False):
+def is_nan(value):
+    return isinstance(value, float) and math.isnan(value)
+
+
+def coerce_value(value, current_value, attr_type=None):
+    '''
+    Converts a value read from file to the type of the attribute (attr_type
+    from the schema cache, if known, otherwise the type of its current
+    value), where this can be done without losing information. A current
+    value of nan (it couldn't be read) says nothing about the type.
+    '''
+    if attr_type is not None:
+        return attributeSchema.coerce_to_type(value, attr_type)
+    if isinstance(value, bool) or isinstance(current_value, bool) or is_nan(current_value):
+        return value
+    if isinstance(current_value, float) and isinstance(value, int):
+        return float(value)
+    if isinstance(current_value, int) and isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+class RetryPolicy(object):
+    '''
+    Decides how often a failing Tango call is retried. Between attempts we
+    wait for an exponentially increasing time (with some random jitter). If a
+    deadline is given, no retry is started which would end after it.
+    '''
+
+    def __init__(self, attempts=3, backoff=0.1, max_backoff=5.0, jitter=0.2, deadline=None):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.deadline = deadline
+
+    def deadline_from_now(self):
+        '''
+        Returns the time (as given by time.monotonic) at which retrying stops
+        '''
+        if self.deadline is None:
+            return None
+        return time.monotonic() + self.deadline
+
+    def delay(self, attempt):
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def run(self, func, *args, deadline=None):
+        '''
+        Calls func(*args), retrying if it raises. The last error is raised if
+        all attempts fail or the deadline is reached.
+        '''
+        for attempt in range(self.attempts):
+            try:
+                return func(*args)
+            except Exception as ex:
+                if attempt + 1 >= self.attempts:
+                    raise
+                delay = self.delay(attempt)
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise
+                print('WARNING: {} (attempt {} of {}). Retrying...'.format(str(ex).strip(), attempt + 1, self.attempts))
+                time.sleep(delay)
+
+
+class AdaptiveLimiter(object):
+    '''
+    Limits how many motors of one device server are read or written at
+    once, AIMD style. While calls finish no slower than tolerance times the
+    baseline latency (the fastest of the last window calls), the limit grows
+    by about one for every limit calls. When a call fails or is slower, the
+    limit is multiplied by decrease (at most once per limit calls, since the
+    calls already running were started under the old limit).
+    '''
+
+    def __init__(self, maximum=16, minimum=1, initial=1, tolerance=1.5, decrease=0.5, window=50):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(max(min(initial, maximum), minimum))
+        self.tolerance = tolerance
+        self.decrease = decrease
+        self.baseline = None
+        self._recent = deque(maxlen=window)
+        self.in_flight = 0
+        self.peak = int(self.limit)
+        self._since_decrease = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, failed=False):
+        with self._condition:
+            self.in_flight -= 1
+            self._since_decrease += 1
+            if not failed:
+                # A window rather than the fastest call ever, so the baseline
+                # can rise again after one unusually fast call
+                self._recent.append(latency)
+                self.baseline = min(self._recent)
+            congested = failed or latency > self.baseline * self.tolerance
+
+            if congested:
+                if self._since_decrease >= int(self.limit):
+                    self.limit = max(self.limit * self.decrease, self.minimum)
+                    self._since_decrease = 0
+            else:
+                self.limit = min(self.limit + 1.0 / int(self.limit), self.maximum)
+                self.peak = max(self.peak, int(self.limit))
+            self._condition.notify_all()
+
+    def run(self, func, *args, gate=None):
+        '''
+        Calls func(*args) once there is room, timing it. If gate (e.g. a
+        semaphore) is given, it is held during the call but only acquired
+        once there is room, and the wait for it isn't timed.
+        '''
+        self.acquire()
+        if gate is not None:
+            gate.acquire()
+        start = time.monotonic()
+        failed = True
+        try:
+            result = func(*args)
+            failed = False
+            return result
+        finally:
+            if gate is not None:
+                gate.release()
+            self.release(time.monotonic() - start, failed)
+
+
+def server_limiter(config, motor, operation='read'):
+    '''
+    Returns the AdaptiveLimiter for operation ('read' or 'write') on the
+    device server of a motor (e.g. EH1A.01 is on server EH1A), or None if
+    config['adaptive'] is not set. config['adaptive'] is the most motors of a
+    server to use at once. Writes (with the EPROM commit) are much slower
+    than reads, so they have their own limiter.
+    '''
+    if not config.get('adaptive'):
+        return None
+    key = (operation, config['tango_host'], motor.rsplit('.', 1)[0])
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = AdaptiveLimiter(maximum=config['adaptive'])
+        return _limiters[key]
+
+
+def write_parameters(oms_dp, zmx_dp, attribs_to_write, reduced_params_list=_reduced_attr, raise_errors=False, write_eprom=True, retry_policy=None, old_params=None):
+    '''
+    Writes the parameters in attribs_to_write which are in reduced_params_list
+    and commits them to the ZMX EPROM. The old values are read (unless they
+    are given in old_params) and the new values written with one call per
+    device. If that write fails, each
+    attribute is written separately, retrying according to retry_policy. If a
+    write still fails, the error is raised (raise_errors) or the parameters
+    are reverted and we exit.
+    '''
+    def undo_write(ex_thrown, dev_proxy):
         # FIXME This bit doesn't get tested
         if raise_errors:
             # We have been told to push the error up, so do so!
             raise ex_thrown
-        if undo:
-            # This is already the second time... we should abandon this and give up.
-            # We try to undo what we did.
-            print('ERROR: Could not write to {}:\n{}\n\n. Attempting to revert changes...'.format(dev_proxy.name(), str(ex_thrown)))
-            write_parameters(oms_dp, zmx_dp, old_attribs, raise_errors=True)
-            # As things have gone wrong, stop any further execution
-            print('Reverted successfully. Aborting due to previous error.')
-            sys.exit(1)
-        else:
-            # This is the first attempt. We try a second time (in case this was a transient corba error)
-            print('WARNING: An error occurred while writing to {}. Retrying...'.format(dev_proxy.name()))
-            write_parameters(oms_dp, zmx_dp, attribs_to_write, retry=True, written_attribs=written_attribs)
-
+        # We couldn't write even after retrying. Try to undo what we did.
+        print('ERROR: Could not write to {}:\n{}\n\n. Attempting to revert changes...'.format(dev_proxy.name(), str(ex_thrown)))
+        write_parameters(oms_dp, zmx_dp, old_attribs, reduced_params_list=reduced_params_list, raise_errors=True, retry_policy=retry_policy)
+        # As things have gone wrong, stop any further execution
+        print('Reverted successfully. Aborting due to previous error.')
+        sys.exit(1)
+
+    if retry_policy is None:
+        retry_policy = RetryPolicy()
+    deadline = retry_policy.deadline_from_now()
     old_attribs = {}
-    # This ensures that written_attribs is an empty list if the function is
-    # called without arguments a second time. Otherwise test doesn't pass.
-    if not written_attribs:
-        written_attribs = []
-    # Taken from jive. DelayTime value reported cannot be written back
-    # directly. Needs to be mapped.
-    DelayTime_map = {1: 0, 2: 1, 4: 2, 6: 3, 8: 4, 10: 5, 12: 6, 14: 7, 16: 8,
-                     20: 9, 40: 10, 60: 11, 100: 12, 200: 13, 500: 14,
-                     1000: 15}
-    dev_proxy = None
-
-    for attrib in attribs_to_write.keys():
+
+    # Sort the parameters by the device they need to be written to
+    to_write = {'oms': [], 'zmx': []}
+    for attrib, value in attribs_to_write.items():
         # Only write the parameter if it's in the reduced_params_list...
         if attrib not in reduced_params_list:
             continue
 
         attr_class, attr_name = attrib.split(':')
-        # ...and it's previously been written and not called 'Deactivation'
-        if (attr_name in written_attribs) or attr_name == 'Deactivation':
+        # ...and it's not called 'Deactivation'
+        if attr_name == 'Deactivation':
+            continue
+        attr_info = None
+        if _schema_cache is not None:
+            attr_info = _schema_cache.attribute_info(attrib, attributeSchema.proxy_host(oms_dp))
+        if attr_info is not None and not attr_info['writable']:
+            print('WARNING: {} is read only. Not written.'.format(attrib))
             continue
 
-        # Create a device proxy depending whether this is an OMS of ZMX attribute
-        if attr_class == 'oms':
-            dev_proxy = oms_dp
-        elif attr_class == 'zmx':
-            dev_proxy = zmx_dp
-        else:
+        if attr_class not in to_write:
             print('ERROR: Unrecognised device class {}'.format(attr_class))
             raise Exception('Unrecognised device class')  # FIXME Should be a specific error
+        to_write[attr_class].append((attr_name, value))
 
-        # Read and store the initial value of the parameter...
-        old_attribs[attrib] = dev_proxy.read_attribute(attr_name)
-        # ...then write the new value
-        # For DelayTime we have to map from 4-bit or something...
-        if attr_name == 'DelayTime':  # FIXME Add to test!
-            attribs_to_write[attrib] = DelayTime_map[attribs_to_write[attrib]]
+    for attr_class, dev_proxy in (('oms', oms_dp), ('zmx', zmx_dp)):
+        if not to_write[attr_class]:
+            continue
 
+        # Read and store the initial values of the parameters in one go...
+        attr_names = [attr_name for attr_name, _ in to_write[attr_class]]
+        if old_params is None:
+            # Not while another read has changed the source of the proxy
+            old_values = read_source_values(dev_proxy, attr_names)
+        else:
+            old_values = [old_params.get('{}:{}'.format(attr_class, attr_name), math.nan) for attr_name in attr_names]
+        name_values = []
+        for (attr_name, value), old_value in zip(to_write[attr_class], old_values):
+            # For DelayTime we have to map from 4-bit or something...
+            if attr_name == 'DelayTime':  # FIXME Add to test!
+                value = _DelayTime_map[value]
+            else:
+                attr_type = None
+                if _schema_cache is not None:
+                    attr_type = attribute_type('{}:{}'.format(attr_class, attr_name), attributeSchema.proxy_host(dev_proxy))
+                value = coerce_value(value, old_value, attr_type)
+            name_values.append((attr_name, value))
+            if not is_nan(old_value):
+                old_attribs['{}:{}'.format(attr_class, attr_name)] = old_value
+
+        # ...then write all the new values in one go.
         try:
-            dev_proxy.write_attribute(attr_name, attribs_to_write[attrib])
-            written_attribs.append(attr_name)
-        except Exception as ex:
-            do_undo_write(ex, oms_dp, zmx_dp, attribs_to_write, old_attribs, undo=retry)
+            dev_proxy.write_attributes(name_values)
+        except Exception:
+            # Write them one at a time (with retries) to find which failed
+            print('WARNING: Writing attributes to {} failed. Writing individually...'.format(dev_proxy.name()))
+            for attr_name, value in name_values:
+                try:
+                    retry_policy.run(dev_proxy.write_attribute, attr_name, value, deadline=deadline)
+                except Exception as ex:
+                    undo_write(ex, dev_proxy)
 
-    eprom_write = zmx_dp.WriteEPROM()
+    if not write_eprom:
+        return
+
+    try:
+        eprom_write = retry_policy.run(zmx_dp.WriteEPROM, deadline=deadline)
+    except Exception:
+        eprom_write = None
     if eprom_write != 1:
         print('ERROR: Failed writing EPROM for {}. Aborting'.format(zmx_dp.name()))
-        if raise_errors:
-            raise Exception('Writing to EPROM failed')  # FIXME Should be a specific error
         # EPROM write failed, we'll try to undo the write
-        do_undo_write(Exception('Writing to EPROM failed'), oms_dp, zmx_dp, attribs_to_write, old_attribs, undo=True)
+        undo_write(Exception('Writing to EPROM failed'), zmx_dp)  # FIXME Should be a specific error
+
+
+def values_equal(value_a, value_b, rel_tol=1e-9, abs_tol=0.0):
+    '''
+    Compares two parameter values. Numbers are compared within a tolerance
+    and two nans are considered equal.
+    '''
+    if isinstance(value_a, str) or isinstance(value_b, str):
+        return value_a == value_b
+    try:
+        if math.isnan(value_a) and math.isnan(value_b):
+            return True
+        return math.isclose(value_a, value_b, rel_tol=rel_tol, abs_tol=abs_tol)
+    except TypeError:
+        return value_a == value_b
+
+
+def parameter_delta(current_params, new_params, rel_tol=1e-9, abs_tol=0.0):
+    '''
+    Returns the entries of new_params which differ from (or are missing in)
+    current_params. Both are in the units reported by the devices, i.e.
+    DelayTime has not yet been mapped.
+    '''
+    delta = {}
+    for label, new_value in new_params.items():
+        if label not in current_params or not values_equal(current_params[label], new_value, rel_tol, abs_tol):
+            delta[label] = new_value
+    return delta
+
+
+def writable_parameters(attribs_to_write, reduced_params_list=_reduced_attr):
+    '''
+    Returns the entries of attribs_to_write which write_parameters would
+    actually write
+    '''
+    return {attrib: value for attrib, value in attribs_to_write.items()
+            if attrib in reduced_params_list and attrib.split(':')[1] != 'Deactivation'}
+
+
+def attribute_tolerance(attrib, tolerances=None, rel_tol=1e-9, abs_tol=0.0):
+    '''
+    Returns the (rel_tol, abs_tol) to use for attrib. tolerances maps labels
+    or glob patterns to dictionaries with 'rel' and/or 'abs' keys; an exact
+    label is preferred over a pattern.
+    '''
+    if tolerances:
+        if attrib in tolerances:
+            tolerance = tolerances[attrib]
+        else:
+            tolerance = next((tol for pattern, tol in tolerances.items() if fnmatch.fnmatchcase(attrib, pattern)), {})
+        rel_tol = tolerance.get('rel', rel_tol)
+        abs_tol = tolerance.get('abs', abs_tol)
+    return rel_tol, abs_tol
+
+
+def compare_parameters(input_all_params, current_all_params, tolerances=None, rel_tol=1e-9, abs_tol=0.0):
+    '''
+    Compares every parameter recorded in input_all_params with the same
+    parameter in current_all_params. The values are lined up into one column
+    per attribute (across all motors) and each column is compared in one go,
+    with the tolerance for that attribute (see attribute_tolerance). Two nans
+    are equal. Returns a list of the differences and a summary dictionary.
+    '''
+    missing = object()
+    motors = sorted(input_all_params)
+    attributes = sorted(set(itertools.chain.from_iterable(input_all_params[motor] for motor in motors)))
+
+    diffs = []
+    n_compared = 0
+    for attrib in attributes:
+        attr_rel_tol, attr_abs_tol = attribute_tolerance(attrib, tolerances, rel_tol, abs_tol)
+        input_column = [input_all_params[motor].get(attrib, missing) for motor in motors]
+        current_column = [current_all_params.get(motor, {}).get(attrib, missing) for motor in motors]
+        equal_column = [input_value is missing or (current_value is not missing and values_equal(input_value, current_value, attr_rel_tol, attr_abs_tol))
+                        for input_value, current_value in zip(input_column, current_column)]
+        n_compared += sum(input_value is not missing for input_value in input_column)
+
+        for motor, input_value, current_value, equal in zip(motors, input_column, current_column, equal_column):
+            if equal:
+                continue
+            if current_value is missing:
+                status = 'missing'
+            elif is_nan(input_value) or is_nan(current_value):
+                # One of them couldn't be read
+                status = 'nan'
+            else:
+                status = 'different'
+            diff = {'motor': motor, 'parameter': attrib, 'input': input_value,
+                    'current': None if current_value is missing else current_value, 'status': status}
+            try:
+                diff['difference'] = current_value - input_value
+            except TypeError:
+                diff['difference'] = None
+            diffs.append(diff)
+
+    diffs.sort(key=lambda diff: (diff['motor'], diff['parameter']))
+    different_motors = sorted({diff['motor'] for diff in diffs})
+    summary = {'motors': len(motors), 'parameters': n_compared, 'differences': len(diffs),
+               'different_motors': different_motors,
+               'same_motors': [motor for motor in motors if motor not in different_motors]}
+    return diffs, summary
+
+
+def write_diff_json(diffs, summary, filename):
+    '''
+    Writes the differences (see compare_parameters) as JSON. nan isn't valid
+    JSON, so is written as null (the status of the difference says why).
+    '''
+    diffs = [{key: None if is_nan(value) else value for key, value in diff.items()} for diff in diffs]
+    with open(filename, 'w') as out_file:
+        json.dump({'summary': summary, 'differences': diffs}, out_file, indent=1, allow_nan=False)
+
+
+def write_diff_csv(diffs, filename):
+    with open(filename, 'w', newline='') as out_file:
+        writer = csv.DictWriter(out_file, ['motor', 'parameter', 'input', 'current', 'difference', 'status'])
+        writer.writeheader()
+        writer.writerows(diffs)
 
 
 def file_reader(filename):
@@ -225,148 +1082,1109 @@ def file_writer(input_lines, filename):
         out_file.flush()
 
 
-def read_dat(filename):
-    def string_to_numeric(string):
+_int_pattern = re.compile(r'[-+]?[0-9]+$')
+_float_pattern = re.compile(r'[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?$')
+
+
+def string_to_numeric(string):
+    '''
+    Converts a value from a .params file to an int or float. Plain numbers are
+    recognised by pattern; anything else is left to int()/float(), which raise
+    ValueError if it isn't a number at all.
+    '''
+    if _int_pattern.match(string):
+        return int(string)
+    if _float_pattern.match(string):
+        return float(string)
+    if string == 'nan':
+        return math.nan
+    try:
+        return int(string)
+    except ValueError:
+        # Maybe it wasn't an int. Try a float.
+        # If we error this time, it gets raised
+        return float(string)
+
+
+def parse_dat_line(line, keep_nan=False):
+    '''
+    Splits a line of a .params file into the device name and a dictionary of
+    its parameters. NaN values are left out, as they can't be written back,
+    unless keep_nan (e.g. to compare them).
+    '''
+    line = line.rstrip().rstrip(',').split(',')
+    assert len(line) % 2 != 0  # There should be n k,v pairs + the device name (odd number of entries in list)
+
+    attribs = {}
+    values = iter(line[1:])
+    for attrib, value in zip(values, values):
+        if attrib == 'zmx:AxisName':
+            # AxisName is a string. Don't try to conver to number
+            attribs[attrib] = value
+            continue
+
         try:
-            if string == 'nan':
-                return math.nan
-            return int(string)
+            attr_type = attribute_type(attrib)
+            if attr_type is None:
+                attrib_val = string_to_numeric(value)
+            else:
+                # The schema cache knows exactly what the type should be
+                attrib_val = attributeSchema.parse_value(value, attr_type)
         except ValueError:
-            # Maybe it wasn't an int. Try a string.
-            # If we error this time, it gets raised
-            return float(string)
+            print('Motor{} ({}): String {} cannot be converted to int or float. Aborting!'.format(line[0], attrib, value))
+            sys.exit(1)
 
-    in_lines = file_reader(filename)
+        if is_nan(attrib_val) and not keep_nan:
+            # We don't want to try writing NaNs...
+            continue
+        attribs[attrib] = attrib_val
 
-    all_params = {}
-    for line in in_lines:
-        line = line.rstrip().rstrip(',').split(',')
-        assert len(line) % 2 != 0  # There should be n k,v pairs + the device name (odd number of entries in list)
+    return line[0], attribs
 
-        attribs = {}
-        attrib_list = line[1:]
-        for i in range(int(len(attrib_list) / 2)):
 
-            if attrib_list[2*i] == 'zmx:AxisName':
-                # AxisName is a string. Don't try to conver to number
-                attribs[attrib_list[i*2]] = attrib_list[2*i+1]
-            else:
-                attrib_val = None
-                try:
-                    attrib_val = string_to_numeric(attrib_list[2*i+1])
-                except ValueError:
-                    print('Motor{} ({}): String {} cannot be converted to int or float. Aborting!'.format(line[0], attrib_list[i*2], attrib_list[2*i+1]))
-                    sys.exit(1)
-
-                if attrib_val == math.nan:
-                    # We don't want to try writing NaNs...
-                    continue
-                attribs[attrib_list[i*2]] = attrib_val
+def read_dat(filename, lazy=False, keep_nan=False):
+    '''
+    Reads a .params file, returning the parameters of each motor (as a
+    FleetSnapshot). If lazy, a ParamsFile is returned instead, which only
+    parses the line for a motor when it is asked for. NaN values are kept
+    only if keep_nan (see parse_dat_line).
+    '''
+    if lazy:
+        return ParamsFile(filename)
 
-        all_params[line[0]] = attribs
+    all_params = motorSnapshot.FleetSnapshot(_attribute_index)
+    for line in file_reader(filename):
+        device, attribs = parse_dat_line(line, keep_nan=keep_nan)
+        all_params[device] = attribs
 
     return all_params
 
 
-def write_dat(all_params, reduced_params_list=_reduced_attr):
+def index_dat(filename):
+    '''
+    Returns a dictionary of the byte offset of the line for each motor in a
+    .params file. Only the device names are looked at, so this is much quicker
+    than parsing the whole file. As with read_dat, if a motor appears more
+    than once, the last line wins.
+    '''
+    index = {}
+    offset = 0
+    with open(filename, 'rb') as in_file:
+        for line in in_file:
+            index[line.split(b',', 1)[0].rstrip().decode()] = offset
+            offset += len(line)
+    return index
+
+
+def read_dat_motor(filename, motor, index=None):
+    '''
+    Returns the parameters of one motor from a .params file, using (or
+    building) an index from index_dat to go straight to its line
+    '''
+    if index is None:
+        index = index_dat(filename)
+    with open(filename, 'rb') as in_file:
+        in_file.seek(index[motor])
+        return parse_dat_line(in_file.readline().decode())[1]
+
+
+class ParamsFile(Mapping):
+    '''
+    Read-only dictionary of the parameters of the motors in a .params file.
+    The file is indexed on creation, but a motor's line is only parsed the
+    first time it is needed.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index = index_dat(filename)
+        self._parsed = {}
+
+    def __getitem__(self, motor):
+        if motor not in self._parsed:
+            if motor not in self.index:
+                raise KeyError(motor)
+            self._parsed[motor] = read_dat_motor(self.filename, motor, self.index)
+        return self._parsed[motor]
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def sorted_items(params):
+    '''
+    Returns the items of params sorted by key. Snapshots (see motorSnapshot)
+    are already in order.
+    '''
+    if isinstance(params, (motorSnapshot.MotorSnapshot, motorSnapshot.FleetSnapshot)):
+        return params.items()
+    return sorted(params.items())
+
+
+def format_motor_lines(device, attributes, reduced_params_list=_reduced_attr):
+    '''
+    Returns the lines for a motor in the full and reduced .params files
+    '''
     def merge_line_list(line):
         joined_line = ','.join(line)
         return joined_line+'\n'
 
+    line_full = [device]
+    line_red = [device]
+    for attr, value in sorted_items(attributes):
+        line_full.append('{},{}'.format(attr, value))
+        if attr in reduced_params_list:
+            line_red.append('{},{}'.format(attr, value))
+
+    return merge_line_list(line_full), merge_line_list(line_red)
+
+
+def snapshot_filenames(now=None, counter=1):
+    '''
+    Returns the names of the full and reduced .params files for a snapshot
+    taken at now. A counter above 1 is added to the time (e.g. for a second
+    snapshot in the same second).
+    '''
+    if now is None:
+        now = datetime.today()
+
+    stamp = '{0:04d}{1:02d}{2:02d}_{3:02d}{4:02d}{5:02d}'.format(now.year, now.month, now.day, now.hour, now.minute, now.second)
+    if counter > 1:
+        stamp += '-{}'.format(counter)
+    params_filename = 'motors-{}.params'.format(stamp)
+    reduced_params_filename = 'motors-{}_reduced.params'.format(stamp)
+    return params_filename, reduced_params_filename
+
+
+def write_motor_status(motor_status, filename):
+    '''
+    Writes a line 'motor,status,reason' for each motor which was not read
+    '''
+    file_writer(['{},{},{}\n'.format(motor, status, ' '.join(reason.split()))
+                 for motor, (status, reason) in sorted(motor_status.items())], filename)
+
+
+def read_motor_status(filename):
+    '''
+    Reads a file written by write_motor_status. Returns {motor: (status, reason)}.
+    '''
+    motor_status = {}
+    for line in file_reader(filename):
+        motor, status, reason = line.rstrip('\n').split(',', 2)
+        motor_status[motor] = (status, reason)
+    return motor_status
+
+
+def write_dat(all_params, reduced_params_list=_reduced_attr):
     out_lines_full = []
     out_lines_red = []
-    for device, attributes in sorted(all_params.items()):
-        line_full = [device]
-        line_red = [device]
-        for attr, value in sorted(attributes.items()):
-            line_full.append('{},{}'.format(attr, value))
-            if attr in reduced_params_list:
-                line_red.append('{},{}'.format(attr, value))
+    for device, attributes in sorted_items(all_params):
+        line_full, line_red = format_motor_lines(device, attributes, reduced_params_list)
+        out_lines_full.append(line_full)
+        out_lines_red.append(line_red)
 
-        out_lines_full.append(merge_line_list(line_full))
-        out_lines_red.append(merge_line_list(line_red))
+    params_filename, reduced_params_filename = snapshot_filenames()
+    file_writer(out_lines_full, params_filename)
+    file_writer(out_lines_red, reduced_params_filename)
 
-    now = datetime.today()
 
-    params_filename = 'motors-{0:04d}{1:02d}{2:02d}_{3:02d}{4:02d}{5:02d}.params'.format(now.year, now.month, now.day, now.hour, now.minute, now.second)
-    file_writer(out_lines_full, params_filename)
+class SnapshotWriter(object):
+    '''
+    Writes the full and reduced .params files one motor at a time, so nothing
+    which has been read is lost if the run dies. Lines are appended to
+    '<filename>.part' files, which are renamed to their final names by
+    close(). If resume is True, existing .part files are kept and the motors
+    in them can be skipped (see done_motors).
+    '''
+    part_suffix = '.part'
+
+    def __init__(self, params_filename, reduced_params_filename, reduced_params_list=_reduced_attr, resume=False):
+        self.filenames = [params_filename, reduced_params_filename]
+        self.status_filename = params_filename[:-len('.params')] + '.status'
+        self.reduced_params_list = reduced_params_list
+        self.done_motors = set()
+        self.motor_status = {}
+        self.lock = threading.Lock()
+
+        part_filenames = [filename + self.part_suffix for filename in self.filenames]
+        if resume and all(os.path.exists(filename) for filename in part_filenames):
+            self.done_motors = self._recover_parts(part_filenames)
+            mode = 'a'
+        else:
+            mode = 'w'
+        self.out_files = [open(filename, mode) for filename in part_filenames]
+
+    @classmethod
+    def resume(cls, part_filename, reduced_params_list=_reduced_attr):
+        '''
+        Returns a SnapshotWriter continuing from the partial full .params file
+        part_filename
+        '''
+        params_filename = part_filename
+        if params_filename.endswith(cls.part_suffix):
+            params_filename = params_filename[:-len(cls.part_suffix)]
+        reduced_params_filename = params_filename[:-len('.params')] + '_reduced.params'
+        return cls(params_filename, reduced_params_filename, reduced_params_list, resume=True)
+
+    @staticmethod
+    def _recover_parts(part_filenames):
+        # Only motors with a complete line in both files count as done
+        motors_per_file = []
+        for filename in part_filenames:
+            with open(filename, 'r') as part_file:
+                motors_per_file.append({line.split(',', 1)[0] for line in part_file if line.endswith('\n')})
+        done_motors = set.intersection(*motors_per_file)
+
+        # Throw away anything else (e.g. a half written line)
+        for filename in part_filenames:
+            with open(filename, 'r') as part_file, open(filename + '.tmp', 'w') as tmp_file:
+                for line in part_file:
+                    if line.endswith('\n') and line.split(',', 1)[0] in done_motors:
+                        tmp_file.write(line)
+            os.replace(filename + '.tmp', filename)
+        return done_motors
+
+    def write_motor(self, device, attributes):
+        self.write_motor_lines(device, format_motor_lines(device, attributes, self.reduced_params_list))
+
+    def write_motor_lines(self, device, lines):
+        '''
+        Writes the (already formatted) full and reduced lines of a motor
+        '''
+        with self.lock:
+            for out_file, line in zip(self.out_files, lines):
+                out_file.write(line)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+            self.done_motors.add(device)
+
+    def mark_motor(self, device, status, reason):
+        '''
+        Records that a motor is not in the snapshot, and why
+        '''
+        with self.lock:
+            self.motor_status[device] = (status, reason)
+
+    def close(self, complete=True):
+        '''
+        Closes the files. If complete, they are moved to their final names,
+        and the status of any motors missing from them is saved.
+        '''
+        for out_file in self.out_files:
+            out_file.close()
+        if complete:
+            for filename in self.filenames:
+                os.replace(filename + self.part_suffix, filename)
+            if self.motor_status:
+                write_motor_status(self.motor_status, self.status_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Leave the .part files in place after an error, so we can resume
+        self.close(complete=exc_type is None)
+
+
+def read_motor(config, motor):
+    '''
+    Creates the Tango servers for one motor and reads its parameters
+    '''
+    host_semaphore = config.get('host_semaphore')
+    limiter = server_limiter(config, motor)
+    if limiter is not None:
+        # Wait for the server's limiter before taking a slot on the host, so
+        # motors waiting for a busy server don't hold up the other servers
+        return limiter.run(read_motor, dict(config, adaptive=None, host_semaphore=None), motor, gate=host_semaphore)
+    if host_semaphore is not None:
+        # Don't read more motors at a time than the Tango host should see
+        with host_semaphore:
+            return read_motor(dict(config, host_semaphore=None), motor)
+
+    start = time.perf_counter()
+    deadline = None
+    if config.get('motor_budget'):
+        deadline = time.monotonic() + config['motor_budget']
+    oms_dp, zmx_dp = get_motor_proxies(config, motor)
+    print('Reading parameters for motor {}...'.format(motor))
+    motor_params = read_parameters(oms_dp, zmx_dp, chunk_size=config.get('chunk_size'),
+                                   selection=config.get('selection'), deadline=deadline,
+                                   source=config.get('read_source'))
+    if _metrics is not None:
+        # Total for the motor, including any waits between calls
+        _metrics.record('motor', 'read_motor', '', time.perf_counter() - start)
+    print('{}: DONE'.format(motor))
+    return motor_params
 
-    reduced_params_filename = 'motors-{0:04d}{1:02d}{2:02d}_{3:02d}{4:02d}{5:02d}_reduced.params'.format(now.year, now.month, now.day, now.hour, now.minute, now.second)
-    file_writer(out_lines_red, reduced_params_filename)
 
+def read_motors(config, dev_names, snapshot_writer=None):  # FIXME: Should have separate test?
+    '''
+    Reads the parameters of every motor in dev_names. If config['jobs'] is
+    greater than 1, that many motors are read at the same time. Motors which
+    cannot be read are reported and left out of the returned dictionary,
+    rather than stopping the whole run.
+
+    If a snapshot_writer is given, each motor is written to it as soon as it
+    has been read (in dev_names order) instead of being returned. Motors
+    already written to it are skipped. Motors which were skipped or failed
+    are recorded in its status file.
+
+    With config['adaptive'], up to that many motors are started at once and
+    the AdaptiveLimiter of the device server decides how many really run.
+
+    If config['probe'] is set, the devices are pinged first and unreachable
+    motors skipped. A motor whose read takes more than config['motor_budget']
+    seconds is also skipped.
+    '''
+    unreachable = {}
+
+    def try_read_motor(motor):
+        if motor in unreachable:
+            return 'skipped', unreachable[motor]
+        try:
+            return 'read', read_motor(config, motor)
+        except MotorBudgetExceeded as ex:
+            print('WARNING: Skipping motor {}: {}'.format(motor, str(ex)))
+            return 'skipped', str(ex)
+        except Exception as ex:
+            print('ERROR: Could not read parameters for motor {}:\n{}'.format(motor, str(ex)))
+            # The proxies may be dead. Make sure they're recreated next time.
+            evict_motor_proxies(config, motor)
+            return 'failed', str(ex)
 
-def read_motors(config, dev_names):  # FIXME: Should have separate test?
+    jobs = max(config.get('jobs') or 1, config.get('adaptive') or 1)
     # For each motor in the list, make Tango servers and query them for information
-    all_motor_params = {}
+    all_motor_params = motorSnapshot.FleetSnapshot(_attribute_index)
     for server in sorted(dev_names.keys()):
-        for motor in dev_names[server]:
-            oms_dp = DeviceProxy('{}/{}/motor/{}'.format(config['tango_host'], config['beamline'], motor))
-            zmx_dp = DeviceProxy('{}/{}/ZMX/{}'.format(config['tango_host'], config['beamline'], motor))
-            print('Reading parameters for motor {}...'.format(motor))
-            all_motor_params[motor] = read_parameters(oms_dp, zmx_dp)
-            print('{}: DONE'.format(motor))
-        print('\nSuccessfully read configurations for motors:\n{}'.format(', '.join(dev_names[server])))
+        motors = dev_names[server]
+        if snapshot_writer is not None:
+            skipped = [motor for motor in motors if motor in snapshot_writer.done_motors]
+            if skipped:
+                print('Skipping motors already read:\n{}'.format(', '.join(skipped)))
+            motors = [motor for motor in motors if motor not in skipped]
+
+        unreachable.clear()
+        if config.get('probe'):
+            unreachable.update(probe_motors(config, motors))
+            for motor, reason in sorted(unreachable.items()):
+                print('WARNING: Skipping motor {}: {}'.format(motor, reason))
+
+        failed_motors = []
+        skipped_motors = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            if jobs > 1:
+                # map returns results in the same order as motors
+                results = executor.map(try_read_motor, motors)
+            else:
+                results = map(try_read_motor, motors)
+
+            for motor, (status, result) in zip(motors, results):
+                if status != 'read':
+                    (skipped_motors if status == 'skipped' else failed_motors).append(motor)
+                    if snapshot_writer is not None:
+                        snapshot_writer.mark_motor(motor, status, result)
+                elif snapshot_writer is not None:
+                    snapshot_writer.write_motor(motor, result)
+                else:
+                    all_motor_params[motor] = result
+
+        read_ok = [motor for motor in motors if motor not in failed_motors and motor not in skipped_motors]
+        print('\nSuccessfully read configurations for motors:\n{}'.format(', '.join(read_ok)))
+        if skipped_motors:
+            print('WARNING: Skipped unreachable or slow motors:\n{}'.format(', '.join(skipped_motors)))
+        if failed_motors:
+            print('ERROR: Failed to read configurations for motors:\n{}'.format(', '.join(failed_motors)))
+        if config.get('adaptive') and motors:
+            limiter = server_limiter(config, motors[0])
+            print('INFO: Up to {} motors of {} were read at once (limit now {})'.format(
+                limiter.peak, server, int(limiter.limit)))
 
     return all_motor_params
 
 
-def main():
-    # Find out what we're supposed to be doing...
-    config = parse_args(sys.argv[1:])
-    # ...and set up the reduced set of parameters we're interested in.
-    make_reduced_attribs()
+def sweep_targets(config):
+    '''
+    Returns a config for each (tango_host, beamline, server) combination to
+    be read. config['server'] may be a comma separated list of servers or
+    'all'. config['tango_host'] may be a comma separated list of hosts, each
+    optionally with its own beamline (e.g. 'haspp02oh1:10000/p02').
+    '''
+    targets = []
+    for host in config['tango_host'].split(','):
+        tango_host, _, beamline = host.partition('/')
+        beamline = beamline or config['beamline']
+        if config['server'] == 'all':
+            discovered = discovered_servers(dict(config, tango_host=tango_host, beamline=beamline))
+            servers = sorted(discovered if discovered is not None else _servers)
+        else:
+            servers = config['server'].split(',')
+        for server in servers:
+            target = dict(config)
+            target.update({'tango_host': tango_host, 'beamline': beamline, 'server': server})
+            targets.append(target)
+    return targets
+
+
+def read_sweep(targets):
+    '''
+    Reads all the motors of several servers (possibly on several Tango hosts)
+    at once and merges them into one snapshot. On each Tango host at most
+    'host_jobs' motors are read at the same time. If more than one
+    host/beamline is read, motor names are prefixed with them.
+    '''
+    host_semaphores = {}
+    for target in targets:
+        if target['tango_host'] not in host_semaphores:
+            host_jobs = target.get('host_jobs') or target.get('jobs') or 1
+            host_semaphores[target['tango_host']] = threading.BoundedSemaphore(host_jobs)
+    locations = {(target['tango_host'], target['beamline']) for target in targets}
+
+    def read_target(target):
+        target_config = dict(target)
+        target_config['host_semaphore'] = host_semaphores[target['tango_host']]
+        target_config['jobs'] = target.get('host_jobs') or target.get('jobs') or 1
+        start = time.monotonic()
+        all_motor_params = read_motors(target_config, device_names(target))
+        return all_motor_params, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=max(len(targets), 1)) as executor:
+        results = list(executor.map(read_target, targets))
+
+    merged_params = motorSnapshot.FleetSnapshot(_attribute_index)
+    print('\nSweep timings:')
+    for target, (all_motor_params, elapsed) in zip(targets, results):
+        print('{} ({}/{}): {} motors in {:.1f}s'.format(target['server'], target['tango_host'], target['beamline'],
+                                                        len(all_motor_params), elapsed))
+        for motor, motor_params in all_motor_params.items():
+            if len(locations) > 1:
+                motor = '{}/{}/{}'.format(target['tango_host'], target['beamline'], motor)
+            merged_params[motor] = motor_params
+    return merged_params
+
+
+def write_motor(config, motor, motor_params):
+    '''
+    Writes the parameters of one motor as a single transaction: the old values
+    are saved, the new values written and committed to EPROM. If anything goes
+    wrong the old values are written back. Returns one of 'committed',
+    'unchanged', 'rolled back' or 'failed'.
+    '''
+    motor_locks = config.get('motor_locks')
+    if motor_locks is not None:
+        # Someone else may be writing to the same motor (see motorDaemon)
+        with motor_locks.lock_for(oms_device_name(config, motor)):
+            return write_motor(dict(config, motor_locks=None), motor, motor_params)
+    limiter = server_limiter(config, motor, 'write')
+    if limiter is not None:
+        return limiter.run(write_motor, dict(config, adaptive=None), motor, motor_params)
+
+    oms_dp, zmx_dp = get_motor_proxies(config, motor)
+    retry_policy = RetryPolicy(attempts=config.get('retries') or 3, deadline=config.get('write_deadline'))
+    print('Writing config to motor {}'.format(motor))
+
+    to_write = writable_parameters(motor_params, _reduced_attr)
+    old_params = read_parameters(oms_dp, zmx_dp, selection=sorted(to_write))
+    write_eprom = True
+    if config.get('only_changed'):
+        to_write = parameter_delta(old_params, to_write)
+        if not to_write:
+            print('{}: UNCHANGED'.format(motor))
+            return 'unchanged'
+        write_eprom = any(attrib.startswith('zmx:') for attrib in to_write)
+    if not to_write:
+        print('{}: NOTHING TO WRITE'.format(motor))
+        return 'unchanged'
+
+    journal = config.get('journal')
+    if journal is not None:
+        # Recorded before anything is written, so the old values are never lost
+        journal.begin(motor, old_params, to_write, write_eprom)
+
+    try:
+        write_parameters(oms_dp, zmx_dp, to_write, reduced_params_list=_reduced_attr, raise_errors=True,
+                         write_eprom=write_eprom, retry_policy=retry_policy, old_params=old_params)
+    except Exception as ex:
+        print('ERROR: Could not write to motor {}:\n{}\nAttempting to revert changes...'.format(motor, str(ex)))
+        # Values we could not read before can't be restored
+        restore = {attrib: value for attrib, value in old_params.items() if not is_nan(value)}
+        try:
+            write_parameters(oms_dp, zmx_dp, restore, reduced_params_list=_reduced_attr, raise_errors=True,
+                             retry_policy=retry_policy, old_params=old_params)
+        except Exception as undo_ex:
+            print('ERROR: Could not revert changes to motor {}:\n{}'.format(motor, str(undo_ex)))
+            evict_motor_proxies(config, motor)
+            return 'failed'
+        print('{}: REVERTED'.format(motor))
+        return 'rolled back'
+
+    print('{}: DONE'.format(motor))
+    return 'committed'
+
+
+def write_motors(config, all_motor_params):
+    '''
+    Writes the parameters for each motor in all_motor_params, config['jobs']
+    motors at a time (or as many as the AdaptiveLimiter allows, with
+    config['adaptive']). A failure only rolls back the motor concerned; the
+    others carry on. Returns a dictionary of motor names for each outcome.
+    If config['journal'] is a WriteJournal, each write and its outcome are
+    recorded in it.
+    '''
+    journal = config.get('journal')
+
+    def try_write_motor(motor):
+        try:
+            outcome = write_motor(config, motor, all_motor_params[motor])
+        except Exception as ex:
+            print('ERROR: Could not write to motor {}:\n{}'.format(motor, str(ex)))
+            evict_motor_proxies(config, motor)
+            outcome = 'failed'
+        if journal is not None:
+            journal.end(motor, outcome)
+        return outcome
+
+    motors = sorted(all_motor_params.keys())
+    jobs = max(config.get('jobs') or 1, config.get('adaptive') or 1)
+    if jobs > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            outcomes = list(executor.map(try_write_motor, motors))
+    else:
+        outcomes = [try_write_motor(motor) for motor in motors]
+
+    summary = {'committed': [], 'unchanged': [], 'rolled back': [], 'failed': []}
+    for motor, outcome in zip(motors, outcomes):
+        summary[outcome].append(motor)
+
+    print('\nWrite summary:')
+    for outcome, outcome_motors in summary.items():
+        print('{:>12}: {}'.format(outcome, ', '.join(outcome_motors) if outcome_motors else '-'))
+    return summary
+
+
+class WriteJournal(object):
+    '''
+    Write-ahead journal of a --write run: one JSON object per line, flushed
+    to disk before we go on. The run is recorded ('start'), then for each
+    motor its old and new values before anything is written ('begin') and
+    the outcome afterwards ('end'; 'committed' means the EPROM was written
+    too if 'eprom' was set). Motors restored by rollback_journal get a
+    'restored' line. A journal can be reopened (resume=True) to carry on
+    where an interrupted run stopped.
+    '''
+
+    def __init__(self, filename, resume=False):
+        '''
+        Starts a new journal in filename, which mustn't exist yet (raises
+        FileExistsError), or continues the one there if resume
+        '''
+        self.filename = filename
+        self.header = None
+        self.motors = {}
+        self.lock = threading.Lock()
+        if resume:
+            complete = 0
+            with open(filename, 'rb') as journal_file:
+                for line in journal_file:
+                    if not line.endswith(b'\n'):
+                        # Torn write when the run died
+                        break
+                    complete += len(line)
+                    self._apply_line(line.decode('utf-8', 'replace'))
+            # Throw the torn line away, so the next record starts on a line of its own
+            os.truncate(filename, complete)
+        # Never overwrite the journal of another run
+        self.out_file = open(filename, 'a' if resume else 'x')
+
+    @classmethod
+    def resume(cls, filename):
+        return cls(filename, resume=True)
+
+    @classmethod
+    def create(cls, config):
+        '''
+        Starts the journal of a new --write run (see journal_filename)
+        '''
+        now = datetime.today()
+        counter = 1
+        while True:
+            try:
+                return cls(journal_filename(config, now, counter))
+            except FileExistsError:
+                # Another run started in the same second
+                counter += 1
+
+    def _apply_line(self, line):
+        try:
+            record = json.loads(line)
+        except ValueError:
+            print('WARNING: Skipping damaged line in journal {}'.format(self.filename))
+            return
+        self._apply(record)
+
+    def _apply(self, record):
+        event = record['event']
+        if event == 'start':
+            self.header = self.header or record
+        elif event == 'begin':
+            entry = self.motors.setdefault(record['motor'], {})
+            # Keep the values from before the first attempt
+            entry.setdefault('old', record['old'])
+            entry.update(new=record['new'], eprom=record['eprom'], outcome=None)
+        elif event == 'end':
+            self.motors.setdefault(record['motor'], {})['outcome'] = record['outcome']
+        elif event == 'restored':
+            self.motors.setdefault(record['motor'], {})['restored'] = record['outcome']
+
+    def _append(self, record):
+        with self.lock:
+            self.out_file.write(json.dumps(record) + '\n')
+            self.out_file.flush()
+            os.fsync(self.out_file.fileno())
+            self._apply(record)
+
+    def start(self, config):
+        if self.header is None:
+            self._append({'event': 'start', 'time': datetime.now().isoformat(), 'tango_host': config['tango_host'],
+                          'beamline': config['beamline'], 'server': config['server'],
+                          'input_file': config.get('input_file')})
+
+    def begin(self, motor, old_params, new_params, write_eprom):
+        self._append({'event': 'begin', 'motor': motor, 'eprom': write_eprom,
+                      'old': {attrib: value for attrib, value in old_params.items() if not is_nan(value)},
+                      'new': dict(new_params)})
+
+    def end(self, motor, outcome):
+        self._append({'event': 'end', 'motor': motor, 'outcome': outcome})
+
+    def restored(self, motor, outcome):
+        self._append({'event': 'restored', 'motor': motor, 'outcome': outcome})
+
+    @property
+    def done_motors(self):
+        return {motor for motor, entry in self.motors.items() if entry.get('outcome') in ('committed', 'unchanged')}
+
+    def old_values(self):
+        '''
+        Returns the values from before the run of every motor which may have
+        been changed and hasn't been restored yet
+        '''
+        return {motor: entry['old'] for motor, entry in self.motors.items()
+                if 'old' in entry and entry.get('outcome') != 'rolled back' and entry.get('restored') != 'committed'}
+
+    def close(self):
+        self.out_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def journal_filename(config, now=None, counter=1):
+    if now is None:
+        now = datetime.today()
+    stamp = '{:%Y%m%d_%H%M%S}'.format(now)
+    if counter > 1:
+        stamp += '-{}'.format(counter)
+    return os.path.join(config.get('output_dir') or '', 'motors-{}.journal'.format(stamp))
+
+
+def rollback_journal(config, filename):
+    '''
+    Writes back the values from before the run recorded in a WriteJournal to
+    every motor it may have changed
+    '''
+    with WriteJournal.resume(filename) as journal:
+        if journal.header is not None:
+            config = dict(config, tango_host=journal.header['tango_host'], beamline=journal.header['beamline'])
+        to_restore = journal.old_values()
+        print('Restoring {} motors from {}'.format(len(to_restore), filename))
+        summary = write_motors(dict(config, journal=None, only_changed=False), to_restore)
+        for outcome, outcome_motors in summary.items():
+            for motor in outcome_motors:
+                journal.restored(motor, outcome)
+    return summary
+
+
+class MotorWatcher(object):
+    '''
+    Watches the selected attributes (by default the reduced set) of a list of
+    motors. The current values are kept in state and every change is appended
+    to the change log as 'time,motor,attribute,old value,new value'. Devices
+    which can send Tango change events are subscribed to; the others are
+    read again every poll().
+    '''
+
+    def __init__(self, config, motors, log_filename):
+        self.config = config
+        self.motors = motors
+        self.selection = config.get('selection') or list(_reduced_attr)
+        self.state = {}
+        self.polled_motors = []
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        self.log_file = open(log_filename, 'a')
+
+    def update(self, motor, label, value, when=None):
+        '''
+        Records the value of an attribute. Returns True if it had changed.
+        '''
+        with self.lock:
+            motor_state = self.state.setdefault(motor, {})
+            known = label in motor_state
+            old_value = motor_state.get(label)
+            if known and values_equal(old_value, value):
+                return False
+            motor_state[label] = value
+            if not known:
+                # First value we have seen. Not a change.
+                return False
+            when = when or datetime.now()
+            self.log_file.write('{},{},{},{},{}\n'.format(when.isoformat(), motor, label, old_value, value))
+            self.log_file.flush()
+        print('{} {}: {} -> {}'.format(motor, label, old_value, value))
+        return True
+
+    def read_motor(self, motor):
+        oms_dp, zmx_dp = get_motor_proxies(self.config, motor)
+        motor_params = read_parameters(oms_dp, zmx_dp, chunk_size=self.config.get('chunk_size'),
+                                       selection=self.selection, source=self.config.get('read_source'))
+        return [self.update(motor, label, value) for label, value in motor_params.items()].count(True)
+
+    def subscribe(self, motor):
+        '''
+        Subscribes to change events for all the watched attributes of a
+        motor. Returns False (with nothing subscribed) if any attribute can't
+        send them.
+        '''
+        if EventType is None:
+            return False
+        subscriptions = []
+        try:
+            for prefix, dev_proxy in zip(('oms', 'zmx'), get_motor_proxies(self.config, motor)):
+                for attrib in select_attributes(prefix, dev_proxy, self.selection):
+                    label = '{}:{}'.format(prefix, attrib)
+                    callback = self.event_callback(motor, label)
+                    subscriptions.append((dev_proxy, dev_proxy.subscribe_event(attrib, EventType.CHANGE_EVENT, callback)))
+        except Exception:
+            # Probably no change event configured. Poll this motor instead.
+            for dev_proxy, event_id in subscriptions:
+                dev_proxy.unsubscribe_event(event_id)
+            return False
+        self.subscriptions.extend(subscriptions)
+        return True
+
+    def event_callback(self, motor, label):
+        def push_event(event):
+            if event.err:
+                print('WARNING: Error event for {} of motor {}'.format(label, motor))
+                return
+            self.update(motor, label, event.attr_value.value)
+        return push_event
+
+    def start(self):
+        '''
+        Reads the current values of all the motors, then subscribes to events
+        where possible
+        '''
+        for motor in self.motors:
+            try:
+                self.read_motor(motor)
+            except Exception as ex:
+                print('ERROR: Could not read parameters for motor {}:\n{}'.format(motor, str(ex)))
+                evict_motor_proxies(self.config, motor)
+            if not self.subscribe(motor):
+                self.polled_motors.append(motor)
+        print('Watching {} motors ({} by events, {} by polling)'.format(
+            len(self.motors), len(self.motors) - len(self.polled_motors), len(self.polled_motors)))
+
+    def poll(self):
+        '''
+        Reads the motors which don't send events. Returns the number of
+        changes found.
+        '''
+        changes = 0
+        for motor in self.polled_motors:
+            try:
+                changes += self.read_motor(motor)
+            except Exception as ex:
+                print('ERROR: Could not read parameters for motor {}:\n{}'.format(motor, str(ex)))
+                evict_motor_proxies(self.config, motor)
+        return changes
+
+    def close(self):
+        for dev_proxy, event_id in self.subscriptions:
+            try:
+                dev_proxy.unsubscribe_event(event_id)
+            except Exception:
+                pass
+        self.subscriptions = []
+        self.log_file.close()
+
+
+def watch_motors(config, motors, cycles=None):
+    '''
+    Watches the motors (see MotorWatcher) until interrupted, or for the given
+    number of poll cycles
+    '''
+    watcher = MotorWatcher(config, motors, config.get('watch_log') or 'motor-changes.log')
+    try:
+        watcher.start()
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            time.sleep(config.get('watch_interval') or 0)
+            watcher.poll()
+            cycle += 1
+    except KeyboardInterrupt:
+        print('Stopped watching')
+    finally:
+        watcher.close()
+    return watcher.state
+
+
+def new_snapshot_filenames(output_dir=None, now=None):
+    '''
+    Returns the names of the full and reduced .params files for a new
+    snapshot in output_dir (see snapshot_filenames). The .part file of the
+    full one is created, so no other run can take the names; if they are
+    already taken, a counter is added.
+    '''
+    if now is None:
+        now = datetime.today()
+    counter = 1
+    while True:
+        filenames = [os.path.join(output_dir or '', filename) for filename in snapshot_filenames(now, counter)]
+        if not os.path.exists(filenames[0]):
+            try:
+                open(filenames[0] + SnapshotWriter.part_suffix, 'x').close()
+                return filenames
+            except FileExistsError:
+                pass
+        counter += 1
+
+
+def make_snapshot_writer(config):
+    '''
+    Returns the writer for the snapshot, as chosen by config
+    '''
+    if config.get('delta_store'):
+        if config.get('resume'):
+            # A delta store entry is only added once the snapshot is complete
+            print('ERROR: --resume cannot be used with --delta-store.\nAborting...')
+            sys.exit(1)
+        store = deltaSnapshot.DeltaStore(config['delta_store'], keyframe_interval=config.get('keyframe_interval') or 24,
+                                         compress=config.get('compress'))
+        return store.writer()
+    elif config.get('resume'):
+        return SnapshotWriter.resume(config['resume'])
+    return SnapshotWriter(*new_snapshot_filenames(config.get('output_dir')))
+
+
+def save_binary_snapshot(config, snapshot_writer):
+    if config.get('binary') and not config.get('delta_store'):
+        params_filename = snapshot_writer.filenames[0]
+        binarySnapshot.params_to_binary(params_filename, binarySnapshot.binary_filename_for(params_filename))
+
+
+def sweep_snapshot(config, targets):
+    '''
+    Reads the motors of all targets (see sweep_targets) into one snapshot
+    '''
+    all_motor_params = read_sweep(targets)
+    snapshot_writer = make_snapshot_writer(config)
+    with snapshot_writer:
+        for motor, motor_params in all_motor_params.items():
+            if motor not in snapshot_writer.done_motors:
+                snapshot_writer.write_motor(motor, motor_params)
+    save_binary_snapshot(config, snapshot_writer)
+    return snapshot_writer
+
+
+def shard_snapshot(config, targets):
+    '''
+    Reads the motors of all targets (see sweep_targets) in config['shards']
+    worker processes and merges their partial snapshots (see shardedSnapshot)
+    '''
+    if config['write_params'] or config['compare_params'] or config.get('watch') or config.get('rollback'):
+        print('ERROR: --shards can only be used to read a snapshot.\nAborting...')
+        sys.exit(1)
+    if config.get('delta_store') or config.get('resume'):
+        print('ERROR: --shards cannot be used with --delta-store or --resume.\nAborting...')
+        sys.exit(1)
+    if len({(target['tango_host'], target['beamline']) for target in targets}) > 1:
+        print('ERROR: --shards can only read the motors of one Tango host at a time.\nAborting...')
+        sys.exit(1)
+
+    motors = []
+    for target in targets:
+        motors.extend(itertools.chain.from_iterable(device_names(target).values()))
+    filenames = new_snapshot_filenames(config.get('output_dir'))
+    try:
+        snapshot_writer = shardedSnapshot.run_shards(targets[0], motors, filenames)
+    except shardedSnapshot.ShardMergeError as ex:
+        print('ERROR: {}\nAborting...'.format(ex))
+        sys.exit(1)
+    save_binary_snapshot(config, snapshot_writer)
+    return snapshot_writer
+
+
+def snapshot_result(snapshot_writer):
+    '''
+    Describes a finished snapshot: where it went and which motors are in it
+    '''
+    return {'snapshot': getattr(snapshot_writer, 'filenames', None) or snapshot_writer.store.store_dir,
+            'motors': sorted(snapshot_writer.done_motors),
+            'motor_status': {motor: list(status) for motor, status in snapshot_writer.motor_status.items()}}
+
+
+def input_matches_motors(motors_with_params, all_motors, dev_ids):
+    '''
+    The input file should contain only motors which are on the given server
+    or, the input file should contain parameters for all motors when device
+    IDs have been specified.
+    '''
+    return motors_with_params.issubset(all_motors) or (bool(dev_ids) and all_motors.issubset(motors_with_params))
+
+
+def run(config):
+    '''
+    Reads, writes, compares or watches the motors, as config (see
+    parse_args) asks. Returns a dictionary describing the outcome.
+    '''
+    config['selection'] = resolve_selection(config.get('selection'))
+    if config.get('resume') and config['resume'].endswith('.journal') != bool(config['write_params']):
+        print('ERROR: --resume takes the .journal file of a --write run, or the .params.part file of a read.\nAborting...')
+        sys.exit(1)
+
+    targets = sweep_targets(config)
+    if not targets:
+        # e.g. '-s all' and no servers were found in the Tango database
+        print('WARNING: No motors found on {}. Nothing to do.'.format(config['tango_host']))
+        return {}
+    if config.get('shards'):
+        return snapshot_result(shard_snapshot(config, targets))
+    if len(targets) > 1:
+        if config['write_params'] or config['compare_params'] or config.get('watch'):
+            print('ERROR: Only one server on one Tango host can be written, compared or watched at a time.\nAborting...')
+            sys.exit(1)
+        return snapshot_result(sweep_snapshot(config, targets))
+    config = targets[0]
 
     # Construct all the names of the motors we're interested in
-    dev_names = generate_device_names(config['server'], config['dev_ids'])
+    dev_names = device_names(config)
     all_motors = set(itertools.chain.from_iterable(dev_names.values()))
 
-    if config['write_params']:
-        input_motor_params = read_dat(config['input_file'])
+    if config.get('prewarm'):
+        prewarm_proxies(config, sorted(all_motors), jobs=config.get('jobs') or 1)
+
+    if config.get('watch'):
+        return {'watched': watch_motors(config, sorted(all_motors))}
+
+    elif config.get('rollback'):
+        return {'write_summary': rollback_journal(config, config['rollback'])}
+
+    elif config['write_params']:
+        # Only the motors being written need to be parsed
+        input_motor_params = read_dat(config['input_file'], lazy=True)
 
         # We check that all of the motors we are interested in have an entry in our input file
         motors_with_params = set(input_motor_params.keys())
+        if not input_matches_motors(motors_with_params, all_motors, config['dev_ids']) and _discovery is not None:
+            # The motors may only be missing because their server was down
+            # when the cached discovery was made. Ask the database again.
+            dev_names = device_names(config, refresh=True)
+            all_motors = set(itertools.chain.from_iterable(dev_names.values()))
         motors_to_update = list(all_motors & motors_with_params)
-        # The input file should contain only motors which are on the given
-        # server or, the input file should contain parameters for all motors
-        # when device IDs have been specified.
-        if set(motors_with_params).issubset(all_motors) or (bool(config['dev_ids']) and all_motors.issubset(motors_with_params)):
-            for motor in sorted(motors_to_update):
-                oms_dp = DeviceProxy('{}/{}/motor/{}'.format(config['tango_host'], config['beamline'], motor))
-                zmx_dp = DeviceProxy('{}/{}/ZMX/{}'.format(config['tango_host'], config['beamline'], motor))
-                print('Writing config to motor {}'.format(motor))
-                write_parameters(oms_dp, zmx_dp, input_motor_params[motor])
-                print('{}: DONE'.format(motor))
-            print('\nSuccessfully updated configuration for motors:\n{}'.format(', '.join(sorted(motors_to_update))))
+        if input_matches_motors(motors_with_params, all_motors, config['dev_ids']):
+            if config.get('resume'):
+                journal = WriteJournal.resume(config['resume'])
+                done = sorted(journal.done_motors & set(motors_to_update))
+                if done:
+                    print('Skipping motors already written:\n{}'.format(', '.join(done)))
+                motors_to_update = [motor for motor in motors_to_update if motor not in done]
+            else:
+                journal = WriteJournal.create(config)
+            print('Journal of this run: {}'.format(journal.filename))
+            with journal:
+                journal.start(config)
+                summary = write_motors(dict(config, journal=journal),
+                                       {motor: input_motor_params[motor] for motor in motors_to_update})
+            return {'write_summary': summary, 'journal': journal.filename}
         else:
-            print('ERROR: Configuration for one or more of the requested motors is not in the input file.\nAborting...')
+            undiscovered = sorted(motor for motor in motors_with_params - all_motors
+                                  if deviceDiscovery.server_name(motor) in dev_names)
+            if undiscovered and _discovery is not None:
+                print('ERROR: Discovery did not find these motors of the input file on {} (not exported?):\n{}'
+                      '\nAborting...'.format(config['tango_host'], ', '.join(undiscovered)))
+            else:
+                print('ERROR: Configuration for one or more of the requested motors is not in the input file.\nAborting...')
             sys.exit(1)
 
-    elif config['compare_params']:  # FIXME: this part of function not tested!
-        input_all_motor_params = read_dat(config['input_file'])
-        current_all_motor_params = read_motors(config, dev_names)
+    elif config['compare_params']:
+        # A nan which was recorded is a difference too
+        input_all_motor_params = read_dat(config['input_file'], keep_nan=True)
+        if config.get('compare_against'):
+            # Offline comparison of two files. No need to talk to Tango.
+            current_all_motor_params = read_dat(config['compare_against'], keep_nan=True)
+        else:
+            # Only the parameters recorded in the input file need to be read
+            compare_config = dict(config)
+            compare_config['selection'] = sorted(set(itertools.chain.from_iterable(
+                input_all_motor_params.values())))
+            current_all_motor_params = read_motors(compare_config, dev_names)
 
         # As per the write, we check that all of the motors we are interested in have an entry in our input file
         motors_with_params = set(input_all_motor_params.keys())
-        motors_to_update = list(all_motors & motors_with_params)
-        if set(motors_with_params).issubset(all_motors) or (bool(config['dev_ids']) and all_motors.issubset(motors_with_params)):
-            for motor in sorted(motors_to_update):
-                motors_equal = True
-                input_this_motor_params = input_all_motor_params[motor]
-                current_this_motor_params = current_all_motor_params[motor]
-                for recorded_param in input_this_motor_params.keys():
-                    curr_param_equal = (input_this_motor_params[recorded_param] == current_this_motor_params[recorded_param])
-                    motors_equal = motors_equal and curr_param_equal
-                    if not curr_param_equal:
-                        print('{} parameter for motor {} differ! (Input: {} Current: {})'.format(recorded_param, motor, input_this_motor_params[recorded_param], current_this_motor_params[recorded_param]))
-
-                if motors_equal:
-                    print('{}: Input and current params are same\n'.format(motor))
-                else:
-                    print('{}: Input and current params are DIFFERENT\n'.format(motor))
+        motors_to_compare = all_motors & motors_with_params
+        if input_matches_motors(motors_with_params, all_motors, config['dev_ids']):
+            tolerances = None
+            if config.get('tolerances'):
+                with open(config['tolerances'], 'r') as tol_file:
+                    tolerances = json.load(tol_file)
+            diffs, summary = compare_parameters({motor: input_all_motor_params[motor] for motor in motors_to_compare},
+                                                current_all_motor_params, tolerances)
+
+            for diff in diffs:
+                print('{} parameter for motor {} differ! (Input: {} Current: {})'.format(diff['parameter'], diff['motor'], diff['input'], diff['current']))
+            print('\nInput and current params are same for motors:\n{}'.format(', '.join(summary['same_motors'])))
+            print('Input and current params are DIFFERENT for motors:\n{}'.format(', '.join(summary['different_motors'])))
+            print('\n{} parameters of {} motors compared, {} differences'.format(summary['parameters'], summary['motors'], summary['differences']))
+
+            if config.get('diff_json'):
+                write_diff_json(diffs, summary, config['diff_json'])
+            if config.get('diff_csv'):
+                write_diff_csv(diffs, config['diff_csv'])
+            return {'differences': diffs, 'compare_summary': summary}
 
     else:
-        all_motor_params = read_motors(config, dev_names)
-        write_dat(all_motor_params)
+        snapshot_writer = make_snapshot_writer(config)
+        with snapshot_writer:
+            read_motors(config, dev_names, snapshot_writer=snapshot_writer)
+        save_binary_snapshot(config, snapshot_writer)
+        return snapshot_result(snapshot_writer)
+    return {}
+
+
+def main():
+    # Find out what we're supposed to be doing...
+    config = parse_args(sys.argv[1:])
+    if config.get('metrics'):
+        enable_metrics(config['metrics'])
+    if config.get('schema_cache'):
+        enable_schema_cache(config['schema_cache'], config.get('schema_ttl') or 86400)
+    if config.get('discover'):
+        enable_discovery(config.get('device_cache'), config.get('device_ttl') or 3600)
+    # ...and set up the reduced set of parameters we're interested in.
+    make_reduced_attribs()
+
+    result = run(config)
+    summary = result.get('write_summary')
+    if summary and (summary['rolled back'] or summary['failed']):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
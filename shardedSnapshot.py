@@ -0,0 +1,240 @@
+import os
+import sys
+import argparse
+import json
+import shlex
+import subprocess
+
+
+''' Reads a snapshot in several worker processes (shards), on this host or
+ started on other control hosts with ssh, then merges their partial
+ snapshots into the usual .params and _reduced.params files.
+
+ The motors are sorted and dealt out to the shards round robin, so every
+ shard gets motors of every device server. The shards work in a directory
+ next to the snapshot ('motors-<stamp>.shards'), which must be visible to
+ all the hosts (e.g. on NFS). It holds shards.json, describing the run, and
+ for each shard its settings (shard-NN.json), its partial snapshot
+ (shard-NN.params, shard-NN_reduced.params, shard-NN.status) and its output
+ (shard-NN.log). The merge only depends on the contents of the directory, so
+ it can be repeated, e.g. after a failed shard has been run again:
+     python shardedSnapshot.py worker <dir>/shard-NN.json
+     python shardedSnapshot.py merge <dir>'''
+_manifest_name = 'shards.json'
+_local_hosts = ('', 'localhost', '127.0.0.1')
+
+
+class ShardMergeError(Exception):
+    '''
+    Raised when the partial snapshots can't be merged (e.g. two shards read
+    different values for the same motor)
+    '''
+
+
+def shard_motors(motors, shards):
+    '''
+    Splits motors into (at most) shards lists
+    '''
+    motors = sorted(motors)
+    return [motors[i::shards] for i in range(min(shards, len(motors)))]
+
+
+def shard_name(index):
+    return 'shard-{:02d}'.format(index + 1)
+
+
+def worker_config(config):
+    '''
+    Returns the settings of config which can be passed to a worker
+    '''
+    return {key: value for key, value in config.items()
+            if value is None or isinstance(value, (str, int, float, bool, list))}
+
+
+def prepare_shards(config, motors, shard_dir, snapshot_filenames):
+    '''
+    Writes the manifest and the settings of each shard into shard_dir.
+    Returns the names of the shard settings files.
+    '''
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = shard_motors(motors, config['shards'])
+    with open(os.path.join(shard_dir, _manifest_name), 'w') as manifest_file:
+        json.dump({'shards': len(shards), 'motors': sorted(motors), 'snapshot': list(snapshot_filenames)},
+                  manifest_file, indent=1)
+
+    spec_filenames = []
+    for index, shard in enumerate(shards):
+        base = os.path.join(shard_dir, shard_name(index))
+        with open(base + '.json', 'w') as spec_file:
+            json.dump({'config': worker_config(config), 'motors': shard,
+                       'snapshot': [base + '.params', base + '_reduced.params']}, spec_file, indent=1)
+        spec_filenames.append(base + '.json')
+    return spec_filenames
+
+
+def launch_shard(spec_filename, host=None):
+    '''
+    Starts a worker for a shard, on host if given (with ssh). Returns the
+    Popen of the worker.
+    '''
+    spec_filename = os.path.abspath(spec_filename)
+    script = os.path.abspath(__file__)
+    if host in _local_hosts or host is None:
+        command = [sys.executable, script, 'worker', spec_filename]
+    else:
+        command = ['ssh', host, 'cd {} && python3 {} worker {}'.format(
+            shlex.quote(os.getcwd()), shlex.quote(script), shlex.quote(spec_filename))]
+    with open(spec_filename[:-len('.json')] + '.log', 'w') as log_file:
+        return subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def run_worker(spec_filename):
+    '''
+    Reads the motors of one shard into its partial snapshot
+    '''
+    import readMotor
+
+    with open(spec_filename, 'r') as spec_file:
+        spec = json.load(spec_file)
+    config = spec['config']
+    if config.get('metrics'):
+        readMotor.enable_metrics(spec_filename[:-len('.json')] + os.path.splitext(config['metrics'])[1])
+    if config.get('schema_cache'):
+        readMotor.enable_schema_cache(config['schema_cache'], config.get('schema_ttl') or 86400)
+    if not readMotor._reduced_attr:
+        readMotor.make_reduced_attribs()
+
+    dev_names = {}
+    for motor in spec['motors']:
+        dev_names.setdefault(motor.rsplit('.', 1)[0], []).append(motor)
+    snapshot_writer = readMotor.SnapshotWriter(*spec['snapshot'])
+    with snapshot_writer:
+        readMotor.read_motors(config, dev_names, snapshot_writer=snapshot_writer)
+    return snapshot_writer
+
+
+def read_partial(params_filename, reduced_params_filename):
+    '''
+    Returns {motor: (full line, reduced line)} of a partial snapshot. The
+    .part files of a shard which didn't finish are used if there is nothing
+    better; only motors with a complete line in both count.
+    '''
+    lines = []
+    for filename in (params_filename, reduced_params_filename):
+        with open(filename, 'r') as params_file:
+            lines.append({line.split(',', 1)[0]: line for line in params_file if line.endswith('\n')})
+    full_lines, reduced_lines = lines
+    return {motor: (line, reduced_lines[motor]) for motor, line in full_lines.items() if motor in reduced_lines}
+
+
+def merge_shards(shard_dir):
+    '''
+    Merges the partial snapshots in shard_dir into the snapshot named in its
+    manifest. Motors read by more than one shard must have the same values
+    in each. The status file lists the motors the shards skipped or failed
+    to read, and as 'missing' those no shard accounted for. Returns the
+    SnapshotWriter of the snapshot.
+    '''
+    import readMotor
+
+    with open(os.path.join(shard_dir, _manifest_name), 'r') as manifest_file:
+        manifest = json.load(manifest_file)
+    expected = set(manifest['motors'])
+
+    motor_lines = {}
+    owners = {}
+    motor_status = {}
+    for index in range(manifest['shards']):
+        name = shard_name(index)
+        base = os.path.join(shard_dir, name)
+        filenames = [base + '.params', base + '_reduced.params']
+        if not all(os.path.exists(filename) for filename in filenames):
+            filenames = [filename + readMotor.SnapshotWriter.part_suffix for filename in filenames]
+            if not all(os.path.exists(filename) for filename in filenames):
+                print('WARNING: {} wrote no snapshot (see {}.log)'.format(name, base))
+                continue
+            print('WARNING: {} did not finish. Using the motors it read.'.format(name))
+
+        for motor, lines in sorted(read_partial(*filenames).items()):
+            if motor not in expected:
+                raise ShardMergeError('{} read motor {}, which is not in {}'.format(name, motor, _manifest_name))
+            if motor in motor_lines:
+                if motor_lines[motor] != lines:
+                    raise ShardMergeError('Motor {} was read by {} and {} with different values'.format(
+                        motor, owners[motor], name))
+                print('WARNING: Motor {} was read by both {} and {}'.format(motor, owners[motor], name))
+                continue
+            motor_lines[motor] = lines
+            owners[motor] = name
+
+        if os.path.exists(base + '.status'):
+            for motor, status in readMotor.read_motor_status(base + '.status').items():
+                motor_status.setdefault(motor, status)
+
+    motor_status = {motor: status for motor, status in motor_status.items() if motor not in motor_lines}
+    missing = sorted(expected - set(motor_lines) - set(motor_status))
+    if missing:
+        print('ERROR: No shard read motors:\n{}'.format(', '.join(missing)))
+        for motor in missing:
+            motor_status[motor] = ('missing', 'not in any partial snapshot')
+
+    snapshot_writer = readMotor.SnapshotWriter(*manifest['snapshot'])
+    with snapshot_writer:
+        for motor in sorted(motor_lines):
+            snapshot_writer.write_motor_lines(motor, motor_lines[motor])
+        for motor, (status, reason) in sorted(motor_status.items()):
+            snapshot_writer.mark_motor(motor, status, reason)
+    return snapshot_writer
+
+
+def run_shards(config, motors, snapshot_filenames):
+    '''
+    Reads motors in config['shards'] workers, spread over the hosts in
+    config['shard_hosts'] (a comma separated list, default this host), and
+    merges their partial snapshots into snapshot_filenames. Returns the
+    SnapshotWriter of the snapshot.
+    '''
+    shard_dir = snapshot_filenames[0][:-len('.params')] + '.shards'
+    spec_filenames = prepare_shards(config, motors, shard_dir, snapshot_filenames)
+    hosts = (config.get('shard_hosts') or '').split(',')
+
+    workers = []
+    for index, spec_filename in enumerate(spec_filenames):
+        host = hosts[index % len(hosts)]
+        print('Starting {} on {}'.format(shard_name(index), host or 'this host'))
+        workers.append(launch_shard(spec_filename, host))
+    for index, worker in enumerate(workers):
+        return_code = worker.wait()
+        if return_code:
+            print('ERROR: {} exited with code {} (see {}.log)'.format(
+                shard_name(index), return_code, os.path.join(shard_dir, shard_name(index))))
+
+    print('Merging {} partial snapshots from {}'.format(len(spec_filenames), shard_dir))
+    return merge_shards(shard_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one shard of a sharded snapshot, or merge the shards')
+    subparsers = parser.add_subparsers(dest='command')
+    worker_parser = subparsers.add_parser('worker', help='Read the motors of one shard')
+    worker_parser.add_argument('spec', help='Settings of the shard (shard-NN.json)')
+    merge_parser = subparsers.add_parser('merge', help='Merge the partial snapshots of the shards')
+    merge_parser.add_argument('shard_dir', help='Directory of the shards (motors-<stamp>.shards)')
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.command == 'worker':
+        run_worker(args.spec)
+    elif args.command == 'merge':
+        try:
+            snapshot_writer = merge_shards(args.shard_dir)
+        except ShardMergeError as ex:
+            print('ERROR: {}'.format(ex))
+            sys.exit(1)
+        print('Merged {} motors into {}'.format(len(snapshot_writer.done_motors), snapshot_writer.filenames[0]))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import fnmatch
+import math
+import random
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from unittest import mock
+
+import readMotor
+
+
+''' Stand-ins for the OMSvme and ZMX DeviceProxys, so that readMotor can be
+ tested and benchmarked without a beamline. Every call to a device costs a
+ (configurable) latency and may fail at random.'''
+
+
+class SimulatedDevFailed(Exception):
+    '''
+    Raised by simulated devices where PyTango would raise DevFailed
+    '''
+
+
+class SimulatedDevSource(object):
+    DEV = 'DEV'
+    CACHE = 'CACHE'
+    CACHE_DEV = 'CACHE_DEV'
+
+
+class SimulatedDeviceAttribute(object):
+    def __init__(self, value, has_failed=False):
+        self.value = value
+        self.has_failed = has_failed
+
+
+class SimulatedFarm(object):
+    '''
+    Settings and state shared by all the simulated devices. Use
+    make_proxy as a replacement for DeviceProxy.
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, extra_attributes=0, eprom_cost=0.0, seed=None,
+                 server_capacity=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.extra_attributes = extra_attributes
+        self.eprom_cost = eprom_cost
+        # Calls a device server can handle at once before it slows down
+        self.server_capacity = server_capacity
+        self.server_load = Counter()
+        self.random = random.Random(seed)
+        self.devices = {}
+        # Names of devices which never answer (e.g. crate powered off)
+        self.dead_devices = set()
+        # Names of devices which answer nothing until the client times out
+        self.hanging_devices = set()
+        # Names of devices the simulated Tango database reports as exported
+        self.exported_devices = set()
+        # Attributes the device servers poll, which can be read from their cache
+        self.polled_attributes = set()
+        # Attributes read from the hardware (rather than a cache), by name
+        self.hardware_reads = Counter()
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def make_proxy(self, dev_name):
+        with self.lock:
+            if dev_name not in self.devices:
+                self.devices[dev_name] = SimulatedDevice(self, dev_name)
+            device = self.devices[dev_name]
+        self.call(dev_name, 'DeviceProxy')
+        return SimulatedDeviceProxy(device)
+
+    def make_database(self, host, port):
+        self.call('sys/database/2', 'Database')
+        return SimulatedDatabase(self)
+
+    def export_motors(self, beamline, server, count):
+        '''
+        Adds the OMS and ZMX devices of count motors of server to the database
+        '''
+        for i in range(1, count + 1):
+            for dev_class in ('motor', 'ZMX'):
+                self.exported_devices.add('{}/{}/{}.{:02d}'.format(beamline, dev_class, server, i))
+
+    def call(self, dev_name, method, fail=True, timeout=None):
+        '''
+        Accounts for one round trip to a device: counts it, waits and maybe
+        fails. If the device server (e.g. EH1A) is handling more than
+        server_capacity calls, the wait grows in proportion. A call which
+        would take longer than the client timeout (in ms) fails after it.
+        '''
+        server = dev_name.rsplit('/', 1)[-1].rsplit('.', 1)[0]
+        with self.lock:
+            self.calls[method] += 1
+            self.server_load[server] += 1
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+            if self.server_capacity:
+                delay *= max(self.server_load[server] / self.server_capacity, 1)
+            failed = fail and self.random.random() < self.failure_rate
+        try:
+            if dev_name in self.dead_devices and method != 'DeviceProxy':
+                raise SimulatedDevFailed('{} is not responding'.format(dev_name))
+            if dev_name in self.hanging_devices and method != 'DeviceProxy':
+                delay = math.inf
+            if timeout is not None and delay > timeout / 1000:
+                time.sleep(timeout / 1000)
+                raise SimulatedDevFailed('{} timed out after {} ms'.format(method, timeout))
+            if delay:
+                time.sleep(delay)
+        finally:
+            with self.lock:
+                self.server_load[server] -= 1
+        if failed:
+            raise SimulatedDevFailed('Simulated failure of {} on {}'.format(method, dev_name))
+
+    @contextmanager
+    def patch(self):
+        '''
+        Makes readMotor use this farm instead of Tango while in the context
+        '''
+        readMotor.clear_proxy_pool()
+        with mock.patch('readMotor.DeviceProxy', self.make_proxy), \
+                mock.patch('deviceDiscovery.Database', self.make_database), \
+                mock.patch('readMotor.DevFailed', SimulatedDevFailed, create=True), \
+                mock.patch('readMotor.DevSource', SimulatedDevSource):
+            yield self
+        readMotor.clear_proxy_pool()
+
+    def round_trips(self):
+        return sum(count for method, count in self.calls.items() if method != 'DeviceProxy')
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+
+class SimulatedDatabase(object):
+    def __init__(self, farm):
+        self.farm = farm
+
+    def get_device_exported(self, pattern):
+        self.farm.call('sys/database/2', 'get_device_exported')
+        # Tango wildcards are not case sensitive
+        return sorted(name for name in self.farm.exported_devices if fnmatch.fnmatch(name.lower(), pattern.lower()))
+
+
+class SimulatedAttributeInfo(object):
+    def __init__(self, name, value):
+        self.name = name
+        if isinstance(value, str):
+            self.data_type = 'DevString'
+        elif isinstance(value, float):
+            self.data_type = 'DevDouble'
+        else:
+            self.data_type = 'DevLong'
+        self.writable = 'READ' if name.startswith('Diagnostic') else 'READ_WRITE'
+
+
+class SimulatedDevice(object):
+    '''
+    The state of one simulated OMSvme ('motor') or ZMX device
+    '''
+
+    def __init__(self, farm, dev_name):
+        self.farm = farm
+        self.dev_name = dev_name
+        self.device_class = 'zmx' if '/ZMX/' in dev_name else 'oms'
+        self.attributes = {}
+        for i, attr in enumerate(readMotor._parameters_list[self.device_class]):
+            if attr == 'AxisName':
+                self.attributes[attr] = dev_name.rsplit('/', 1)[-1]
+            elif attr == 'DelayTime':
+                self.attributes[attr] = 4
+            else:
+                self.attributes[attr] = float(i) if i % 2 else i
+        for i in range(farm.extra_attributes):
+            self.attributes['Diagnostic{:03d}'.format(i)] = float(i)
+
+    def set(self, attr, value):
+        if attr not in self.attributes:
+            raise SimulatedDevFailed('{} has no attribute {}'.format(self.dev_name, attr))
+        if attr == 'DelayTime':
+            # Written as the mapped value, read back as the real one
+            value = {index: delay for delay, index in readMotor._DelayTime_map.items()}[value]
+        self.attributes[attr] = value
+
+
+class SimulatedDeviceProxy(object):
+    def __init__(self, device):
+        self._device = device
+        self._timeout = 3000
+        self._source = SimulatedDevSource.CACHE_DEV
+
+    def _call(self, method):
+        self._device.farm.call(self._device.dev_name, method, timeout=self._timeout)
+
+    def name(self):
+        return self._device.dev_name
+
+    def dev_name(self):
+        return self._device.dev_name
+
+    def get_db_host(self):
+        return self._device.dev_name.split('/', 1)[0].partition(':')[0]
+
+    def get_db_port(self):
+        return self._device.dev_name.split('/', 1)[0].partition(':')[2]
+
+    def get_timeout_millis(self):
+        return self._timeout
+
+    def set_timeout_millis(self, timeout):
+        self._timeout = timeout
+
+    def get_source(self):
+        return self._source
+
+    def set_source(self, source):
+        self._source = source
+
+    def ping(self):
+        start = time.monotonic()
+        self._call('ping')
+        return int((time.monotonic() - start) * 1e6)
+
+    def get_attribute_list(self):
+        self._call('get_attribute_list')
+        return list(self._device.attributes)
+
+    def get_attribute_config(self, attrs):
+        self._call('get_attribute_config')
+        return [SimulatedAttributeInfo(attr, self._attribute(attr).value) for attr in attrs]
+
+    def _attribute(self, attr):
+        if attr not in self._device.attributes:
+            raise SimulatedDevFailed('{} has no attribute {}'.format(self._device.dev_name, attr))
+        return SimulatedDeviceAttribute(self._device.attributes[attr])
+
+    def _read(self, attr, source):
+        '''
+        Reads attr from the cache or the hardware, as source (that of the
+        proxy when the call was made) allows
+        '''
+        farm = self._device.farm
+        if source != SimulatedDevSource.DEV and attr in farm.polled_attributes:
+            return self._attribute(attr)
+        if source == SimulatedDevSource.CACHE:
+            raise SimulatedDevFailed('{} is not polled'.format(attr))
+        with farm.lock:
+            farm.hardware_reads[attr] += 1
+        return self._attribute(attr)
+
+    def read_attribute(self, attr, *args, **kwargs):
+        source = self._source
+        self._call('read_attribute')
+        return self._read(attr, source)
+
+    def read_attributes(self, attrs, *args, **kwargs):
+        source = self._source
+        self._call('read_attributes')
+        values = []
+        for attr in attrs:
+            try:
+                values.append(self._read(attr, source))
+            except SimulatedDevFailed:
+                values.append(SimulatedDeviceAttribute(None, True))
+        return values
+
+    def write_attribute(self, attr, value):
+        self._call('write_attribute')
+        self._device.set(attr, value)
+
+    def write_attributes(self, name_values):
+        self._call('write_attributes')
+        for attr, value in name_values:
+            self._device.set(attr, value)
+
+    def WriteEPROM(self):
+        self._call('WriteEPROM')
+        if self._device.farm.eprom_cost:
+            time.sleep(self._device.farm.eprom_cost)
+        return 1
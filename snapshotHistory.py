@@ -0,0 +1,238 @@
+import os
+import sys
+import argparse
+import bisect
+import json
+import re
+
+from datetime import datetime
+from urllib.parse import quote
+
+from binarySnapshot import read_params_raw, read_binary_snapshot
+from deltaSnapshot import same_value
+
+
+''' Catalog of the snapshot files written by readMotor.py. For each motor we
+ keep the times of the snapshots it appears in and, for each attribute, only
+ the points at which its value changed. Each motor is stored in its own JSON
+ file in the catalog directory, so a query only loads the motor it is about.'''
+# A second snapshot taken in the same second has e.g. '-2' after the time
+_snapshot_pattern = re.compile(r'motors-(\d{8}_\d{6})(?:-\d+)?\.(params|snap)$')
+_stamp_format = '%Y%m%d_%H%M%S'
+_index_filename = 'catalog.json'
+
+
+def snapshot_time(stamp):
+    return datetime.strptime(stamp, _stamp_format)
+
+
+def read_snapshot_file(filename):
+    if filename.endswith('.snap'):
+        return read_binary_snapshot(filename)
+    return read_params_raw(filename)
+
+
+class MotorHistory(object):
+    '''
+    History of one motor: the snapshot times it was seen at, and for each
+    attribute a list of [time index, value] change points. An attribute
+    missing from a snapshot is assumed not to have changed.
+    '''
+
+    def __init__(self, times=None, changes=None):
+        self.times = times or []
+        self.changes = changes or {}
+
+    def add(self, stamp, attributes):
+        pos = bisect.bisect_left(self.times, stamp)
+        if pos < len(self.times) and self.times[pos] == stamp:
+            # Already have this snapshot
+            return False
+
+        self.times.insert(pos, stamp)
+        if pos == len(self.times) - 1:
+            # Newest snapshot, which is the usual case
+            for attr, value in attributes.items():
+                points = self.changes.setdefault(attr, [])
+                if not points or not same_value(points[-1][1], value):
+                    points.append([pos, value])
+            return True
+
+        for points in self.changes.values():
+            for point in points:
+                if point[0] >= pos:
+                    point[0] += 1
+
+        for attr, value in attributes.items():
+            points = self.changes.setdefault(attr, [])
+            i = bisect.bisect_left([point[0] for point in points], pos)
+            previous = points[i - 1][1] if i > 0 else None
+            following = points[i] if i < len(points) else None
+
+            if i > 0 and same_value(previous, value):
+                continue
+            points.insert(i, [pos, value])
+            if following is not None and following[0] == pos + 1:
+                if same_value(following[1], value):
+                    # The change we already knew about now happens earlier
+                    points.remove(following)
+            elif i > 0 and pos + 1 < len(self.times):
+                # The next snapshot still had the old value
+                points.insert(i + 1, [pos + 1, previous])
+        return True
+
+    def change_points(self, attr):
+        return [(self.times[index], value) for index, value in self.changes.get(attr, [])]
+
+    def series(self, attr):
+        points = self.changes.get(attr, [])
+        if not points:
+            return []
+        values = []
+        point_i = 0
+        for index, stamp in enumerate(self.times[points[0][0]:], start=points[0][0]):
+            while point_i + 1 < len(points) and points[point_i + 1][0] <= index:
+                point_i += 1
+            values.append((stamp, points[point_i][1]))
+        return values
+
+    def to_json(self):
+        return {'times': self.times, 'changes': self.changes}
+
+
+class HistoryCatalog(object):
+    '''
+    Catalog of a set of snapshot files, stored in catalog_dir. Call update()
+    to add any new snapshot files in a directory; only files which aren't
+    already in the catalog are read.
+    '''
+
+    def __init__(self, catalog_dir):
+        self.catalog_dir = catalog_dir
+        os.makedirs(catalog_dir, exist_ok=True)
+        index_path = os.path.join(catalog_dir, _index_filename)
+        if os.path.exists(index_path):
+            with open(index_path, 'r') as index_file:
+                self.index = json.load(index_file)
+        else:
+            self.index = {'files': {}, 'motors': []}
+        self._motors = {}
+        self._dirty = set()
+
+    def _motor_path(self, motor):
+        # Motors of a sweep are named e.g. 'haspp02oh1:10000/p02/EH1A.01'
+        return os.path.join(self.catalog_dir, '{}.json'.format(quote(motor, safe='')))
+
+    def motor_history(self, motor):
+        if motor not in self._motors:
+            if motor in self.index['motors']:
+                with open(self._motor_path(motor), 'r') as motor_file:
+                    stored = json.load(motor_file)
+                self._motors[motor] = MotorHistory(stored['times'], stored['changes'])
+            else:
+                self._motors[motor] = MotorHistory()
+        return self._motors[motor]
+
+    def add_snapshot(self, filename, stamp=None):
+        if stamp is None:
+            stamp = _snapshot_pattern.search(os.path.basename(filename)).group(1)
+        for motor, attributes in read_snapshot_file(filename).items():
+            if self.motor_history(motor).add(stamp, attributes):
+                self._dirty.add(motor)
+        self.index['files'][os.path.abspath(filename)] = stamp
+
+    def update(self, snapshot_dir):
+        '''
+        Adds all the snapshot files in snapshot_dir which aren't yet in the
+        catalog. Returns the number of files added.
+        '''
+        added = 0
+        for filename in sorted(os.listdir(snapshot_dir)):
+            match = _snapshot_pattern.search(filename)
+            path = os.path.abspath(os.path.join(snapshot_dir, filename))
+            if not match or path in self.index['files']:
+                continue
+            # Don't catalog the same snapshot twice if it exists as .params & .snap
+            if match.group(2) == 'snap' and os.path.exists(path[:-len('.snap')] + '.params'):
+                continue
+            self.add_snapshot(path, match.group(1))
+            added += 1
+        self.save()
+        return added
+
+    def save(self):
+        for motor in self._dirty:
+            tmp_path = self._motor_path(motor) + '.tmp'
+            with open(tmp_path, 'w') as motor_file:
+                json.dump(self._motors[motor].to_json(), motor_file, separators=(',', ':'))
+            os.replace(tmp_path, self._motor_path(motor))
+        self.index['motors'] = sorted(set(self.index['motors']) | self._dirty)
+        self._dirty = set()
+
+        tmp_path = os.path.join(self.catalog_dir, _index_filename + '.tmp')
+        with open(tmp_path, 'w') as index_file:
+            json.dump(self.index, index_file)
+        os.replace(tmp_path, os.path.join(self.catalog_dir, _index_filename))
+
+    def motors(self):
+        return list(self.index['motors'])
+
+    def series(self, motor, attr, start=None, end=None):
+        '''
+        Returns (datetime, value) for attr of motor at every snapshot between
+        start and end
+        '''
+        return [(snapshot_time(stamp), value) for stamp, value in self.motor_history(motor).series(attr)
+                if (start is None or snapshot_time(stamp) >= start) and (end is None or snapshot_time(stamp) <= end)]
+
+    def change_points(self, motor, attr):
+        '''
+        Returns (datetime, value) for each snapshot where the value of attr of
+        motor differs from the one before. The first entry is the first value
+        recorded.
+        '''
+        return [(snapshot_time(stamp), value) for stamp, value in self.motor_history(motor).change_points(attr)]
+
+    def value_at(self, motor, attr, when):
+        '''
+        Returns the value of attr of motor in the last snapshot at or before
+        when, or None if there isn't one
+        '''
+        value = None
+        for changed, changed_value in self.change_points(motor, attr):
+            if changed > when:
+                break
+            value = changed_value
+        return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index snapshot files and query the history of motor parameters')
+    parser.add_argument('--catalog', '-c', default='.motor_history',
+                        help='Directory where the catalog is kept')
+    subparsers = parser.add_subparsers(dest='command')
+    index_parser = subparsers.add_parser('index', help='Add new snapshot files to the catalog')
+    index_parser.add_argument('snapshot_dir', nargs='?', default='.')
+    query_parser = subparsers.add_parser('query', help='Show the history of a motor parameter')
+    query_parser.add_argument('motor')
+    query_parser.add_argument('attribute')
+    query_parser.add_argument('--changes', action='store_true', help='Only show the changes')
+    args = parser.parse_args(sys.argv[1:])
+
+    catalog = HistoryCatalog(args.catalog)
+    if args.command == 'index':
+        added = catalog.update(args.snapshot_dir)
+        print('Added {} snapshot(s) to {}'.format(added, args.catalog))
+    elif args.command == 'query':
+        if args.changes:
+            history = catalog.change_points(args.motor, args.attribute)
+        else:
+            history = catalog.series(args.motor, args.attribute)
+        for when, value in history:
+            print('{},{}'.format(when.isoformat(), value))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import bisect
+import json
+import threading
+import time
+
+
+''' Instrumentation of the calls made to Tango devices. Wrap a DeviceProxy in
+ an InstrumentedProxy and every call to it is counted and timed in a Metrics
+ object, by device class, operation and attribute. The metrics can be saved
+ as a JSON report or in the Prometheus text format.'''
+
+# Upper bounds (s) of the latency histogram buckets, as used by Prometheus
+_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Calls to these methods are timed, by attribute where there is only one
+_timed_methods = ('get_attribute_list', 'read_attribute', 'read_attributes', 'write_attribute',
+                  'write_attributes', 'WriteEPROM', 'ping', 'get_attribute_config')
+
+
+def call_attribute(method, args):
+    '''
+    Returns the name of the attribute a call is about, or '' for calls about
+    the device or several attributes. Use --chunk-size 1 to time every
+    attribute read separately.
+    '''
+    if not args:
+        return ''
+    if method in ('read_attribute', 'write_attribute', 'get_attribute_config'):
+        return args[0]
+    if method == 'read_attributes' and len(args[0]) == 1:
+        return args[0][0]
+    if method == 'write_attributes' and len(args[0]) == 1:
+        return args[0][0][0]
+    return ''
+
+
+def device_class(dev_name):
+    if '/ZMX/' in dev_name:
+        return 'zmx'
+    if '/motor/' in dev_name:
+        return 'oms'
+    return 'other'
+
+
+class Metrics(object):
+    '''
+    Call counts, error counts and latency histograms, keyed by
+    (device class, operation, attribute)
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, dev_class, operation, attribute, seconds, failed=False):
+        key = (dev_class, operation, attribute)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'count': 0, 'errors': 0, 'seconds': 0.0, 'max': 0.0,
+                                            'buckets': [0] * (len(_buckets) + 1)}
+            stats['count'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['buckets'][bisect.bisect_left(_buckets, seconds)] += 1
+
+    def report(self):
+        '''
+        Returns a list of the statistics for each (device class, operation,
+        attribute), slowest first
+        '''
+        with self._lock:
+            items = [(key, dict(stats, buckets=list(stats['buckets']))) for key, stats in self._stats.items()]
+
+        report = []
+        for (dev_class, operation, attribute), stats in items:
+            report.append({'device_class': dev_class, 'operation': operation, 'attribute': attribute,
+                           'count': stats['count'], 'errors': stats['errors'],
+                           'total_seconds': stats['seconds'], 'mean_seconds': stats['seconds'] / stats['count'],
+                           'max_seconds': stats['max'],
+                           'histogram': dict(zip([str(bound) for bound in _buckets] + ['+Inf'], stats['buckets']))})
+        report.sort(key=lambda entry: entry['total_seconds'], reverse=True)
+        return report
+
+    def write_json(self, filename):
+        with open(filename, 'w') as out_file:
+            json.dump(self.report(), out_file, indent=1)
+
+    def write_prometheus(self, filename):
+        lines = ['# HELP motor_reader_tango_call_seconds Time taken by calls to Tango devices',
+                 '# TYPE motor_reader_tango_call_seconds histogram']
+        error_lines = ['# HELP motor_reader_tango_call_errors_total Calls to Tango devices which failed',
+                       '# TYPE motor_reader_tango_call_errors_total counter']
+        for entry in sorted(self.report(), key=lambda entry: (entry['device_class'], entry['operation'], entry['attribute'])):
+            labels = 'device_class="{}",operation="{}",attribute="{}"'.format(
+                entry['device_class'], entry['operation'], entry['attribute'])
+            cumulative = 0
+            for bound, count in entry['histogram'].items():
+                cumulative += count
+                lines.append('motor_reader_tango_call_seconds_bucket{{{},le="{}"}} {}'.format(labels, bound, cumulative))
+            lines.append('motor_reader_tango_call_seconds_sum{{{}}} {}'.format(labels, entry['total_seconds']))
+            lines.append('motor_reader_tango_call_seconds_count{{{}}} {}'.format(labels, entry['count']))
+            error_lines.append('motor_reader_tango_call_errors_total{{{}}} {}'.format(labels, entry['errors']))
+        with open(filename, 'w') as out_file:
+            out_file.write('\n'.join(lines + error_lines) + '\n')
+
+    def write(self, filename):
+        '''
+        Saves the metrics, in the Prometheus format if filename ends with
+        .prom and as JSON otherwise
+        '''
+        if filename.endswith('.prom'):
+            self.write_prometheus(filename)
+        else:
+            self.write_json(filename)
+
+
+class InstrumentedProxy(object):
+    '''
+    Wraps a DeviceProxy, recording the time taken by each call to the device
+    in metrics. Everything else is passed straight through.
+    '''
+
+    def __init__(self, dev_proxy, dev_name, metrics):
+        self._proxy = dev_proxy
+        self._device_class = device_class(dev_name)
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        value = getattr(self._proxy, name)
+        if name not in _timed_methods:
+            return value
+
+        def timed_call(*args, **kwargs):
+            start = time.perf_counter()
+            failed = True
+            try:
+                result = value(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self._metrics.record(self._device_class, name, call_attribute(name, args),
+                                     time.perf_counter() - start, failed)
+        return timed_call
@@ -0,0 +1,71 @@
+import readMotor
+from attributeSchema import coerce_to_type, parse_value
+from simulatedMotors import SimulatedFarm
+
+
+def test_parse_value():
+    assert parse_value('5.0', 'int') == 5 and isinstance(parse_value('5.0', 'int'), int)
+    assert parse_value('5', 'float') == 5.0 and isinstance(parse_value('5', 'float'), float)
+    assert parse_value('False', 'bool') is False
+    assert parse_value('1', 'bool') is True
+    assert parse_value('Phi', 'str') == 'Phi'
+    # Nothing is lost: 2.5 is not an int
+    assert coerce_to_type(2.5, 'int') == 2.5
+
+
+def test_schema_cache(tmp_path, monkeypatch):
+    cache_file = str(tmp_path / 'schema.json')
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02'}
+    farm = SimulatedFarm(extra_attributes=2)
+    monkeypatch.setattr(readMotor, '_schema_cache', None)
+    with farm.patch():
+        readMotor.enable_schema_cache(cache_file)
+        all_params = readMotor.read_motors(config, {'SIM': ['SIM.01', 'SIM.02', 'SIM.03']})
+        # Attributes listed & described once per class, not per motor
+        assert farm.calls['get_attribute_list'] == 2
+        assert farm.calls['get_attribute_config'] == 2
+        assert all_params['SIM.03']['zmx:AxisName'] == 'SIM.03'
+
+        # A new run only checks the attribute list of the first device
+        farm.reset_counts()
+        readMotor.enable_schema_cache(cache_file)
+        readMotor.read_motors(config, {'SIM': ['SIM.01', 'SIM.02', 'SIM.03']})
+        assert farm.calls['get_attribute_list'] == 2
+        assert farm.calls['get_attribute_config'] == 0
+
+        # An expired cache is read again
+        farm.reset_counts()
+        readMotor.enable_schema_cache(cache_file, ttl=-1)
+        readMotor.read_motors(config, {'SIM': ['SIM.01']})
+        assert farm.calls['get_attribute_config'] == 2
+
+    schema = readMotor._schema_cache
+    assert schema.attribute_type('oms:BaseRate') == 'float'
+    assert schema.attribute_type('oms:Acceleration') == 'int'
+    assert schema.attribute_info('oms:Diagnostic001') == {'type': 'float', 'writable': False}
+
+    # .params values are read as the type of their attribute
+    params_file = tmp_path / 'motors.params'
+    params_file.write_text('SIM.01,oms:Acceleration,5.0,oms:BaseRate,2,zmx:AxisName,Phi\n')
+    motor_params = readMotor.read_dat(str(params_file))['SIM.01']
+    assert motor_params == {'oms:Acceleration': 5, 'oms:BaseRate': 2.0, 'zmx:AxisName': 'Phi'}
+    assert isinstance(motor_params['oms:Acceleration'], int)
+    assert isinstance(motor_params['oms:BaseRate'], float)
+
+
+def test_schema_cache_per_host(tmp_path, monkeypatch):
+    farm = SimulatedFarm()
+    monkeypatch.setattr(readMotor, '_schema_cache', None)
+    with farm.patch():
+        schema = readMotor.enable_schema_cache(str(tmp_path / 'schema.json'))
+        for tango_host in ('sim:10000', 'sim2:10000'):
+            readMotor.read_motors({'tango_host': tango_host, 'beamline': 'p02'}, {'SIM': ['SIM.01']})
+    assert sorted(schema.classes) == ['sim2:10000/oms', 'sim2:10000/zmx', 'sim:10000/oms', 'sim:10000/zmx']
+    assert schema.attribute_type('oms:BaseRate') == 'float'
+
+    # A newer device server on one host changed the type
+    schema.classes['sim2:10000/oms']['attributes']['BaseRate']['type'] = 'int'
+    assert schema.attribute_type('oms:BaseRate', 'sim:10000') == 'float'
+    assert schema.attribute_type('oms:BaseRate', 'sim2:10000') == 'int'
+    # Without a host we can't tell which applies
+    assert schema.attribute_type('oms:BaseRate') is None
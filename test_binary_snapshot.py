@@ -0,0 +1,41 @@
+import math
+
+from binarySnapshot import (BinarySnapshot, write_binary_snapshot,
+                            read_binary_snapshot, params_to_binary,
+                            binary_to_params)
+
+
+def test_binary_snapshot_round_trip(tmp_path):
+    snap_file = str(tmp_path / 'motors.snap')
+    all_params = {'EH1A.03': {'oms:Conversion': 1.0, 'oms:StepLimitMax': 43,
+                              'zmx:AxisName': 'Phi', 'oms:FlagProtected': False},
+                  'EH1A.01': {'oms:Conversion': 4.3, 'oms:StepLimitMax': math.nan,
+                              'zmx:AxisName': 'Chi'}}
+    write_binary_snapshot(all_params, snap_file)
+
+    with BinarySnapshot(snap_file) as snapshot:
+        assert snapshot.motors == ['EH1A.01', 'EH1A.03']
+        assert list(snapshot.column('oms:Conversion')) == [4.3, 1.0]
+        assert snapshot.value('EH1A.03', 'zmx:AxisName') == 'Phi'
+        assert snapshot.value('EH1A.03', 'oms:FlagProtected') is False
+
+    read_params = read_binary_snapshot(snap_file)
+    assert math.isnan(read_params['EH1A.01'].pop('oms:StepLimitMax'))
+    del all_params['EH1A.01']['oms:StepLimitMax']
+    assert read_params == all_params
+    # Types are kept, even when ints share a column with floats
+    assert isinstance(read_params['EH1A.03']['oms:StepLimitMax'], int)
+
+
+def test_params_conversion_is_lossless(tmp_path):
+    params_file = tmp_path / 'motors-20190414_235205.params'
+    params_text = ('EH1A.01,oms:attr1,4.3,oms:attr2,nan,oms:attr3,True,zmx:AxisName,Chi\n'
+                   'EH1A.03,oms:attr1,1,oms:attr2,43,oms:attr3,False,zmx:AxisName,Phi\n')
+    params_file.write_text(params_text)
+
+    params_to_binary(str(params_file), str(tmp_path / 'motors.snap'))
+    binary_to_params(str(tmp_path / 'motors.snap'), str(tmp_path / 'out.params'),
+                     str(tmp_path / 'out_reduced.params'), ['oms:attr1'])
+
+    assert (tmp_path / 'out.params').read_text() == params_text
+    assert (tmp_path / 'out_reduced.params').read_text() == 'EH1A.01,oms:attr1,4.3\nEH1A.03,oms:attr1,1\n'
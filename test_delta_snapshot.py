@@ -0,0 +1,52 @@
+import os
+
+import pytest
+
+from readMotor import make_snapshot_writer, read_dat, write_dat
+from deltaSnapshot import DeltaStore, snapshot_delta
+
+
+def test_snapshot_delta():
+    old = {'EH1A.01': {'oms:attr1': 4, 'oms:attr2': 7.5},
+           'EH1A.02': {'oms:attr1': 1}}
+    new = {'EH1A.01': {'oms:attr1': 4, 'oms:attr2': 8.0},
+           'EH1A.03': {'oms:attr1': 2}}
+    assert snapshot_delta(old, new) == [['EH1A.02'],
+                                        ['EH1A.01', 'oms:attr2', 8.0],
+                                        ['EH1A.03', {'oms:attr1': 2}]]
+
+
+def test_delta_store(tmp_path, monkeypatch):
+    store = DeltaStore(str(tmp_path / 'store'), keyframe_interval=3, compress=True)
+    snapshots = {}
+    for hour in range(5):
+        all_params = {'EH1A.{:02d}'.format(i): {'oms:Position': float(i * hour), 'oms:Conversion': 100,
+                                                'zmx:AxisName': 'Axis{}'.format(i), 'zmx:RunCurrent': 3}
+                      for i in range(1, 5)}
+        if hour == 3:
+            del all_params['EH1A.04']
+            all_params['EH1A.01']['zmx:RunCurrent'] = float('nan')
+        stamp = '20190401_{:02d}0000'.format(hour)
+        store.add_snapshot(all_params, stamp)
+        snapshots[stamp] = all_params
+
+    assert [kind for _, kind, _ in store.entries()] == ['key', 'delta', 'delta', 'key', 'delta']
+    # Only the changes are stored in a delta
+    assert len(store._read_entries('motors-20190401_010000.delta.z')) == 4
+
+    # Reconstructed snapshots match what read_dat gives for the .params file
+    monkeypatch.chdir(tmp_path)
+    for stamp, all_params in snapshots.items():
+        write_dat(all_params, [])
+        params_file = [f for f in os.listdir('.') if f.endswith('.params') and not f.endswith('_reduced.params')][0]
+        assert store.read(stamp) == read_dat(params_file)
+        os.remove(params_file)
+        os.remove(params_file.replace('.params', '_reduced.params'))
+
+    assert store.read('20190401_023000') == store.read('20190401_020000')
+
+
+def test_delta_store_cannot_resume(tmp_path):
+    config = {'delta_store': str(tmp_path / 'store'), 'resume': str(tmp_path / 'motors.params.part')}
+    with pytest.raises(SystemExit):
+        make_snapshot_writer(config)
@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+import readMotor
+from deviceDiscovery import DeviceDiscovery, pair_devices
+from simulatedMotors import SimulatedFarm
+
+
+def test_pair_devices():
+    # Device names are not case sensitive
+    servers, unpaired = pair_devices(['p02/motor/EH1A.02', 'p02/motor/EH1A.01', 'p02/motor/EH1B.01'],
+                                     ['p02/ZMX/eh1a.01', 'p02/zmx/EH1A.02', 'p02/ZMX/EH1A.03'])
+    assert servers == {'EH1A': ['EH1A.01', 'EH1A.02']}
+    assert unpaired == ['p02/ZMX/EH1A.03', 'p02/motor/EH1B.01']
+
+
+def test_discovery_cache(tmp_path):
+    farm = SimulatedFarm()
+    farm.export_motors('p02', 'EH1A', 3)
+    farm.export_motors('p02', 'EH1B', 2)
+    cache_file = str(tmp_path / 'devices.json')
+    with farm.patch():
+        discovery = DeviceDiscovery(cache_file, ttl=3600)
+        assert discovery.servers('sim:10000', 'p02') == {'EH1A': ['EH1A.01', 'EH1A.02', 'EH1A.03'],
+                                                         'EH1B': ['EH1B.01', 'EH1B.02']}
+        assert farm.calls['get_device_exported'] == 2
+
+        # Another run uses the cached result...
+        farm.exported_devices.discard('p02/ZMX/EH1A.03')
+        assert DeviceDiscovery(cache_file, ttl=3600).servers('sim:10000', 'p02')['EH1A'] == \
+            ['EH1A.01', 'EH1A.02', 'EH1A.03']
+        assert farm.calls['get_device_exported'] == 2
+        # ...until it is too old
+        assert DeviceDiscovery(cache_file, ttl=0).servers('sim:10000', 'p02')['EH1A'] == ['EH1A.01', 'EH1A.02']
+        assert farm.calls['get_device_exported'] == 4
+
+    with open(cache_file) as stored:
+        assert list(json.load(stored)['locations']) == ['sim:10000/p02']
+
+
+def test_discovered_device_names(monkeypatch):
+    farm = SimulatedFarm()
+    farm.export_motors('p02', 'EH1A', 3)
+    farm.export_motors('p02', 'EH1C', 1)
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'EH1A', 'dev_ids': None}
+    with farm.patch():
+        monkeypatch.setattr(readMotor, '_discovery', None)
+        readMotor.enable_discovery()
+        assert readMotor.device_names(config) == {'EH1A': ['EH1A.01', 'EH1A.02', 'EH1A.03']}
+        # Motors which don't exist are left out
+        assert readMotor.device_names(dict(config, dev_ids=[2, 5])) == {'EH1A': ['EH1A.02']}
+        targets = readMotor.sweep_targets(dict(config, server='all'))
+        assert [target['server'] for target in targets] == ['EH1A', 'EH1C']
+
+        all_motor_params = readMotor.read_sweep(targets)
+    assert list(all_motor_params) == ['EH1A.01', 'EH1A.02', 'EH1A.03', 'EH1C.01']
+
+
+def test_discovery_falls_back(monkeypatch):
+    # No Tango database to ask
+    monkeypatch.setattr('deviceDiscovery.Database', None)
+    monkeypatch.setattr(readMotor, '_discovery', None)
+    readMotor.enable_discovery()
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'EH1B', 'dev_ids': None}
+    assert readMotor.device_names(config) == readMotor.generate_device_names('EH1B')
+
+
+def test_discovered_names_are_not_case_sensitive(monkeypatch):
+    farm = SimulatedFarm()
+    farm.exported_devices.update({'p02/motor/eh1a.01', 'p02/zmx/eh1a.01', 'p02/motor/EH1A.02', 'p02/ZMX/eh1a.02'})
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'EH1A', 'dev_ids': None}
+    with farm.patch():
+        monkeypatch.setattr(readMotor, '_discovery', None)
+        readMotor.enable_discovery()
+        assert readMotor.device_names(config) == {'EH1A': ['EH1A.01', 'EH1A.02']}
+        assert readMotor.device_names(dict(config, server='eh1a', dev_ids=[2])) == {'EH1A': ['EH1A.02']}
+
+
+def test_offline_compare_skips_discovery(tmp_path, monkeypatch):
+    farm = SimulatedFarm()
+    (tmp_path / 'input.params').write_text('EH1A.01,oms:attr1,4.3\n')
+    (tmp_path / 'current.params').write_text('EH1A.01,oms:attr1,4.3\n')
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'EH1A', 'dev_ids': [1], 'selection': None,
+              'write_params': False, 'compare_params': True, 'input_file': str(tmp_path / 'input.params'),
+              'compare_against': str(tmp_path / 'current.params')}
+    with farm.patch():
+        monkeypatch.setattr(readMotor, '_discovery', None)
+        readMotor.enable_discovery()
+        result = readMotor.run(config)
+    assert result['compare_summary']['same_motors'] == ['EH1A.01']
+    # No Tango access at all
+    assert sum(farm.calls.values()) == 0
+
+
+def test_write_refreshes_discovery(tmp_path, monkeypatch, capsys):
+    farm = SimulatedFarm()
+    farm.export_motors('p02', 'EH1A', 1)
+    (tmp_path / 'new.params').write_text('EH1A.01,oms:SlewRate,111\nEH1A.02,oms:SlewRate,222\n')
+    monkeypatch.setattr(readMotor, '_reduced_attr', ['oms:SlewRate'])
+    monkeypatch.chdir(tmp_path)
+    with farm.patch():
+        monkeypatch.setattr(readMotor, '_discovery', None)
+        readMotor.enable_discovery(str(tmp_path / 'devices.json'), ttl=3600)
+        assert readMotor.device_names({'tango_host': 'haspp02oh1:10000', 'beamline': 'p02', 'server': 'EH1A',
+                                       'dev_ids': None}) == {'EH1A': ['EH1A.01']}
+
+        # EH1A.02 was down when the cached discovery was made
+        farm.export_motors('p02', 'EH1A', 2)
+        result = readMotor.run(readMotor.parse_args(['-s', 'EH1A', '--write', 'new.params']))
+        assert result['write_summary']['committed'] == ['EH1A.01', 'EH1A.02']
+
+        # A motor which really doesn't exist
+        (tmp_path / 'new.params').write_text('EH1A.03,oms:SlewRate,333\n')
+        with pytest.raises(SystemExit):
+            readMotor.run(readMotor.parse_args(['-s', 'EH1A', '--write', 'new.params']))
+    assert 'Discovery did not find these motors of the input file on haspp02oh1:10000' in capsys.readouterr().out
+
+
+def test_no_servers_found(monkeypatch, capsys):
+    farm = SimulatedFarm()
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'all', 'dev_ids': None}
+    with farm.patch():
+        monkeypatch.setattr(readMotor, '_discovery', None)
+        readMotor.enable_discovery()
+        assert readMotor.run(config) == {}
+    assert 'No motors found on sim:10000' in capsys.readouterr().out
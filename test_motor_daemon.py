@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+from mock import patch
+
+import readMotor
+from motorClient import send_request
+from motorDaemon import MotorLocks, MotorService, make_server
+from simulatedMotors import SimulatedFarm
+
+
+@pytest.fixture
+def daemon():
+    farm = SimulatedFarm()
+    with farm.patch():
+        server = make_server('127.0.0.1:0', MotorService())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        yield farm, '127.0.0.1:{}'.format(server.server_address[1])
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def test_daemon_read_and_write(daemon, tmp_path):
+    farm, address = daemon
+    response = send_request({'args': ['-s', 'SIM', '1,2'], 'cwd': str(tmp_path)}, address)
+    assert response['ok']
+    assert response['result']['motors'] == ['SIM.01', 'SIM.02']
+    params_filename = response['result']['snapshot'][0]
+    assert params_filename.startswith(str(tmp_path))
+
+    # The proxies stay warm for the next request
+    farm.reset_counts()
+    (tmp_path / 'new.params').write_text('SIM.02,oms:SlewRate,777\n')
+    response = send_request({'args': ['-s', 'SIM', '--write', 'new.params', '2'], 'cwd': str(tmp_path)}, address)
+    assert response['result']['write_summary']['committed'] == ['SIM.02']
+    assert farm.calls['DeviceProxy'] == 0
+    assert farm.devices['haspp02oh1:10000/p02/motor/SIM.02'].attributes['SlewRate'] == 777
+
+    assert send_request({'command': 'status'}, address)['result']['proxies'] == 4
+
+
+def test_daemon_errors(daemon):
+    _, address = daemon
+    response = send_request({'args': ['--jobs', 'many']}, address)
+    assert not response['ok']
+    assert 'invalid int value' in response['error']
+
+    # Options which set up the daemon itself can't be given per request
+    response = send_request({'args': ['-s', 'SIM', '--metrics', 'metrics.json', '--no-discover']}, address)
+    assert not response['ok']
+    assert response['error'] == '--metrics, --no-discover can only be given when starting the daemon'
+
+
+def test_motor_locks_serialise_writes():
+    locks = MotorLocks()
+    config = {'beamline': 'p02', 'tango_host': 'sim:10000', 'motor_locks': locks}
+    farm = SimulatedFarm()
+    with farm.patch(), patch('readMotor._reduced_attr', ['oms:SlewRate']):
+        with locks.lock_for(readMotor.oms_device_name(config, 'SIM.01')):
+            thread = threading.Thread(target=readMotor.write_motor, args=(config, 'SIM.01', {'oms:SlewRate': 5}))
+            thread.start()
+            thread.join(0.05)
+            # Waits for the other writer to finish
+            assert thread.is_alive()
+            assert farm.calls['write_attributes'] == 0
+        thread.join()
+    assert farm.calls['write_attributes'] == 1
@@ -0,0 +1,41 @@
+import math
+
+from motorSnapshot import AttributeIndex, FleetSnapshot, MotorSnapshot
+
+
+def test_motor_snapshot():
+    index = AttributeIndex()
+    params = MotorSnapshot(index, {'zmx:RunCurrent': 3, 'oms:Position': math.nan, 'zmx:AxisName': 'Phi',
+                                   'oms:Conversion': 0.1, 'oms:Flag': True, 'oms:Steps': 2 ** 60})
+
+    # Behaves as the dictionary it replaces, but is always in order
+    assert list(params) == ['oms:Conversion', 'oms:Flag', 'oms:Position', 'oms:Steps', 'zmx:AxisName',
+                            'zmx:RunCurrent']
+    assert params['zmx:RunCurrent'] == 3 and isinstance(params['zmx:RunCurrent'], int)
+    assert params['oms:Flag'] is True
+    assert params['oms:Steps'] == 2 ** 60
+    assert params.get('zmx:StopCurrent') is None
+    assert params.nan_labels() == ['oms:Position']
+
+    del params['oms:Position']
+    params['oms:Acceleration'] = 5
+    assert params == {'oms:Acceleration': 5, 'oms:Conversion': 0.1, 'oms:Flag': True, 'oms:Steps': 2 ** 60,
+                      'zmx:AxisName': 'Phi', 'zmx:RunCurrent': 3}
+    assert len(params) == 6
+    assert 'oms:Position' not in params
+
+
+def test_fleet_snapshot():
+    fleet = FleetSnapshot()
+    fleet['EH1A.02'] = {'oms:Conversion': 2.0}
+    fleet['EH1A.01'] = {'oms:Conversion': 1.0, 'oms:Acceleration': 4}
+
+    assert list(fleet) == ['EH1A.01', 'EH1A.02']
+    assert isinstance(fleet['EH1A.02'], MotorSnapshot)
+    # All the motors share the labels
+    assert fleet['EH1A.01'].index is fleet['EH1A.02'].index
+    assert fleet.index.labels == ['oms:Conversion', 'oms:Acceleration']
+    assert list(fleet['EH1A.01']) == ['oms:Acceleration', 'oms:Conversion']
+
+    del fleet['EH1A.01']
+    assert fleet == {'EH1A.02': {'oms:Conversion': 2.0}}
@@ -1,8 +1,30 @@
+import json
+import math
+import os
+import threading
+import time
+
+from datetime import datetime
+
 import pytest
-from mock import call, Mock, patch
+from mock import ANY, call, Mock, patch
+
+from motorSnapshot import FleetSnapshot
+from readMotor import (parse_args, read_parameters, read_attribute_values,
+                       write_parameters, write_motor, RetryPolicy,
+                       generate_device_names, read_dat, index_dat,
+                       write_dat, SnapshotWriter, read_motors, write_motors, main, get_proxy, evict_proxy,
+                       clear_proxy_pool, compare_parameters, write_diff_json, sweep_targets, AdaptiveLimiter,
+                       attribute_source, WriteJournal, coerce_value, run, new_snapshot_filenames,
+                       _device_cache)
+
 
-from readMotor import (parse_args, read_parameters, write_parameters,
-                       generate_device_names, read_dat, write_dat, main)
+@pytest.fixture(autouse=True)
+def empty_proxy_pool():
+    # DeviceProxys are shared between tests otherwise
+    clear_proxy_pool()
+    yield
+    clear_proxy_pool()
 
 
 def test_parse_args():
@@ -10,6 +32,40 @@ def test_parse_args():
     eg_conf1 = {'beamline': 'p02',
                 'tango_host': 'haspp02oh1:10000',
                 'server': 'EH1A',
+                'chunk_size': None,
+                'jobs': 1,
+                'prewarm': False,
+                'only_changed': False,
+                'retries': 3,
+                'write_deadline': None,
+                'resume': None,
+                'rollback': None,
+                'binary': False,
+                'delta_store': None,
+                'keyframe_interval': 24,
+                'compress': False,
+                'compare_against': None,
+                'tolerances': None,
+                'diff_json': None,
+                'diff_csv': None,
+                'host_jobs': None,
+                'probe': False,
+                'probe_timeout': 500,
+                'motor_budget': None,
+                'schema_cache': None,
+                'schema_ttl': 86400,
+                'watch': False,
+                'watch_interval': 10,
+                'watch_log': 'motor-changes.log',
+                'adaptive': None,
+                'metrics': None,
+                'discover': True,
+                'device_cache': _device_cache,
+                'device_ttl': 3600,
+                'shards': None,
+                'shard_hosts': None,
+                'read_source': None,
+                'selection': None,
                 'dev_ids': [1],
                 'compare_params': False,
                 'write_params': False}
@@ -22,6 +78,40 @@ def test_parse_args():
     eg_conf2 = {'beamline': 'p02',
                 'tango_host': 'haspp02oh1:10000',
                 'server': 'EH1A',
+                'chunk_size': None,
+                'jobs': 1,
+                'prewarm': False,
+                'only_changed': False,
+                'retries': 3,
+                'write_deadline': None,
+                'resume': None,
+                'rollback': None,
+                'binary': False,
+                'delta_store': None,
+                'keyframe_interval': 24,
+                'compress': False,
+                'compare_against': None,
+                'tolerances': None,
+                'diff_json': None,
+                'diff_csv': None,
+                'host_jobs': None,
+                'probe': False,
+                'probe_timeout': 500,
+                'motor_budget': None,
+                'schema_cache': None,
+                'schema_ttl': 86400,
+                'watch': False,
+                'watch_interval': 10,
+                'watch_log': 'motor-changes.log',
+                'adaptive': None,
+                'metrics': None,
+                'discover': True,
+                'device_cache': _device_cache,
+                'device_ttl': 3600,
+                'shards': None,
+                'shard_hosts': None,
+                'read_source': None,
+                'selection': None,
                 'dev_ids': [12, 15, 32],
                 'compare_params': False,
                 'write_params': False}
@@ -32,6 +122,40 @@ def test_parse_args():
     eg_conf3 = {'beamline': 'p02',
                 'tango_host': 'haspp02oh1:10000',
                 'server': 'EH1A',
+                'chunk_size': None,
+                'jobs': 1,
+                'prewarm': False,
+                'only_changed': False,
+                'retries': 3,
+                'write_deadline': None,
+                'resume': None,
+                'rollback': None,
+                'binary': False,
+                'delta_store': None,
+                'keyframe_interval': 24,
+                'compress': False,
+                'compare_against': None,
+                'tolerances': None,
+                'diff_json': None,
+                'diff_csv': None,
+                'host_jobs': None,
+                'probe': False,
+                'probe_timeout': 500,
+                'motor_budget': None,
+                'schema_cache': None,
+                'schema_ttl': 86400,
+                'watch': False,
+                'watch_interval': 10,
+                'watch_log': 'motor-changes.log',
+                'adaptive': None,
+                'metrics': None,
+                'discover': True,
+                'device_cache': _device_cache,
+                'device_ttl': 3600,
+                'shards': None,
+                'shard_hosts': None,
+                'read_source': None,
+                'selection': None,
                 'dev_ids': None,
                 'compare_params': False,
                 'write_params': False}
@@ -42,6 +166,40 @@ def test_parse_args():
     eg_conf4 = {'beamline': 'p02',
                 'tango_host': 'haspp02oh1:10000',
                 'server': 'EH1A',
+                'chunk_size': None,
+                'jobs': 1,
+                'prewarm': False,
+                'only_changed': False,
+                'retries': 3,
+                'write_deadline': None,
+                'resume': None,
+                'rollback': None,
+                'binary': False,
+                'delta_store': None,
+                'keyframe_interval': 24,
+                'compress': False,
+                'compare_against': None,
+                'tolerances': None,
+                'diff_json': None,
+                'diff_csv': None,
+                'host_jobs': None,
+                'probe': False,
+                'probe_timeout': 500,
+                'motor_budget': None,
+                'schema_cache': None,
+                'schema_ttl': 86400,
+                'watch': False,
+                'watch_interval': 10,
+                'watch_log': 'motor-changes.log',
+                'adaptive': None,
+                'metrics': None,
+                'discover': True,
+                'device_cache': _device_cache,
+                'device_ttl': 3600,
+                'shards': None,
+                'shard_hosts': None,
+                'read_source': None,
+                'selection': None,
                 'dev_ids': None,
                 'compare_params': False,
                 'write_params': True,
@@ -73,17 +231,73 @@ def test_read_motor_parameters():
 
     for dp in [oms_dp_mock, zmx_dp_mock]:
         dp.get_attribute_list.return_value = ['attr1', 'attr2']
-        dp.read_attribute().value = 4
+        dp.read_attributes.return_value = [Mock(value=4, has_failed=False),
+                                           Mock(value=4, has_failed=False)]
 
     motor_dict = read_parameters(oms_dp_mock, zmx_dp_mock)
 
     assert motor_dict == {'oms:attr1': 4, 'oms:attr2': 4,
                           'zmx:attr1': 4, 'zmx:attr2': 4}
+    # All attributes of each device should be fetched in one call
+    oms_dp_mock.read_attributes.assert_called_once_with(['attr1', 'attr2'])
+    zmx_dp_mock.read_attributes.assert_called_once_with(['attr1', 'attr2'])
+    oms_dp_mock.read_attribute.assert_not_called()
+
+
+def test_read_motor_parameters_selected():
+    oms_dp_mock = Mock()
+    zmx_dp_mock = Mock()
+
+    for dp in [oms_dp_mock, zmx_dp_mock]:
+        dp.get_attribute_list.return_value = ['RunCurrent', 'StopCurrent', 'Position']
+        dp.read_attributes.side_effect = lambda names: [Mock(value=len(n), has_failed=False) for n in names]
+
+    # Explicit names don't need the attribute list
+    motor_dict = read_parameters(oms_dp_mock, zmx_dp_mock, selection=['oms:Position'])
+    assert motor_dict == {'oms:Position': 8}
+    oms_dp_mock.get_attribute_list.assert_not_called()
+    zmx_dp_mock.read_attributes.assert_not_called()
+
+    # Patterns are matched against the attribute list
+    motor_dict = read_parameters(oms_dp_mock, zmx_dp_mock, selection=['zmx:*Current', 'oms:Position'])
+    assert motor_dict == {'oms:Position': 8, 'zmx:RunCurrent': 10, 'zmx:StopCurrent': 11}
+
+
+class FakeDevFailed(Exception):
+    pass
+
+
+@patch('readMotor.DevFailed', FakeDevFailed, create=True)
+def test_read_attribute_values():
+    dp_mock = Mock()
+    dp_mock.read_attributes.side_effect = lambda names: [Mock(value=names.index(n), has_failed=(n == 'bad')) for n in names]
+
+    # Chunks of two attributes, with one failed read becoming nan
+    values = read_attribute_values(dp_mock, ['a', 'b', 'bad', 'd', 'e'], chunk_size=2)
+    assert values[:2] == [0, 1]
+    assert math.isnan(values[2])
+    assert values[3:] == [1, 0]
+    assert dp_mock.read_attributes.call_count == 3
+
+    # If the whole batch fails, we fall back to single reads
+    dp_mock.reset_mock()
+    dp_mock.read_attributes.side_effect = UnicodeDecodeError('utf-8', b'', 0, 1, 'bad')
+    dp_mock.read_attribute.side_effect = [Mock(value=7), FakeDevFailed()]
+    values = read_attribute_values(dp_mock, ['a', 'bad'])
+    assert values[0] == 7
+    assert math.isnan(values[1])
+
+
+def reads_as(value):
+    # Side effect for read_attributes, returning value for every attribute
+    return lambda names: [Mock(value=value, has_failed=False) for _ in names]
 
 
 def test_write_motor_parameters():
     oms_dp_mock = Mock()
     zmx_dp_mock = Mock()
+    oms_dp_mock.read_attributes.side_effect = reads_as(0)
+    zmx_dp_mock.read_attributes.side_effect = reads_as(0)
     zmx_dp_mock.WriteEPROM.return_value = 1
 
     motor_params = {'oms:oattr1': 2, 'oms:oattr2': 6,
@@ -91,20 +305,108 @@ def test_write_motor_parameters():
 
     write_parameters(oms_dp_mock, zmx_dp_mock, motor_params, reduced_params_list=['oms:oattr1', 'oms:oattr2', 'zmx:zattra', 'zmx:zattrb'])
 
-    oms_calls = [call('oattr1', 2), call('oattr2', 6)]
-    zmx_calls = [call('zattra', 24), call('zattrb', 10)]
-    oms_dp_mock.write_attribute.assert_has_calls(oms_calls)
-    zmx_dp_mock.write_attribute.assert_has_calls(zmx_calls)
-    assert zmx_dp_mock.write_attribute.call_count == 2
+    # Old values are read, and new values written, in one call per device
+    oms_dp_mock.read_attributes.assert_called_once_with(['oattr1', 'oattr2'])
+    oms_dp_mock.write_attributes.assert_called_once_with([('oattr1', 2), ('oattr2', 6)])
+    zmx_dp_mock.write_attributes.assert_called_once_with([('zattra', 24), ('zattrb', 10)])
+    oms_dp_mock.write_attribute.assert_not_called()
+    zmx_dp_mock.write_attribute.assert_not_called()
 
     # Try again with a reduced parameter list
     oms_dp_mock.reset_mock()
     zmx_dp_mock.reset_mock()
     write_parameters(oms_dp_mock, zmx_dp_mock, motor_params, reduced_params_list=['oms:oattr1', 'oms:oattr2', 'zmx:zattra'])
-    zmx_calls_2 = [call('zattra', 24)]
-    oms_dp_mock.write_attribute.assert_has_calls(oms_calls)
-    zmx_dp_mock.write_attribute.assert_has_calls(zmx_calls_2)
-    assert zmx_dp_mock.write_attribute.call_count == 1
+    oms_dp_mock.write_attributes.assert_called_once_with([('oattr1', 2), ('oattr2', 6)])
+    zmx_dp_mock.write_attributes.assert_called_once_with([('zattra', 24)])
+
+    # Values are converted to the type of the attribute
+    oms_dp_mock.reset_mock()
+    oms_dp_mock.read_attributes.side_effect = reads_as(1.5)
+    write_parameters(oms_dp_mock, zmx_dp_mock, {'oms:oattr1': 2}, reduced_params_list=['oms:oattr1'])
+    written = oms_dp_mock.write_attributes.call_args[0][0]
+    assert written == [('oattr1', 2.0)] and isinstance(written[0][1], float)
+
+
+def test_coerce_value():
+    assert coerce_value(3, 2.5) == 3.0 and isinstance(coerce_value(3, 2.5), float)
+    assert coerce_value(3.0, 2) == 3 and isinstance(coerce_value(3.0, 2), int)
+    # An unreadable current value says nothing about the type...
+    assert isinstance(coerce_value(3, math.nan), int)
+    # ...but the schema does
+    assert isinstance(coerce_value(3, math.nan, 'float'), float)
+
+
+def test_write_parameters_retry():
+    oms_dp_mock = Mock()
+    zmx_dp_mock = Mock()
+    oms_dp_mock.read_attributes.side_effect = reads_as(0)
+    zmx_dp_mock.WriteEPROM.return_value = 1
+    # The batch write fails, so attributes are written individually. Second
+    # attribute fails once, then succeeds
+    oms_dp_mock.write_attributes.side_effect = Exception('Transient CORBA error')
+    oms_dp_mock.write_attribute.side_effect = [None, Exception('Transient CORBA error'), None]
+    motor_params = {'oms:oattr1': 2, 'oms:oattr2': 6}
+
+    write_parameters(oms_dp_mock, zmx_dp_mock, motor_params, reduced_params_list=['oms:oattr1', 'oms:oattr2'],
+                     retry_policy=RetryPolicy(attempts=2, backoff=0))
+
+    # Only the failing attribute is written again
+    oms_dp_mock.write_attribute.assert_has_calls([call('oattr1', 2), call('oattr2', 6), call('oattr2', 6)])
+    assert oms_dp_mock.write_attribute.call_count == 3
+    zmx_dp_mock.WriteEPROM.assert_called_once_with()
+
+    # When retries run out, the error is passed on
+    oms_dp_mock.reset_mock()
+    oms_dp_mock.write_attribute.side_effect = Exception('Persistent CORBA error')
+    with pytest.raises(Exception, match='Persistent'):
+        write_parameters(oms_dp_mock, zmx_dp_mock, motor_params, reduced_params_list=['oms:oattr1'],
+                         raise_errors=True, retry_policy=RetryPolicy(attempts=3, backoff=0))
+    assert oms_dp_mock.write_attribute.call_count == 3
+
+
+@patch('readMotor.time')
+def test_retry_policy_deadline(time_mock):
+    time_mock.monotonic.return_value = 100.0
+    policy = RetryPolicy(attempts=5, backoff=1, jitter=0, deadline=2.5)
+    func = Mock(side_effect=Exception('Timeout'))
+
+    # Retries after 1s and 2s would end after the 2.5s deadline
+    deadline = policy.deadline_from_now()
+    time_mock.sleep.side_effect = lambda delay: setattr(time_mock.monotonic, 'return_value', time_mock.monotonic.return_value + delay)
+    with pytest.raises(Exception):
+        policy.run(func, deadline=deadline)
+    assert func.call_count == 2
+
+
+def test_write_motor_only_changed(monkeypatch):
+    oms_dp_mock = Mock()
+    zmx_dp_mock = Mock()
+    current = {'oattr1': 2.0000000000001, 'oattr2': 5, 'zattra': 24, 'DelayTime': 4}
+    for dp in [oms_dp_mock, zmx_dp_mock]:
+        dp.read_attributes.side_effect = lambda names: [Mock(value=current[n], has_failed=False) for n in names]
+    zmx_dp_mock.WriteEPROM.return_value = 1
+    monkeypatch.setattr('readMotor._reduced_attr', ['oms:oattr1', 'oms:oattr2', 'zmx:zattra', 'zmx:DelayTime'])
+    monkeypatch.setattr('readMotor.get_motor_proxies', lambda config, motor: (oms_dp_mock, zmx_dp_mock))
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'only_changed': True}
+
+    # Only oattr2 differs. Nothing changed on the ZMX, so no EPROM write
+    outcome = write_motor(config, 'EH1A.01', {'oms:oattr1': 2.0, 'oms:oattr2': 6, 'zmx:zattra': 24, 'zmx:DelayTime': 4})
+    assert outcome == 'committed'
+    oms_dp_mock.write_attributes.assert_called_once_with([('oattr2', 6)])
+    zmx_dp_mock.write_attributes.assert_not_called()
+    zmx_dp_mock.WriteEPROM.assert_not_called()
+    # The old values are only read once
+    assert oms_dp_mock.read_attributes.call_count == 1
+
+    # DelayTime is compared as read, but written mapped
+    oms_dp_mock.reset_mock()
+    outcome = write_motor(config, 'EH1A.01', {'oms:oattr1': 2.0, 'zmx:DelayTime': 10})
+    assert outcome == 'committed'
+    oms_dp_mock.write_attributes.assert_not_called()
+    zmx_dp_mock.write_attributes.assert_called_once_with([('DelayTime', 5)])
+    zmx_dp_mock.WriteEPROM.assert_called_once_with()
+
+    assert write_motor(config, 'EH1A.01', {'oms:oattr1': 2.0}) == 'unchanged'
 
 
 @patch('readMotor.file_reader')
@@ -123,6 +425,33 @@ def test_read_dat_file(file_read_mock):
                           }
 
 
+def test_read_dat_lazy(tmp_path):
+    params_file = tmp_path / 'motors.params'
+    params_file.write_text('EH1A.01,oms:attr1,4.3,oms:attr2,nan,zmx:AxisName,nan,zmx:attr2,1e-05,,,\n'
+                           'EH1A.03,oms:attr1,1.0,oms:attr2,43,zmx:AxisName,Phi,zmx:attr2,-793\n'
+                           'EH1A.01,oms:attr1,5.5,oms:attr2,inf,zmx:AxisName,Chi,zmx:attr2,+12\n')
+    expected = {'EH1A.01': {'oms:attr1': 5.5, 'oms:attr2': math.inf,
+                            'zmx:AxisName': 'Chi', 'zmx:attr2': 12},
+                'EH1A.03': {'oms:attr1': 1.0, 'oms:attr2': 43,
+                            'zmx:AxisName': 'Phi', 'zmx:attr2': -793}}
+
+    # Later lines for a motor replace earlier ones
+    assert read_dat(str(params_file)) == expected
+    index = index_dat(str(params_file))
+    assert list(index.keys()) == ['EH1A.01', 'EH1A.03']
+
+    lazy_params = read_dat(str(params_file), lazy=True)
+    assert sorted(lazy_params.keys()) == ['EH1A.01', 'EH1A.03']
+    assert lazy_params._parsed == {}
+    assert lazy_params['EH1A.03'] == expected['EH1A.03']
+    assert list(lazy_params._parsed.keys()) == ['EH1A.03']
+    assert lazy_params == expected
+
+    # NaNs are dropped, except for AxisName which is a string
+    params_file.write_text('EH1A.01,oms:attr1,4.3,oms:attr2,nan,zmx:AxisName,nan\n')
+    assert read_dat(str(params_file)) == {'EH1A.01': {'oms:attr1': 4.3, 'zmx:AxisName': 'nan'}}
+
+
 @patch('readMotor.datetime')
 @patch('readMotor.file_writer')
 def test_write_dat_file(file_write_mock, date_mock):
@@ -152,7 +481,31 @@ def test_write_dat_file(file_write_mock, date_mock):
     file_write_mock.assert_has_calls(file_writer_calls)
 
 
-@patch('readMotor.write_dat')
+def test_snapshot_writer(tmp_path):
+    params_file = str(tmp_path / 'motors-20190414_235205.params')
+    reduced_file = str(tmp_path / 'motors-20190414_235205_reduced.params')
+    reduced_attr = ['oms:attr1']
+
+    # The run dies after the first motor and half of the second line
+    writer = SnapshotWriter(params_file, reduced_file, reduced_attr)
+    writer.write_motor('EH1A.01', {'oms:attr1': 4, 'oms:attr2': 7})
+    writer.out_files[0].write('EH1A.02,oms:att')
+    writer.close(complete=False)
+    assert not (tmp_path / 'motors-20190414_235205.params').exists()
+
+    # On resume, only the complete motor is kept
+    with SnapshotWriter.resume(params_file + '.part', reduced_attr) as writer:
+        assert writer.done_motors == {'EH1A.01'}
+        writer.write_motor('EH1A.02', {'oms:attr1': 1, 'oms:attr2': 43})
+
+    with open(params_file) as in_file:
+        assert in_file.read() == 'EH1A.01,oms:attr1,4,oms:attr2,7\nEH1A.02,oms:attr1,1,oms:attr2,43\n'
+    with open(reduced_file) as in_file:
+        assert in_file.read() == 'EH1A.01,oms:attr1,4\nEH1A.02,oms:attr1,1\n'
+    assert not (tmp_path / 'motors-20190414_235205.params.part').exists()
+
+
+@patch('readMotor.SnapshotWriter')
 @patch('readMotor.read_parameters')
 @patch('readMotor.DeviceProxy')
 @patch('readMotor.parse_args')
@@ -170,18 +523,20 @@ def test_main(args_p_mock, dp_mock, read_params_mock, writer_mock):
     main()
     dp_mock.assert_has_calls([call('haspp02oh1:10000/p02/motor/EH1A.01'),
                               call('haspp02oh1:10000/p02/ZMX/EH1A.01')])
-    writer_mock.assert_called_with({'EH1A.01': {'oms:attr1': 4, 'oms:attr2': 4,
-                                                'zmx:attr1': 4, 'zmx:attr2': 4},
-                                    'EH1A.03': {'oms:attr1': 4, 'oms:attr2': 4,
-                                                'zmx:attr1': 4, 'zmx:attr2': 4}
-                                    })
+    writer_mock().write_motor.assert_has_calls([call('EH1A.01', {'oms:attr1': 4, 'oms:attr2': 4,
+                                                                 'zmx:attr1': 4, 'zmx:attr2': 4}),
+                                                call('EH1A.03', {'oms:attr1': 4, 'oms:attr2': 4,
+                                                                 'zmx:attr1': 4, 'zmx:attr2': 4})])
 
 
+@patch('readMotor.read_parameters')
 @patch('readMotor.write_parameters')
 @patch('readMotor.read_dat')
 @patch('readMotor.DeviceProxy')
 @patch('readMotor.parse_args')
-def test_main_write(args_p_mock, dp_mock, read_dat_mock, write_params_mock):
+def test_main_write(args_p_mock, dp_mock, read_dat_mock, write_params_mock, read_params_mock, tmp_path, monkeypatch):
+    # The journal is written in the current directory
+    monkeypatch.chdir(tmp_path)
     # This time, let's try a parameter writing run...
     args_p_mock.return_value = {'beamline': 'p02',
                                 'tango_host': 'haspp02oh1:10000',
@@ -195,10 +550,287 @@ def test_main_write(args_p_mock, dp_mock, read_dat_mock, write_params_mock):
                                   'EH1A.03': {'oms:attr1': 1, 'oms:attr2': 43,
                                               'zmx:attra': 6, 'zmx:attrb': 793}
                                   }
+    read_params_mock.return_value = {}
+
+    with patch('readMotor._reduced_attr', ['oms:attr1', 'oms:attr2', 'zmx:attra', 'zmx:attrb']):
+        main()
+
+    read_dat_mock.assert_called_with('new-motors.param', lazy=True)
+    write_params_mock.assert_called_once_with(dp_mock(), dp_mock(),
+                                              {'oms:attr1': 1, 'oms:attr2': 43,
+                                               'zmx:attra': 6, 'zmx:attrb': 793},
+                                              reduced_params_list=ANY, raise_errors=True, write_eprom=True,
+                                              retry_policy=ANY, old_params={})
+
+
+@patch('readMotor.read_parameters')
+@patch('readMotor.write_parameters')
+@patch('readMotor.DeviceProxy')
+def test_write_motors_rollback(dp_mock, write_params_mock, read_params_mock):
+    config = {'beamline': 'p02', 'tango_host': 'haspp02oh1:10000', 'jobs': 2}
+    dp_mock.side_effect = lambda name: name
+    read_params_mock.return_value = {'oms:attr1': 0}
+
+    def fake_write(oms_dp, zmx_dp, params, **kwargs):
+        # EH1A.02 can't be written at all, EH1A.03 can at least be reverted
+        if oms_dp.endswith('EH1A.02') or (oms_dp.endswith('EH1A.03') and params['oms:attr1'] != 0):
+            raise Exception('Write failed')
+    write_params_mock.side_effect = fake_write
+
+    all_params = {motor: {'oms:attr1': 1} for motor in ['EH1A.01', 'EH1A.02', 'EH1A.03']}
+    with patch('readMotor._reduced_attr', ['oms:attr1']):
+        summary = write_motors(config, all_params)
+
+    assert summary == {'committed': ['EH1A.01'], 'unchanged': [],
+                       'rolled back': ['EH1A.03'], 'failed': ['EH1A.02']}
+
+
+@patch('readMotor.read_parameters')
+@patch('readMotor.DeviceProxy')
+def test_read_motors_concurrent(dp_mock, read_params_mock):
+    config = {'beamline': 'p02', 'tango_host': 'haspp02oh1:10000', 'jobs': 4}
+    dev_names = generate_device_names('EH1A', [1, 2, 3, 4, 5])
+
+    def fake_read(oms_dp, zmx_dp, chunk_size=None, selection=None, deadline=None, source=None):
+        if oms_dp == 'haspp02oh1:10000/p02/motor/EH1A.03':
+            raise Exception('Crate is dead')
+        return {'oms:name': oms_dp}
+
+    dp_mock.side_effect = lambda name: name
+    read_params_mock.side_effect = fake_read
+
+    all_params = read_motors(config, dev_names)
+    # Broken motor is left out, the rest are returned in order
+    assert list(all_params.keys()) == ['EH1A.01', 'EH1A.02', 'EH1A.04', 'EH1A.05']
+    assert all_params['EH1A.05'] == {'oms:name': 'haspp02oh1:10000/p02/motor/EH1A.05'}
+
+
+@patch('readMotor.DeviceProxy')
+def test_proxy_pool(dp_mock):
+    dp_mock.side_effect = lambda name: Mock(name=name)
+
+    first = get_proxy('haspp02oh1:10000/p02/motor/EH1A.01')
+    assert get_proxy('haspp02oh1:10000/p02/motor/EH1A.01') is first
+    assert dp_mock.call_count == 1
+
+    # Once evicted, a fresh proxy is made
+    evict_proxy('haspp02oh1:10000/p02/motor/EH1A.01')
+    assert get_proxy('haspp02oh1:10000/p02/motor/EH1A.01') is not first
+    assert dp_mock.call_count == 2
+
+
+def test_compare_parameters():
+    input_params = {'EH1A.01': {'oms:Conversion': 0.1, 'oms:Position': 5.0, 'zmx:AxisName': 'Phi'},
+                    'EH1A.02': {'oms:Conversion': 2, 'oms:Position': math.nan, 'zmx:RunCurrent': 3}}
+    current_params = {'EH1A.01': {'oms:Conversion': 0.1 + 1e-17, 'oms:Position': 5.004, 'zmx:AxisName': 'Phi'},
+                      'EH1A.02': {'oms:Conversion': 2.5, 'oms:Position': math.nan}}
+
+    diffs, summary = compare_parameters(input_params, current_params, tolerances={'oms:Pos*': {'abs': 0.001}})
+    assert [(diff['motor'], diff['parameter'], diff['status']) for diff in diffs] == [
+        ('EH1A.01', 'oms:Position', 'different'),
+        ('EH1A.02', 'oms:Conversion', 'different'),
+        ('EH1A.02', 'zmx:RunCurrent', 'missing')]
+    assert diffs[1]['difference'] == 0.5
+    assert summary['parameters'] == 6
+    assert summary['different_motors'] == ['EH1A.01', 'EH1A.02']
+
+    # A looser tolerance hides the Position difference
+    diffs, summary = compare_parameters(input_params, current_params, tolerances={'oms:Position': {'abs': 0.01}})
+    assert summary['same_motors'] == ['EH1A.01']
+
+
+@patch('readMotor.DeviceProxy')
+@patch('readMotor.parse_args')
+def test_main_compare_offline(args_p_mock, dp_mock, tmp_path):
+    (tmp_path / 'input.params').write_text('EH1A.01,oms:attr1,4.3,oms:attr2,7\n')
+    (tmp_path / 'current.params').write_text('EH1A.01,oms:attr1,4.3,oms:attr2,8\n')
+    args_p_mock.return_value = {'beamline': 'p02',
+                                'tango_host': 'haspp02oh1:10000',
+                                'server': 'EH1A',
+                                'dev_ids': [1],
+                                'write_params': False,
+                                'compare_params': True,
+                                'input_file': str(tmp_path / 'input.params'),
+                                'compare_against': str(tmp_path / 'current.params'),
+                                'diff_csv': str(tmp_path / 'diff.csv')}
 
     main()
+    dp_mock.assert_not_called()
+    assert (tmp_path / 'diff.csv').read_text().splitlines() == ['motor,parameter,input,current,difference,status',
+                                                                'EH1A.01,oms:attr2,7,8,1,different']
+
+
+def test_write_diff_json_nan(tmp_path):
+    # The current value couldn't be read
+    diffs, summary = compare_parameters({'EH1A.01': {'oms:Position': 5.0}}, {'EH1A.01': {'oms:Position': math.nan}})
+    assert diffs[0]['status'] == 'nan'
 
-    read_dat_mock.assert_called_with('new-motors.param')
-    write_params_mock.assert_called_once_with(dp_mock(), dp_mock(), 
-                                           {'oms:attr1': 1, 'oms:attr2': 43,
-                                            'zmx:attra': 6, 'zmx:attrb': 793})
+    write_diff_json(diffs, summary, str(tmp_path / 'diff.json'))
+    # Strict JSON: nan is written as null
+    diff_json = json.loads((tmp_path / 'diff.json').read_text(), parse_constant=pytest.fail)
+    assert diff_json['differences'] == [{'motor': 'EH1A.01', 'parameter': 'oms:Position', 'input': 5.0,
+                                         'current': None, 'difference': None, 'status': 'nan'}]
+
+
+@patch('readMotor.DeviceProxy')
+def test_run_compare_offline_nan(dp_mock, tmp_path):
+    # nan in either file is reported as a difference
+    (tmp_path / 'input.params').write_text('EH1A.01,oms:attr1,nan,oms:attr2,5\n')
+    (tmp_path / 'current.params').write_text('EH1A.01,oms:attr1,3,oms:attr2,nan\n')
+    config = {'beamline': 'p02', 'tango_host': 'haspp02oh1:10000', 'server': 'EH1A', 'dev_ids': [1],
+              'write_params': False, 'compare_params': True, 'input_file': str(tmp_path / 'input.params'),
+              'compare_against': str(tmp_path / 'current.params')}
+
+    result = run(config)
+    dp_mock.assert_not_called()
+    assert [(diff['parameter'], diff['status']) for diff in result['differences']] == [('oms:attr1', 'nan'),
+                                                                                       ('oms:attr2', 'nan')]
+    assert result['compare_summary']['different_motors'] == ['EH1A.01']
+
+
+@patch('readMotor.SnapshotWriter')
+@patch('readMotor.read_parameters')
+@patch('readMotor.DeviceProxy')
+@patch('readMotor.parse_args')
+def test_main_sweep(args_p_mock, dp_mock, read_params_mock, writer_mock):
+    args_p_mock.return_value = {'beamline': 'p02',
+                                'tango_host': 'haspp02oh1:10000,haspp07eh1:10000/p07',
+                                'server': 'EH1A,EH1B',
+                                'dev_ids': [1],
+                                'host_jobs': 2,
+                                'compare_params': False,
+                                'write_params': False}
+    dp_mock.side_effect = lambda name: name
+    read_params_mock.side_effect = lambda oms_dp, zmx_dp, **kwargs: {'oms:name': oms_dp}
+
+    targets = sweep_targets(args_p_mock.return_value)
+    assert [(t['tango_host'], t['beamline'], t['server']) for t in targets] == [
+        ('haspp02oh1:10000', 'p02', 'EH1A'), ('haspp02oh1:10000', 'p02', 'EH1B'),
+        ('haspp07eh1:10000', 'p07', 'EH1A'), ('haspp07eh1:10000', 'p07', 'EH1B')]
+
+    main()
+    # All four servers end up in one snapshot
+    written = {c[0][0]: c[0][1] for c in writer_mock().write_motor.call_args_list}
+    assert written == {'haspp02oh1:10000/p02/EH1A.01': {'oms:name': 'haspp02oh1:10000/p02/motor/EH1A.01'},
+                       'haspp02oh1:10000/p02/EH1B.01': {'oms:name': 'haspp02oh1:10000/p02/motor/EH1B.01'},
+                       'haspp07eh1:10000/p07/EH1A.01': {'oms:name': 'haspp07eh1:10000/p07/motor/EH1A.01'},
+                       'haspp07eh1:10000/p07/EH1B.01': {'oms:name': 'haspp07eh1:10000/p07/motor/EH1B.01'}}
+
+
+def test_attribute_source():
+    assert attribute_source('oms:Position') is None
+    assert attribute_source('oms:Position', 'device') == 'device'
+    assert attribute_source('oms:Position', 'cache') == 'cache'
+    assert attribute_source('oms:FlagProtected', 'cache-device') == 'device'
+
+
+def test_adaptive_limiter():
+    limiter = AdaptiveLimiter(maximum=4)
+    # Latency stays flat: the limit grows to the maximum
+    for _ in range(20):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.limit == 4
+
+    # Latency rises: back off, once for the calls started under the old limit
+    for _ in range(2):
+        limiter.acquire()
+        limiter.release(0.5)
+    assert limiter.limit == 2
+
+    # A failure halves it again, but never below the minimum
+    for _ in range(4):
+        limiter.acquire()
+        limiter.release(0.1, failed=True)
+    assert limiter.limit == 1
+
+
+def test_adaptive_limiter_recovers():
+    limiter = AdaptiveLimiter(maximum=4, window=50)
+    # One unusually fast call only makes the others look slow for a while
+    limiter.acquire()
+    limiter.release(0.01)
+    for _ in range(200):
+        limiter.acquire()
+        limiter.release(0.1)
+    assert limiter.baseline == 0.1
+    assert limiter.limit == 4
+
+
+def test_adaptive_limiter_gate():
+    limiter = AdaptiveLimiter(maximum=1)
+    host_slots = threading.BoundedSemaphore(2)
+    running = threading.Event()
+    finish = threading.Event()
+
+    def slow_call():
+        running.set()
+        finish.wait(5)
+
+    first = threading.Thread(target=limiter.run, args=(slow_call,), kwargs={'gate': host_slots})
+    second = threading.Thread(target=limiter.run, args=(lambda: None,), kwargs={'gate': host_slots})
+    first.start()
+    running.wait(5)
+    second.start()
+    time.sleep(0.05)
+    # The second call waits for the limiter without holding a host slot
+    assert host_slots.acquire(blocking=False)
+    host_slots.release()
+    finish.set()
+    first.join()
+    second.join()
+    assert limiter.in_flight == 0
+
+
+def test_write_journal_torn_line(tmp_path):
+    filename = str(tmp_path / 'motors.journal')
+    with WriteJournal(filename) as journal:
+        journal.begin('S.01', {'oms:attr1': 1}, {'oms:attr1': 2}, True)
+        journal.begin('S.02', {'oms:attr1': 3}, {'oms:attr1': 4}, True)
+    with open(filename, 'a') as journal_file:
+        # A damaged line, then the run died half way through a line
+        journal_file.write('{"event": "end", "mot\n{"event": "end", "motor": "S.0')
+
+    with WriteJournal.resume(filename) as journal:
+        journal.end('S.01', 'committed')
+    with WriteJournal.resume(filename) as journal:
+        assert journal.done_motors == {'S.01'}
+        assert journal.old_values() == {'S.01': {'oms:attr1': 1}, 'S.02': {'oms:attr1': 3}}
+
+
+def test_unique_filenames(tmp_path):
+    now = datetime(2019, 4, 14, 23, 52, 5)
+    config = {'output_dir': str(tmp_path)}
+    with patch('readMotor.datetime') as date_mock:
+        date_mock.today.return_value = now
+        # Two runs started in the same second
+        journals = [WriteJournal.create(config) for _ in range(2)]
+        for journal in journals:
+            journal.close()
+        snapshots = [new_snapshot_filenames(str(tmp_path)) for _ in range(2)]
+    assert [os.path.basename(journal.filename) for journal in journals] == [
+        'motors-20190414_235205.journal', 'motors-20190414_235205-2.journal']
+    assert [os.path.basename(filename) for filename, _ in snapshots] == [
+        'motors-20190414_235205.params', 'motors-20190414_235205-2.params']
+    assert os.path.basename(snapshots[1][1]) == 'motors-20190414_235205-2_reduced.params'
+    with pytest.raises(FileExistsError):
+        WriteJournal(journals[0].filename)
+
+
+@pytest.mark.parametrize('write_params, resume', [(False, 'motors.journal'), (True, 'motors.params.part')])
+def test_resume_file_must_match_mode(write_params, resume):
+    config = {'tango_host': 'haspp02oh1:10000', 'beamline': 'p02', 'server': 'EH1A', 'dev_ids': [1],
+              'write_params': write_params, 'compare_params': False, 'resume': resume}
+    with pytest.raises(SystemExit):
+        run(config)
+
+
+def test_write_dat_snapshot(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    fleet = FleetSnapshot(all_params={'EH1A.02': {'zmx:attr1': 2, 'oms:attr2': 0.5},
+                                      'EH1A.01': {'oms:attr1': 4.3, 'zmx:AxisName': 'Chi'}})
+    with patch('readMotor.snapshot_filenames', return_value=('full.params', 'reduced.params')):
+        write_dat(fleet, ['oms:attr1'])
+    assert (tmp_path / 'full.params').read_text() == ('EH1A.01,oms:attr1,4.3,zmx:AxisName,Chi\n'
+                                                      'EH1A.02,oms:attr2,0.5,zmx:attr1,2\n')
+    assert (tmp_path / 'reduced.params').read_text() == 'EH1A.01,oms:attr1,4.3\nEH1A.02\n'
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+import readMotor
+import shardedSnapshot
+from shardedSnapshot import ShardMergeError, merge_shards, prepare_shards, shard_motors
+from simulatedMotors import SimulatedFarm
+
+
+class FinishedWorker(object):
+    def wait(self):
+        return 0
+
+
+def test_shard_motors():
+    motors = ['EH1B.01', 'EH1A.02', 'EH1A.01', 'EH1B.02', 'EH1A.03']
+    assert shard_motors(motors, 2) == [['EH1A.01', 'EH1A.03', 'EH1B.02'], ['EH1A.02', 'EH1B.01']]
+    assert shard_motors(motors, 8) == [[motor] for motor in sorted(motors)]
+
+
+def test_sharded_snapshot(tmp_path, monkeypatch):
+    farm = SimulatedFarm()
+    farm.dead_devices.add('sim:10000/p02/ZMX/SIM.04')
+
+    def launch_here(spec_filename, host=None):
+        shardedSnapshot.run_worker(spec_filename)
+        return FinishedWorker()
+
+    monkeypatch.setattr(shardedSnapshot, 'launch_shard', launch_here)
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'server': 'SIM', 'dev_ids': [1, 2, 3, 4, 5],
+              'selection': None, 'write_params': False, 'compare_params': False, 'shards': 3,
+              'output_dir': str(tmp_path)}
+    with farm.patch():
+        result = readMotor.run(config)
+
+    assert result['motors'] == ['SIM.01', 'SIM.02', 'SIM.03', 'SIM.05']
+    assert result['motor_status']['SIM.04'][0] == 'failed'
+    params_filename, reduced_params_filename = result['snapshot']
+    merged = readMotor.read_dat(params_filename)
+    assert list(merged) == result['motors']
+    assert len(merged['SIM.01']) > 0
+    assert len(readMotor.read_dat(reduced_params_filename)) == 4
+
+    # The merge can be repeated from the shard directory alone
+    shard_dir = params_filename[:-len('.params')] + '.shards'
+    with open(params_filename) as params_file:
+        first_merge = params_file.read()
+    merge_shards(shard_dir)
+    with open(params_filename) as params_file:
+        assert params_file.read() == first_merge
+
+
+def write_partial(shard_dir, name, lines):
+    for suffix in ('.params', '_reduced.params'):
+        with open(os.path.join(shard_dir, name + suffix), 'w') as params_file:
+            params_file.writelines(lines)
+
+
+def test_merge_checks(tmp_path):
+    shard_dir = str(tmp_path / 'motors.shards')
+    snapshot = [str(tmp_path / 'motors.params'), str(tmp_path / 'motors_reduced.params')]
+    prepare_shards({'shards': 2}, ['SIM.01', 'SIM.02', 'SIM.03'], shard_dir, snapshot)
+
+    # Read twice with the same values is fine; SIM.02 was never read
+    write_partial(shard_dir, 'shard-01', ['SIM.03,oms:Position,2.0\n', 'SIM.01,oms:Position,1.0\n'])
+    write_partial(shard_dir, 'shard-02', ['SIM.01,oms:Position,1.0\n'])
+    snapshot_writer = merge_shards(shard_dir)
+    assert snapshot_writer.done_motors == {'SIM.01', 'SIM.03'}
+    with open(snapshot[0]) as params_file:
+        assert params_file.readlines() == ['SIM.01,oms:Position,1.0\n', 'SIM.03,oms:Position,2.0\n']
+    assert readMotor.read_motor_status(str(tmp_path / 'motors.status')) == {
+        'SIM.02': ('missing', 'not in any partial snapshot')}
+
+    write_partial(shard_dir, 'shard-02', ['SIM.01,oms:Position,1.5\n'])
+    with pytest.raises(ShardMergeError):
+        merge_shards(shard_dir)
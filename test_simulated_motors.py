@@ -0,0 +1,187 @@
+import threading
+import time
+
+import pytest
+
+import readMotor
+from simulatedMotors import SimulatedFarm
+from benchmark import run_scenario
+
+
+def test_simulated_farm_round_trips():
+    farm = SimulatedFarm(extra_attributes=5)
+    with farm.patch():
+        oms_dp, zmx_dp = readMotor.get_motor_proxies({'tango_host': 'sim:10000', 'beamline': 'p02'}, 'SIM.01')
+        farm.reset_counts()
+        motor_params = readMotor.read_parameters(oms_dp, zmx_dp)
+
+    assert motor_params['zmx:AxisName'] == 'SIM.01'
+    assert 'oms:Diagnostic004' in motor_params
+    # One listing and one batched read per device
+    assert farm.calls == {'get_attribute_list': 2, 'read_attributes': 2}
+
+
+def test_simulated_farm_failures():
+    farm = SimulatedFarm(failure_rate=1.0)
+    with farm.patch():
+        all_params = readMotor.read_motors({'tango_host': 'sim:10000', 'beamline': 'p02'}, {'SIM': ['SIM.01']})
+    # Even creating the proxies fails, so the motor is left out
+    assert all_params == {}
+
+
+def test_benchmark_scenarios():
+    for scenario in ['full', 'reduced', 'compare', 'write']:
+        result = run_scenario(scenario, 4, {}, jobs=2)
+        assert result['motors'] == 4
+        assert result['round_trips_per_motor'] > 0
+
+
+def test_probe_skips_dead_motors(tmp_path):
+    farm = SimulatedFarm()
+    farm.dead_devices.add('sim:10000/p02/ZMX/SIM.02')
+    params_file = str(tmp_path / 'motors-20190414_235205.params')
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'probe': True, 'probe_timeout': 100}
+    with farm.patch(), readMotor.SnapshotWriter(params_file, params_file[:-7] + '_reduced.params') as writer:
+        readMotor.read_motors(config, {'SIM': ['SIM.01', 'SIM.02', 'SIM.03']}, snapshot_writer=writer)
+
+    assert writer.done_motors == {'SIM.01', 'SIM.03'}
+    # Only the pings went to the dead motor
+    assert farm.calls['read_attributes'] == 4
+    status = (tmp_path / 'motors-20190414_235205.status').read_text()
+    assert status.startswith('SIM.02,skipped,sim:10000/p02/ZMX/SIM.02 did not answer ping')
+
+
+def test_motor_budget():
+    farm = SimulatedFarm(latency=0.01)
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'chunk_size': 1, 'motor_budget': 0.05}
+    with farm.patch():
+        all_params = readMotor.read_motors(config, {'SIM': ['SIM.01']})
+    assert all_params == {}
+
+
+def test_motor_budget_hanging_device():
+    farm = SimulatedFarm()
+    farm.hanging_devices.add('sim:10000/p02/ZMX/SIM.01')
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'motor_budget': 0.1}
+    with farm.patch():
+        start = time.monotonic()
+        all_params = readMotor.read_motors(config, {'SIM': ['SIM.01', 'SIM.02']})
+        # Not the 3 s client timeout
+        assert time.monotonic() - start < 1
+        assert readMotor.get_proxy('sim:10000/p02/ZMX/SIM.01').get_timeout_millis() == 3000
+    assert list(all_params) == ['SIM.02']
+
+
+def test_watch_polling(tmp_path):
+    farm = SimulatedFarm()
+    log_file = tmp_path / 'changes.log'
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'selection': ['oms:SlewRate', 'zmx:RunCurrent']}
+    with farm.patch():
+        watcher = readMotor.MotorWatcher(config, ['SIM.01', 'SIM.02'], str(log_file))
+        watcher.start()
+        # No change events from the simulated devices
+        assert watcher.polled_motors == ['SIM.01', 'SIM.02']
+        assert watcher.poll() == 0
+
+        farm.devices['sim:10000/p02/motor/SIM.02'].attributes['SlewRate'] = 1234
+        farm.reset_counts()
+        assert watcher.poll() == 1
+        # Only the watched attributes are read
+        assert farm.calls == {'read_attributes': 4}
+        watcher.close()
+
+    assert watcher.state['SIM.02']['oms:SlewRate'] == 1234
+    timestamp, motor, label, old_value, new_value = log_file.read_text().strip().split(',')
+    assert (motor, label, new_value) == ('SIM.02', 'oms:SlewRate', '1234')
+
+
+def test_adaptive_reads(monkeypatch):
+    monkeypatch.setattr(readMotor, '_limiters', {})
+    farm = SimulatedFarm(latency=0.002, server_capacity=4)
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'adaptive': 16}
+    motors = ['SIM.{:02d}'.format(i) for i in range(1, 49)]
+    with farm.patch():
+        all_params = readMotor.read_motors(config, {'SIM': motors})
+    assert list(all_params) == motors
+
+    limiter = readMotor._limiters[('read', 'sim:10000', 'SIM')]
+    assert limiter.peak > 1
+    assert limiter.in_flight == 0
+
+
+def test_write_journal_resume_and_rollback(tmp_path, monkeypatch):
+    farm = SimulatedFarm()
+    params_file = tmp_path / 'new.params'
+    params_file.write_text('SIM.01,oms:SlewRate,111\nSIM.02,oms:SlewRate,222\nSIM.03,oms:SlewRate,333\n')
+    monkeypatch.setattr(readMotor, '_reduced_attr', ['oms:SlewRate'])
+    monkeypatch.chdir(tmp_path)
+
+    def slew_rates():
+        return [farm.devices['haspp02oh1:10000/p02/motor/SIM.0{}'.format(i)].attributes['SlewRate'] for i in (1, 2, 3)]
+
+    real_end = readMotor.WriteJournal.end
+
+    def interrupted_end(journal, motor, outcome):
+        if motor == 'SIM.02':
+            raise KeyboardInterrupt
+        real_end(journal, motor, outcome)
+
+    with farm.patch():
+        readMotor.read_motors({'tango_host': 'haspp02oh1:10000', 'beamline': 'p02'}, {'SIM': ['SIM.01', 'SIM.02', 'SIM.03']})
+        original = slew_rates()
+
+        # The run dies after writing SIM.02, before recording that it did
+        monkeypatch.setattr(readMotor.WriteJournal, 'end', interrupted_end)
+        with pytest.raises(KeyboardInterrupt):
+            readMotor.run(readMotor.parse_args(['-s', 'SIM', '--write', 'new.params', '1,2,3']))
+        monkeypatch.setattr(readMotor.WriteJournal, 'end', real_end)
+        journal_file = str(next(tmp_path.glob('*.journal')))
+        assert slew_rates() == [111, 222, original[2]]
+
+        result = readMotor.run(readMotor.parse_args(['-s', 'SIM', '--write', 'new.params', '--resume', journal_file, '1,2,3']))
+        assert result['write_summary']['committed'] == ['SIM.02', 'SIM.03']
+        assert slew_rates() == [111, 222, 333]
+
+        result = readMotor.run(readMotor.parse_args(['-s', 'SIM', '--rollback', journal_file, '1,2,3']))
+        assert result['write_summary']['committed'] == ['SIM.01', 'SIM.02', 'SIM.03']
+        assert slew_rates() == original
+
+    # Nothing left to roll back
+    with readMotor.WriteJournal.resume(journal_file) as journal:
+        assert journal.old_values() == {}
+
+
+def test_read_source():
+    farm = SimulatedFarm()
+    farm.polled_attributes.update({'Position', 'StepPositionController', 'FlagProtected'})
+    config = {'tango_host': 'sim:10000', 'beamline': 'p02', 'read_source': 'cache-device'}
+    with farm.patch():
+        all_params = readMotor.read_motors(config, {'SIM': ['SIM.01']})
+        assert farm.hardware_reads['Position'] == 0
+        assert farm.hardware_reads['Conversion'] == 1
+        # The policy makes the protection flag come from the hardware, polled or not
+        assert farm.hardware_reads['FlagProtected'] == 1
+        # The proxy's source is put back afterwards
+        oms_dp, zmx_dp = readMotor.get_motor_proxies(config, 'SIM.01')
+        assert oms_dp.get_source() == 'CACHE_DEV'
+
+        # Attributes which aren't polled can't be read from the cache alone
+        cached_params = readMotor.read_motors(dict(config, read_source='cache'), {'SIM': ['SIM.01']})
+    assert cached_params['SIM.01']['oms:Position'] == all_params['SIM.01']['oms:Position']
+    assert readMotor.is_nan(cached_params['SIM.01']['oms:Conversion'])
+    assert cached_params['SIM.01']['oms:FlagProtected'] == all_params['SIM.01']['oms:FlagProtected']
+
+
+def test_read_source_shared_proxy():
+    farm = SimulatedFarm(latency=0.05)
+    farm.polled_attributes.add('Position')
+    with farm.patch():
+        dev_proxy = readMotor.get_proxy('sim:10000/p02/motor/SIM.01')
+        hardware_read = threading.Thread(target=readMotor.read_source_values,
+                                         args=(dev_proxy, ['Conversion'], 'device'))
+        hardware_read.start()
+        time.sleep(0.01)
+        # Another request reads the same proxy while its source is changed
+        readMotor.read_source_values(dev_proxy, ['Position'])
+        hardware_read.join()
+    assert farm.hardware_reads == {'Conversion': 1}
@@ -0,0 +1,53 @@
+from datetime import datetime
+
+from snapshotHistory import HistoryCatalog
+
+
+def write_snapshot(snapshot_dir, stamp, lines):
+    (snapshot_dir / 'motors-{}.params'.format(stamp)).write_text(''.join(line + '\n' for line in lines))
+    # Reduced files are not catalogued
+    (snapshot_dir / 'motors-{}_reduced.params'.format(stamp)).write_text('')
+
+
+def test_history_catalog(tmp_path):
+    snapshot_dir = tmp_path / 'snapshots'
+    snapshot_dir.mkdir()
+    catalog_dir = str(tmp_path / 'catalog')
+
+    write_snapshot(snapshot_dir, '20190401_120000', ['EH1A.17,oms:Conversion,100.0,zmx:AxisName,Phi'])
+    write_snapshot(snapshot_dir, '20190402_120000', ['EH1A.17,oms:Conversion,100.0,zmx:AxisName,Phi'])
+    write_snapshot(snapshot_dir, '20190404_120000', ['EH1A.17,oms:Conversion,200.0,zmx:AxisName,Phi'])
+
+    catalog = HistoryCatalog(catalog_dir)
+    assert catalog.update(str(snapshot_dir)) == 3
+    assert catalog.change_points('EH1A.17', 'oms:Conversion') == [(datetime(2019, 4, 1, 12), 100.0),
+                                                                  (datetime(2019, 4, 4, 12), 200.0)]
+
+    # Only new files are read, and they needn't be newer than the rest
+    write_snapshot(snapshot_dir, '20190403_120000', ['EH1A.17,oms:Conversion,150.0,zmx:AxisName,Phi'])
+    catalog = HistoryCatalog(catalog_dir)
+    assert catalog.update(str(snapshot_dir)) == 1
+    assert catalog.update(str(snapshot_dir)) == 0
+
+    catalog = HistoryCatalog(catalog_dir)
+    assert catalog.series('EH1A.17', 'oms:Conversion') == [(datetime(2019, 4, 1, 12), 100.0),
+                                                           (datetime(2019, 4, 2, 12), 100.0),
+                                                           (datetime(2019, 4, 3, 12), 150.0),
+                                                           (datetime(2019, 4, 4, 12), 200.0)]
+    assert catalog.change_points('EH1A.17', 'zmx:AxisName') == [(datetime(2019, 4, 1, 12), 'Phi')]
+    assert catalog.value_at('EH1A.17', 'oms:Conversion', datetime(2019, 4, 3, 18)) == 150.0
+    assert catalog.value_at('EH1A.17', 'oms:Conversion', datetime(2019, 3, 1)) is None
+
+
+def test_history_catalog_sweep_names(tmp_path):
+    snapshot_dir = tmp_path / 'snapshots'
+    snapshot_dir.mkdir()
+    catalog_dir = str(tmp_path / 'catalog')
+    motor = 'haspp02oh1:10000/p02/EH1A.01'
+
+    write_snapshot(snapshot_dir, '20190401_120000', [motor + ',oms:Conversion,100.0'])
+    assert HistoryCatalog(catalog_dir).update(str(snapshot_dir)) == 1
+
+    catalog = HistoryCatalog(catalog_dir)
+    assert catalog.motors() == [motor]
+    assert catalog.change_points(motor, 'oms:Conversion') == [(datetime(2019, 4, 1, 12), 100.0)]
@@ -0,0 +1,48 @@
+import json
+
+import readMotor
+from simulatedMotors import SimulatedFarm
+from tangoMetrics import Metrics
+
+
+def test_metrics_record():
+    metrics = Metrics()
+    metrics.record('oms', 'read_attribute', 'Position', 0.002)
+    metrics.record('oms', 'read_attribute', 'Position', 0.3, failed=True)
+    metrics.record('zmx', 'WriteEPROM', '', 0.0001)
+
+    report = metrics.report()
+    assert [entry['operation'] for entry in report] == ['read_attribute', 'WriteEPROM']
+    assert report[0]['count'] == 2
+    assert report[0]['errors'] == 1
+    assert report[0]['max_seconds'] == 0.3
+    assert report[0]['histogram']['0.0025'] == 1
+    assert report[0]['histogram']['0.5'] == 1
+
+
+def test_metrics_of_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(readMotor, '_metrics', None)
+    farm = SimulatedFarm()
+    with farm.patch():
+        metrics = readMotor.enable_metrics()
+        readMotor.read_motors({'tango_host': 'sim:10000', 'beamline': 'p02', 'chunk_size': 1},
+                              {'SIM': ['SIM.01', 'SIM.02']})
+
+    calls = {(entry['device_class'], entry['operation'], entry['attribute']): entry['count']
+             for entry in metrics.report()}
+    assert calls[('oms', 'DeviceProxy', '')] == 2
+    assert calls[('zmx', 'get_attribute_list', '')] == 2
+    # With --chunk-size 1 every attribute is timed separately
+    assert calls[('oms', 'read_attributes', 'Conversion')] == 2
+    assert calls[('motor', 'read_motor', '')] == 2
+
+    metrics.write(str(tmpdir.join('metrics.json')))
+    with open(str(tmpdir.join('metrics.json'))) as json_file:
+        assert len(json.load(json_file)) == len(calls)
+
+    metrics.write(str(tmpdir.join('metrics.prom')))
+    prom_lines = tmpdir.join('metrics.prom').read().splitlines()
+    assert ('motor_reader_tango_call_seconds_count'
+            '{device_class="oms",operation="DeviceProxy",attribute=""} 2') in prom_lines
+    assert ('motor_reader_tango_call_seconds_bucket'
+            '{device_class="oms",operation="DeviceProxy",attribute="",le="+Inf"} 2') in prom_lines